@@ -0,0 +1,355 @@
+""" asyncio download engine for large batches of URLs.
+
+    Uses a minimal HTTP/1.1 client built on asyncio streams (no extra dependencies),
+    with kept-alive connections per host and a bound on the number of concurrent requests.
+    File writes are offloaded to threads, so they don't block the event loop.
+
+    Usage:
+        # Sync wrapper, like httptools.download_urls:
+        paths = asynchttp.download_urls(urls, "downloads", concurrency=100)
+
+        # Or from a coroutine:
+        async with asynchttp.Client(concurrency=100) as client:
+            path = await asynchttp.download_url(client, url, "downloads")
+"""
+
+import asyncio
+import logging
+import math
+import os
+import ssl
+from urllib.parse import urljoin, urlsplit
+
+from . import filetools as ft
+from .httptools import CHUNK_SIZE, PWRITE_AVAILABLE, path_from_url, pwrite
+
+REDIRECTS = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 10
+
+
+class HTTPError(IOError):
+    def __init__(self, response):
+        super().__init__("{} {}".format(response.status_code, response.url))
+        self.response = response
+
+
+class Response:
+    """ A streamed HTTP response. Always close() it (or use 'async with'). """
+
+    def __init__(self, client, key, url, method, status, headers, reader, writer):
+        self.client = client
+        self.key = key
+        self.url = url
+        self.method = method
+        self.status_code = status
+        self.headers = headers  # Lowercase names.
+        self.reader = reader
+        self.writer = writer
+        self.consumed = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def iter_content(self, chunk_size=CHUNK_SIZE):
+        """ Asynchronously iterate over the body in chunks of at most chunk_size bytes. """
+        limiter = self.client.limiter
+        async for chunk in iter_body(self.reader, self.method, self.status_code, self.headers,
+                                     chunk_size, self.client.timeout):
+            if limiter:
+                await asyncio.sleep(limiter.reserve(self.url, size=len(chunk)))
+            yield chunk
+        self.consumed = True
+
+    async def read(self):
+        return b"".join([chunk async for chunk in self.iter_content()])
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise HTTPError(self)
+
+    async def close(self):
+        """ Return the connection to the pool if the body was read, otherwise close it. """
+        if self.writer is None:
+            return
+        keep_alive = self.consumed and self.headers.get("connection", "").lower() != "close"
+        self.client.release(self.key, self.reader, self.writer, keep_alive)
+        self.writer = None
+
+
+async def iter_body(reader, method, status, headers, chunk_size, timeout=None):
+    """ Read the body of a response (Content-Length, chunked or until the connection is closed). """
+    if method == "HEAD" or status in (204, 304) or 100 <= status < 200:
+        return
+    if "chunked" in headers.get("transfer-encoding", "").lower():
+        while True:
+            line = await asyncio.wait_for(reader.readline(), timeout)
+            size = int(line.split(b";")[0].strip(), 16)
+            if size == 0:
+                # Skip the trailers.
+                while (await asyncio.wait_for(reader.readline(), timeout)) not in (b"\r\n", b"\n", b""):
+                    pass
+                return
+            while size > 0:
+                chunk = await asyncio.wait_for(reader.readexactly(min(size, chunk_size)), timeout)
+                size -= len(chunk)
+                yield chunk
+            await asyncio.wait_for(reader.readline(), timeout)
+    elif "content-length" in headers:
+        remaining = int(headers["content-length"])
+        while remaining > 0:
+            chunk = await asyncio.wait_for(reader.read(min(remaining, chunk_size)), timeout)
+            if not chunk:
+                raise ConnectionError("Connection closed with {} bytes missing".format(remaining))
+            remaining -= len(chunk)
+            yield chunk
+    else:
+        while True:
+            chunk = await asyncio.wait_for(reader.read(chunk_size), timeout)
+            if not chunk:
+                return
+            yield chunk
+
+
+class Client:
+    """ Keeps idle connections per host alive and limits the number of concurrent requests.
+        limiter: optional ratelimit.RateLimiter (can be shared with threaded downloads).
+    """
+
+    def __init__(self, concurrency=64, timeout=60, headers=None, limiter=None):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.limiter = limiter
+        self.timeout = timeout
+        self.headers = headers or {"User-Agent": "pytools", "Accept-Encoding": "identity"}
+        self.idle = {}  # (scheme, host, port) -> [(reader, writer)]
+        self.ssl_context = ssl.create_default_context()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def request(self, method, url, headers=None, allow_redirects=True):
+        """ Send a request and return the Response once its headers arrive. """
+        for _ in range(MAX_REDIRECTS + 1):
+            response = await self._request(method, url, headers)
+            location = response.headers.get("location")
+            if not (allow_redirects and response.status_code in REDIRECTS and location):
+                return response
+            await response.close()
+            url = urljoin(url, location)
+            if response.status_code == 303:
+                method = "GET"
+        raise ConnectionError("Too many redirects: {}".format(url))
+
+    async def get(self, url, headers=None, **kwargs):
+        return await self.request("GET", url, headers, **kwargs)
+
+    async def head(self, url, headers=None, **kwargs):
+        return await self.request("HEAD", url, headers, **kwargs)
+
+    def release(self, key, reader, writer, keep_alive):
+        if keep_alive and not reader.at_eof():
+            self.idle.setdefault(key, []).append((reader, writer))
+        else:
+            writer.close()
+        self.semaphore.release()
+
+    async def close(self):
+        for connections in self.idle.values():
+            for _, writer in connections:
+                writer.close()
+        self.idle.clear()
+
+    async def _request(self, method, url, headers):
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        port = parts.port or (443 if scheme == "https" else 80)
+        key = (scheme, parts.hostname, port)
+        target = parts.path or "/"
+        if parts.query:
+            target += "?" + parts.query
+
+        all_headers = dict(self.headers)
+        all_headers.update(headers or {})
+        all_headers["Host"] = parts.netloc
+        request = "{} {} HTTP/1.1\r\n".format(method, target)
+        request += "".join("{}: {}\r\n".format(k, v) for k, v in all_headers.items()) + "\r\n"
+
+        if self.limiter:
+            await asyncio.sleep(self.limiter.reserve(url, requests=1))
+        await self.semaphore.acquire()
+        try:
+            # A kept-alive connection may have been closed by the server, so retry once with a new one.
+            for reuse in (True, False):
+                reader, writer = await self._connect(key, reuse)
+                try:
+                    writer.write(request.encode("latin-1"))
+                    await writer.drain()
+                    status, response_headers = await asyncio.wait_for(read_head(reader), self.timeout)
+                    break
+                except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+                    writer.close()
+                    if not reuse:
+                        raise
+        except BaseException:
+            self.semaphore.release()
+            raise
+        return Response(self, key, url, method, status, response_headers, reader, writer)
+
+    async def _connect(self, key, reuse):
+        idle = self.idle.get(key)
+        while reuse and idle:
+            reader, writer = idle.pop()
+            if not reader.at_eof():
+                return reader, writer
+            writer.close()
+        scheme, host, port = key
+        return await asyncio.wait_for(asyncio.open_connection(
+            host, port, ssl=self.ssl_context if scheme == "https" else None), self.timeout)
+
+
+async def read_head(reader):
+    """ Returns the status code and the headers (lowercase names). """
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("Connection closed")
+    status = int(line.split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    return status, headers
+
+
+async def probe(client, url, headers=None):
+    """ Returns (content length, range support) with a single 'Range: bytes=0-0' request. """
+    headers = dict(headers or {})
+    headers["Range"] = "bytes=0-0"
+    async with await client.get(url, headers) as r:
+        if r.status_code == 206:
+            await r.read()  # The single byte, so that the connection can be reused.
+            # eg: 'content-range': 'bytes 0-0/10494470'
+            total = r.headers.get("content-range", "").rsplit("/", 1)[-1]
+            return (int(total), True) if total.isdigit() else (0, False)
+        # The whole body would follow, so the connection is closed instead.
+        r.raise_for_status()
+        return int(r.headers.get("content-length", 0)), False
+
+
+async def download_basic(client, url, path, headers=None):
+    """ Download url into the file path using a single connection. """
+    async with await client.get(url, headers) as r:
+        r.raise_for_status()
+        f = await asyncio.to_thread(open, path, 'wb')
+        try:
+            async for chunk in r.iter_content():
+                await asyncio.to_thread(f.write, chunk)
+        finally:
+            await asyncio.to_thread(f.close)
+    return path
+
+
+async def download_multiple_connections(client, url, path, total, connections=5, segment_size=None, headers=None):
+    """ Download url into the preallocated file path, 'connections' byte ranges at a time.
+        Connections take segments from a queue, so a slow one doesn't hold up the rest.
+    """
+    if segment_size is None:
+        segment_size = max(CHUNK_SIZE, math.ceil(total / (connections * 4)))
+    segments = asyncio.Queue()
+    for start in range(0, total, segment_size):
+        segments.put_nowait((start, min(total, start + segment_size)))
+
+    await asyncio.to_thread(ft.preallocate_file, path, total)
+    if PWRITE_AVAILABLE:
+        fd = await asyncio.to_thread(os.open, path, os.O_WRONLY)
+        write = lambda offset, data: pwrite(fd, data, offset)
+        close = lambda: os.close(fd)
+    else:
+        f = await asyncio.to_thread(open, path, 'r+b')
+        lock = asyncio.Lock()
+        def write(offset, data):
+            f.seek(offset)
+            f.write(data)
+        close = f.close
+
+    writes = set()  # Writes running in threads (cancelling doesn't stop them).
+
+    async def write_chunk(offset, chunk):
+        future = asyncio.ensure_future(asyncio.to_thread(write, offset, chunk))
+        writes.add(future)
+        future.add_done_callback(writes.discard)
+        await asyncio.shield(future)
+
+    async def worker():
+        while not segments.empty():
+            start, end = segments.get_nowait()
+            range_headers = dict(headers or {})
+            range_headers["Range"] = "bytes={}-{}".format(start, end - 1)
+            async with await client.get(url, range_headers) as r:
+                if r.status_code != 206:
+                    raise HTTPError(r)
+                offset = start
+                async for chunk in r.iter_content():
+                    if PWRITE_AVAILABLE:
+                        await write_chunk(offset, chunk)
+                    else:
+                        async with lock:
+                            await write_chunk(offset, chunk)
+                    offset += len(chunk)
+
+    tasks = [asyncio.ensure_future(worker()) for _ in range(min(connections, segments.qsize()))]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # If a worker failed, the others must stop writing before the file is closed
+        # (its descriptor could be reused by another file right away).
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.gather(*writes, return_exceptions=True)
+        await asyncio.to_thread(close)
+    return path
+
+
+async def download_url(client, url, dir_path, file_name="", connections=5, headers=None):
+    """ Download url into dir_path, using multiple connections if the server supports ranges. """
+    path = os.path.join(dir_path, file_name) if file_name else path_from_url(dir_path, url)
+    logging.info('Downloading {url} to {path}'.format(url=url, path=path))
+    if connections > 1:
+        total, ranges = await probe(client, url, headers)
+        if ranges and total > CHUNK_SIZE:
+            return await download_multiple_connections(client, url, path, total, connections, headers=headers)
+    return await download_basic(client, url, path, headers)
+
+
+async def download_urls_async(urls, path, concurrency=64, connections=1, headers=None, client=None, limiter=None):
+    """ Download all urls with at most 'concurrency' requests at a time.
+
+        path: a directory for all urls or a list of directories (one for each url).
+        connections: connections per file (only used for files bigger than CHUNK_SIZE).
+
+        Returns a list with the file path or the exception of each url.
+    """
+    paths = [path] * len(urls) if isinstance(path, str) else path
+    own_client = client is None
+    client = client or Client(concurrency=concurrency, limiter=limiter)
+    try:
+        tasks = [download_url(client, url, dir_path, connections=connections, headers=headers)
+                 for url, dir_path in zip(urls, paths)]
+        return await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        if own_client:
+            await client.close()
+
+
+def download_urls(urls, path, concurrency=64, connections=1, headers=None, limiter=None):
+    """ Sync wrapper of download_urls_async (for code that doesn't use asyncio). """
+    return asyncio.run(download_urls_async(urls, path, concurrency=concurrency,
+                                           connections=connections, headers=headers, limiter=limiter))
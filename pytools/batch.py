@@ -0,0 +1,161 @@
+""" Batch downloads: a priority queue of urls downloaded by a pool of threads,
+    with at most 'per_host' downloads from the same host at a time.
+
+    Usage:
+        with BatchDownloader(threads=16, per_host=2) as batch:
+            for url in urls:
+                batch.add(url, "downloads")
+            batch.add(important_url, "downloads", priority=10)
+            for result in batch.results():
+                if result.error:
+                    print(result.url, result.error)
+
+        # Or:
+        for result in download_batch(urls, "downloads"):
+            ...
+"""
+
+import collections
+import heapq
+import itertools
+import logging
+import queue
+import threading
+
+from . import httptools
+from .ratelimit import get_host
+
+
+# result: the return value of the download function (usually the file path).
+DownloadResult = collections.namedtuple("DownloadResult", ["url", "path", "result", "error"])
+
+
+class BatchDownloader:
+    """ Downloads urls with 'threads' threads, highest priority first,
+        but never more than 'per_host' from the same host at a time.
+        Adding a url that's already in the batch does nothing.
+
+        download: function(url, path, **kwargs) (default: httptools.download_url).
+        kwargs: default keyword arguments of download (each add can override them).
+    """
+
+    def __init__(self, threads=8, per_host=2, download=None, session=None, **kwargs):
+        self.threads = threads
+        self.per_host = per_host
+        self.download = download or httptools.download_url
+        if download is None:
+            if session is None:
+                pool_size = per_host * kwargs.get("connections", 5)
+                session = httptools.get_session() if pool_size <= httptools.POOL_SIZE else \
+                    httptools.create_session(pool_size=pool_size)
+            kwargs.setdefault("with_progress", False)
+        if session is not None:
+            kwargs["session"] = session
+        self.kwargs = kwargs
+
+        self.pending = {}  # host -> heap of (-priority, seq, url, path, kwargs)
+        self.active = collections.Counter()  # host -> downloads in progress
+        self.urls = set()
+        self.counter = itertools.count()
+        self.unreported = 0
+        self.finished = queue.Queue()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, url, path=".", priority=0, **kwargs):
+        """ Queue url for download into the directory path. Returns False if url was already added. """
+        with self.cond:
+            if self.closed:
+                raise RuntimeError("BatchDownloader is closed")
+            if url in self.urls:
+                return False
+            self.urls.add(url)
+            options = dict(self.kwargs, **kwargs)
+            heapq.heappush(self.pending.setdefault(get_host(url), []),
+                           (-priority, next(self.counter), url, path, options))
+            self.unreported += 1
+            if len(self.workers) < self.threads:
+                worker = threading.Thread(target=self._work, daemon=True)
+                worker.start()
+                self.workers.append(worker)
+            self.cond.notify()
+        return True
+
+    def results(self):
+        """ Yields a DownloadResult for each url as soon as it finishes (or fails),
+            until every added url has been reported.
+        """
+        while True:
+            with self.cond:
+                if self.unreported == 0:
+                    return
+            result = self.finished.get()
+            if result is None:
+                continue  # Woken up by close().
+            with self.cond:
+                self.unreported -= 1
+            yield result
+
+    def close(self):
+        """ Cancel the queued urls and wait for the running downloads to finish. """
+        with self.cond:
+            self.closed = True
+            self.unreported -= sum(len(heap) for heap in self.pending.values())
+            self.pending.clear()
+            self.cond.notify_all()
+        self.finished.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def _next(self):
+        """ The highest priority item of the hosts that are below the limit (blocks until there is one). """
+        with self.cond:
+            while not self.closed:
+                best = None
+                for host, heap in self.pending.items():
+                    if self.active[host] < self.per_host and (best is None or heap[0] < self.pending[best][0]):
+                        best = host
+                if best is not None:
+                    heap = self.pending[best]
+                    item = heapq.heappop(heap)
+                    if not heap:
+                        del self.pending[best]
+                    self.active[best] += 1
+                    return best, item
+                self.cond.wait()
+            return None
+
+    def _work(self):
+        while True:
+            task = self._next()
+            if task is None:
+                return
+            host, (_, _, url, path, kwargs) = task
+            try:
+                result = DownloadResult(url, path, self.download(url, path, **kwargs), None)
+            except Exception as e:
+                logging.warning('Downloading {url} failed: {e}'.format(url=url, e=e))
+                result = DownloadResult(url, path, None, e)
+            with self.cond:
+                self.active[host] -= 1
+                if not self.active[host]:
+                    del self.active[host]
+                self.cond.notify_all()
+            self.finished.put(result)
+
+
+def download_batch(urls, path=".", threads=8, per_host=2, **kwargs):
+    """ Download urls into the directory path and yield a DownloadResult for each as it finishes.
+        See BatchDownloader.
+    """
+    with BatchDownloader(threads=threads, per_host=per_host, **kwargs) as batch:
+        for url in urls:
+            batch.add(url, path)
+        yield from batch.results()
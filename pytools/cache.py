@@ -1,22 +1,74 @@
+import asyncio
+import collections
 import collections.abc
+import concurrent.futures
+import inspect
+import math
+import pickle
+import sqlite3
+import threading
+import time
+from array import array
+from functools import wraps
 
 
 class LRUcache(collections.abc.MutableMapping):
     
     class Entry:
-        __slots__ = ["key", "val", "prev", "next"]
-        def __init__(self, key, val, prev=None, next=None):
+        __slots__ = ["key", "val", "prev", "next", "weight", "expires"]
+        def __init__(self, key, val, prev=None, next=None, weight=1, expires=None):
             self.key = key
             self.val = val
             self.prev = prev
             self.next = next
+            self.weight = weight
+            self.expires = expires
 
-    def __init__(self, maxsize=8192):
+    def __init__(self, maxsize=8192, maxweight=None, getweight=None, ttl=None, timer=time.monotonic,
+                 on_evict=None, window=None, sample_every=None):
+        """ maxsize: the maximum number of entries.
+
+            maxweight: the maximum total weight of all entries (None means unbounded).
+
+            getweight: function that returns the weight of a value (e.g. len or sys.getsizeof).
+                If None, every entry weighs 1.
+
+            ttl: the default time-to-live of entries in seconds (None means forever).
+                Expired entries are skipped lazily on lookup and removed in batches
+                from the head of the list (see expire()). They may still show up
+                when iterating over the cache.
+
+            timer: the clock used for ttl.
+
+            on_evict: callback(key, value), called when an entry is evicted to make room.
+
+            window: if set, the hit ratio of the last 'window' lookups is tracked.
+
+            sample_every: if set, the latency of every n-th get and set is sampled.
+
+            See snapshot() for the statistics.
+        """
         self.data = dict()
         self.maxsize = maxsize
+        self.maxweight = maxweight
+        self.getweight = getweight
+        self.ttl = ttl
+        self.timer = timer
+        self.on_evict = on_evict
 
-        self.hits = 0
-        self.misses = 0
+        self.weight = 0  # Total weight of all entries.
+        self.hits = 0    # Successful lookups.
+        self.misses = 0  # Failed lookups.
+        self.inserts = 0
+        self.overwrites = 0
+        self.evictions = 0
+        self.expirations = 0
+
+        self.window = None if not window else collections.deque(maxlen=window)
+        self.window_hits = 0
+        self.sample_every = sample_every
+        self.latency = {"get": collections.deque(maxlen=1024), "set": collections.deque(maxlen=1024)}
+        self._countdown = sample_every or 0
 
         # The LRU mechanism is implemented using a linked list.
         # The least recently used item is always adjacent to the head.
@@ -26,27 +78,85 @@ class LRUcache(collections.abc.MutableMapping):
         self.head.next = self.tail
     
     def __getitem__(self, key):
-        entry = self.data[key]
+        if self.sample_every:
+            self._countdown -= 1
+            if self._countdown <= 0:
+                return self._sample("get", self.__getitem__, key)
+        entry = self.data.get(key)
+        if entry is None or (entry.expires is not None and entry.expires <= self.timer()):
+            if entry is not None:
+                self._expire(entry)
+            self.misses += 1
+            if self.window is not None:
+                self._record(0)
+            raise KeyError(key)
         self.hits += 1
+        if self.window is not None:
+            self._record(1)
         return self._get(entry).val
 
     def __setitem__(self, key, value):
-        head, tail = self.head, self.tail
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        self._remove(self.data[key])
+
+    def set(self, key, value, ttl=None):
+        """ cache[key] = value with an optional per-entry ttl, which overrides the cache's ttl. """
+        if self.sample_every:
+            self._countdown -= 1
+            if self._countdown <= 0:
+                return self._sample("set", self.set, key, value, ttl)
+        if ttl is None:
+            ttl = self.ttl
+        expires = None
+        if ttl is not None:
+            now = self.timer()
+            expires = now + ttl
+            self.expire(now)
+
+        weight = self.getweight(value) if self.getweight else 1
+        maxweight = self.maxweight
+        head = self.head
         entry = self.data.get(key, head)
+        if maxweight is not None and weight > maxweight:
+            if entry is not head:
+                self._remove(entry)
+            raise ValueError("value too large ({} > maxweight)".format(weight))
+
         if entry is head:
-            if len(self.data) >= self.maxsize:
-                old = self._pop(head.next)
-                del self.data[old.key]
+            while self.data and (len(self.data) >= self.maxsize or 
+                    (maxweight is not None and self.weight + weight > maxweight)):
+                self._evict(head.next)
             entry = self._push_back(key, value)
             self.data[key] = entry
-            self.misses += 1
+            self.inserts += 1
         else:
-            self.hits += 1
+            self.overwrites += 1
+            self.weight -= entry.weight
             self._get(entry).val = value
+            # The new value may be heavier than the old one.
+            while maxweight is not None and self.weight + weight > maxweight:
+                self._evict(head.next)
+        entry.weight = weight
+        entry.expires = expires
+        self.weight += weight
 
-    def __delitem__(self, key):
-        self._pop(self.data[key])
-        del self.data[key]
+    def expire(self, now=None):
+        """ Remove the expired entries adjacent to the head of the list. 
+            Stops at the first entry that hasn't expired, so only a batch 
+            of the oldest entries is visited. Returns the number of removed entries.
+        """
+        if now is None:
+            now = self.timer()
+        count = 0
+        entry = self.head.next
+        while entry is not self.tail and entry.expires is not None and entry.expires <= now:
+            nxt = entry.next
+            self._expire(entry)
+            entry = nxt
+            count += 1
+        return count
 
     def __iter__(self):
         return iter(self.data)
@@ -60,6 +170,57 @@ class LRUcache(collections.abc.MutableMapping):
         s += "}>"
         return s
 
+    @property
+    def lookups(self):
+        return self.hits + self.misses
+
+    def histogram(self):
+        """ Number of entries by weight, in power of two buckets: {exclusive upper bound: count}. """
+        hist = collections.Counter(1 << max(0, math.ceil(entry.weight)).bit_length() 
+                                   for entry in self.data.values())
+        return dict(sorted(hist.items()))
+
+    def snapshot(self, histogram=True):
+        """ Statistics as a dict. 
+            The histogram walks all entries, so it can be skipped. 
+        """
+        stats = {
+            "entries": len(self.data),
+            "weight": self.weight,
+            "maxsize": self.maxsize,
+            "maxweight": self.maxweight,
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "misses": self.misses,
+            "inserts": self.inserts,
+            "overwrites": self.overwrites,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_ratio": self.hits / self.lookups if self.lookups else 0,
+        }
+        if self.window is not None:
+            stats["window_hit_ratio"] = self.window_hits / len(self.window) if self.window else 0
+        if histogram:
+            stats["histogram"] = self.histogram()
+        if self.sample_every:
+            stats["latency"] = {op: latency_stats(samples) for op, samples in self.latency.items()}
+        return stats
+
+    def _record(self, hit):
+        window = self.window
+        if len(window) == window.maxlen:
+            self.window_hits -= window[0]
+        window.append(hit)
+        self.window_hits += hit
+
+    def _sample(self, op, func, *args):
+        self._countdown = self.sample_every + 1  # func will decrement it again.
+        t = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self.latency[op].append(time.perf_counter() - t)
+
     def _get(self, entry):
         self._pop(entry)
         return self._push_back(entry.key, entry.val, entry)
@@ -79,4 +240,876 @@ class LRUcache(collections.abc.MutableMapping):
         left, right = entry.prev, entry.next
         left.next = right
         right.prev = left
-        return entry
\ No newline at end of file
+        return entry
+
+    def _remove(self, entry):
+        self._pop(entry)
+        del self.data[entry.key]
+        self.weight -= entry.weight
+
+    def _evict(self, entry):
+        self._remove(entry)
+        self.evictions += 1
+        if self.on_evict is not None:
+            self.on_evict(entry.key, entry.val)
+
+    def _expire(self, entry):
+        self._remove(entry)
+        self.expirations += 1
+
+
+def latency_stats(samples):
+    """ Summary of latency samples in seconds. """
+    samples = sorted(samples)
+    if not samples:
+        return {"samples": 0}
+    return {
+        "samples": len(samples),
+        "mean": sum(samples) / len(samples),
+        "p50": samples[len(samples) // 2],
+        "p99": samples[min(len(samples) - 1, int(len(samples) * 0.99))],
+        "max": samples[-1]
+    }
+
+
+class DiskCache(collections.abc.MutableMapping):
+    """ Persistent cache stored in a sqlite database.
+
+        Keys and values are pickled, so keys must pickle deterministically 
+        (str, int, tuples of those, ...). When the total size of the pickled
+        values exceeds 'maxbytes', the least recently used entries are deleted.
+        The file is compacted (VACUUM) after 'compact_ratio' * maxbytes have been freed.
+        Safe to use from multiple threads.
+    """
+
+    def __init__(self, path, maxbytes=2**30, compact_ratio=0.5):
+        self.path = path
+        self.maxbytes = maxbytes
+        self.compact_ratio = compact_ratio
+        self.lock = threading.Lock()
+
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS entries ("
+                        "key BLOB PRIMARY KEY, value BLOB NOT NULL, "
+                        "size INTEGER NOT NULL, atime INTEGER NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_atime ON entries (atime)")
+        self.size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        # Access order is kept as a counter, which is more robust than timestamps.
+        self.clock = self.db.execute("SELECT COALESCE(MAX(atime), 0) FROM entries").fetchone()[0]
+        self.freed = 0  # Bytes deleted since the last compaction.
+
+    def __getitem__(self, key):
+        k = pickle.dumps(key)
+        with self.lock:
+            row = self.db.execute("SELECT value FROM entries WHERE key = ?", (k,)).fetchone()
+            if row is None:
+                raise KeyError(key)
+            self.clock += 1
+            self.db.execute("UPDATE entries SET atime = ? WHERE key = ?", (self.clock, k))
+        return pickle.loads(row[0])
+
+    def __setitem__(self, key, value):
+        k = pickle.dumps(key)
+        v = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            self._delete(k)
+            self.clock += 1
+            self.db.execute("INSERT INTO entries VALUES (?, ?, ?, ?)", (k, v, len(v), self.clock))
+            self.size += len(v)
+            if self.size > self.maxbytes:
+                self._trim()
+
+    def __delitem__(self, key):
+        with self.lock:
+            if not self._delete(pickle.dumps(key)):
+                raise KeyError(key)
+
+    def __iter__(self):
+        with self.lock:
+            keys = self.db.execute("SELECT key FROM entries").fetchall()
+        for (k,) in keys:
+            yield pickle.loads(k)
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def __contains__(self, key):
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM entries WHERE key = ?", (pickle.dumps(key),)).fetchone() is not None
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def compact(self):
+        with self.lock:
+            self._compact()
+
+    def _delete(self, k):
+        row = self.db.execute("SELECT size FROM entries WHERE key = ?", (k,)).fetchone()
+        if row is None:
+            return False
+        self.db.execute("DELETE FROM entries WHERE key = ?", (k,))
+        self.size -= row[0]
+        self.freed += row[0]
+        return True
+
+    def _trim(self):
+        """ Delete the least recently used entries until the size fits maxbytes. """
+        rows = self.db.execute("SELECT key, size FROM entries ORDER BY atime")
+        victims = []
+        size = self.size
+        for k, entry_size in rows:
+            if size <= self.maxbytes:
+                break
+            victims.append((k,))
+            size -= entry_size
+        rows.close()
+        self.db.executemany("DELETE FROM entries WHERE key = ?", victims)
+        self.freed += self.size - size
+        self.size = size
+        if self.freed > self.compact_ratio * self.maxbytes:
+            self._compact()
+
+    def _compact(self):
+        self.db.execute("VACUUM")
+        self.freed = 0
+
+
+class TieredCache(LRUcache):
+    """ LRUcache that spills evicted entries to a DiskCache and
+        promotes them back into memory on a hit.
+
+        Entries stay on disk across restarts (call close() or flush() to 
+        also keep the in-memory entries). The ttl only applies to the memory tier.
+    """
+
+    def __init__(self, path, maxsize=8192, disk_maxbytes=2**30, **kwargs):
+        super().__init__(maxsize=maxsize, **kwargs)
+        self.disk = DiskCache(path, maxbytes=disk_maxbytes)
+        self.disk_hits = 0
+
+    def __getitem__(self, key):
+        try:
+            return super().__getitem__(key)
+        except KeyError:
+            pass
+        value = self.disk[key]
+        self.disk_hits += 1
+        self[key] = value
+        return value
+
+    def set(self, key, value, ttl=None):
+        if key not in self.data:
+            # Keep the tiers disjoint.
+            self.disk.pop(key, None)
+        super().set(key, value, ttl=ttl)
+
+    def __delitem__(self, key):
+        try:
+            super().__delitem__(key)
+        except KeyError:
+            del self.disk[key]
+
+    def __iter__(self):
+        yield from list(self.data)
+        yield from self.disk  # The tiers are disjoint.
+
+    def __len__(self):
+        return len(self.data) + len(self.disk)
+
+    def flush(self):
+        """ Move all in-memory entries to disk (they don't count as evictions). """
+        for entry in list(self.data.values()):
+            self._remove(entry)
+            self._spill(entry)
+
+    def close(self):
+        self.flush()
+        self.disk.close()
+
+    def _evict(self, entry):
+        super()._evict(entry)
+        self._spill(entry)
+
+    def _spill(self, entry):
+        if entry.expires is None or entry.expires > self.timer():
+            self.disk[entry.key] = entry.val
+
+
+class ShardedLRUcache(collections.abc.MutableMapping):
+    """ Thread-safe LRUcache. 
+
+        The keyspace is split into 'shards' independent LRUcaches, 
+        each guarded by its own lock and holding its share of 'maxsize'.
+        Threads that access keys in different shards don't contend.
+        NOTE: the eviction order is LRU per shard, not global.
+    """
+
+    def __init__(self, maxsize=8192, shards=16, maxweight=None, **kwargs):
+        """ The remaining kwargs are passed to each LRUcache. """
+        shards = max(1, min(shards, maxsize))
+        size, extra = divmod(maxsize, shards)
+        self.maxsize = maxsize
+        self.maxweight = maxweight
+        shard_weight = None if maxweight is None else maxweight / shards
+        self.shards = [LRUcache(maxsize=size + (i < extra), maxweight=shard_weight, **kwargs) 
+                       for i in range(shards)]
+        self.locks = [threading.Lock() for _ in range(shards)]
+
+    @property
+    def hits(self):
+        return sum(shard.hits for shard in self.shards)
+
+    @property
+    def misses(self):
+        return sum(shard.misses for shard in self.shards)
+
+    def snapshot(self, histogram=True):
+        """ LRUcache.snapshot() combined over all shards. """
+        snapshots = []
+        windows = []
+        latency = {"get": [], "set": []}
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                snapshots.append(shard.snapshot(histogram=histogram))
+                if shard.window is not None:
+                    windows.append((shard.window_hits, len(shard.window)))
+                for op, samples in shard.latency.items():
+                    latency[op].extend(samples)
+
+        stats = {"shards": len(self.shards), "maxsize": self.maxsize, "maxweight": self.maxweight}
+        for key in ("entries", "weight", "lookups", "hits", "misses", "inserts", 
+                    "overwrites", "evictions", "expirations"):
+            stats[key] = sum(snapshot[key] for snapshot in snapshots)
+        stats["hit_ratio"] = stats["hits"] / stats["lookups"] if stats["lookups"] else 0
+        if windows:
+            size = sum(n for _, n in windows)
+            stats["window_hit_ratio"] = sum(hits for hits, _ in windows) / size if size else 0
+        if histogram:
+            hist = collections.Counter()
+            for snapshot in snapshots:
+                hist.update(snapshot["histogram"])
+            stats["histogram"] = dict(sorted(hist.items()))
+        if any(shard.sample_every for shard in self.shards):
+            stats["latency"] = {op: latency_stats(samples) for op, samples in latency.items()}
+        return stats
+
+    def __getitem__(self, key):
+        i = hash(key) % len(self.shards)
+        with self.locks[i]:
+            return self.shards[i][key]
+
+    def __setitem__(self, key, value):
+        i = hash(key) % len(self.shards)
+        with self.locks[i]:
+            self.shards[i][key] = value
+
+    def __delitem__(self, key):
+        i = hash(key) % len(self.shards)
+        with self.locks[i]:
+            del self.shards[i][key]
+
+    def __iter__(self):
+        # Iterate over a snapshot, so that other threads may keep modifying the cache.
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                keys = list(shard.data)
+            yield from keys
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    @property
+    def weight(self):
+        return sum(shard.weight for shard in self.shards)
+
+    def set(self, key, value, ttl=None):
+        i = hash(key) % len(self.shards)
+        with self.locks[i]:
+            self.shards[i].set(key, value, ttl=ttl)
+
+    def expire(self):
+        count = 0
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                count += shard.expire()
+        return count
+
+    def __str__(self):
+        items = []
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                items.extend((k, v.val) for k, v in shard.data.items())
+        s = "<{"
+        s += ", ".join(("{}: {}".format(k, v) for k, v in items))
+        s += "}>"
+        return s
+
+    # The MutableMapping mixins are not atomic, so override the common ones.
+
+    def get(self, key, default=None):
+        i = hash(key) % len(self.shards)
+        with self.locks[i]:
+            return self.shards[i].get(key, default)
+
+    def pop(self, key, *default):
+        i = hash(key) % len(self.shards)
+        with self.locks[i]:
+            return self.shards[i].pop(key, *default)
+
+    def setdefault(self, key, default=None):
+        i = hash(key) % len(self.shards)
+        with self.locks[i]:
+            return self.shards[i].setdefault(key, default)
+
+    def clear(self):
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                shard.clear()
+
+
+class CompactLRUcache(collections.abc.MutableMapping):
+    """ LRUcache without per-entry objects.
+
+        The linked list is stored as integer indices in preallocated arrays
+        and freed slots are reused through a free list. The eviction order is exactly
+        the same as LRUcache's (weights and ttl aren't supported).
+
+        The saving is modest: each entry still costs a dict item, an int object
+        for its slot index (above 256) and two list slots, so it only takes about 10% 
+        less memory than LRUcache. Sets and evictions are faster, but lookups are slower 
+        (up to about half as fast). See tests/bench_cache.py.
+    """
+
+    def __init__(self, maxsize=8192):
+        self.data = dict()  # key -> slot index
+        self.maxsize = maxsize
+
+        self.hits = 0
+        self.misses = 0
+        self.inserts = 0
+        self.overwrites = 0
+        self.evictions = 0
+
+        # Slot 0 is the sentinel of the circular list: 
+        # next[0] is the oldest slot and prev[0] is the newest.
+        # Free slots are chained through 'next', starting at 'free'.
+        capacity = max(1, maxsize) + 1
+        self.prev = array('l', bytes(array('l').itemsize * capacity))
+        self.next = array('l', range(1, capacity + 1))
+        self.next[0] = 0
+        self.next[-1] = 0
+        self.free = 1 if capacity > 1 else 0
+        self.keyslots = [None] * capacity
+        self.valslots = [None] * capacity
+
+    def __getitem__(self, key):
+        i = self.data.get(key)
+        if i is None:
+            self.misses += 1
+            raise KeyError(key)
+        self.hits += 1
+        prev = self.prev
+        newest = prev[0]
+        if newest != i:
+            # Inlined _move_to_end, since this is the hot path.
+            next = self.next
+            left, right = prev[i], next[i]
+            next[left] = right
+            prev[right] = left
+            next[newest] = i
+            prev[i] = newest
+            next[i] = 0
+            prev[0] = i
+        return self.valslots[i]
+
+    def __setitem__(self, key, value):
+        i = self.data.get(key)
+        if i is None:
+            if len(self.data) >= self.maxsize and self.data:
+                del self[self.keyslots[self.next[0]]]
+                self.evictions += 1
+            i = self.free
+            self.free = self.next[i]
+            self.keyslots[i] = key
+            self.valslots[i] = value
+            self._link_end(i)
+            self.data[key] = i
+            self.inserts += 1
+        else:
+            self.overwrites += 1
+            self.valslots[i] = value
+            self._move_to_end(i)
+
+    def __delitem__(self, key):
+        i = self.data.pop(key)
+        self._unlink(i)
+        self.keyslots[i] = self.valslots[i] = None
+        self.next[i] = self.free
+        self.free = i
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __str__(self):
+        s = "<{"
+        s += ", ".join(("{}: {}".format(k, self.valslots[i]) for k, i in self.data.items()))
+        s += "}>"
+        return s
+
+    def _unlink(self, i):
+        prev, next = self.prev, self.next
+        left, right = prev[i], next[i]
+        next[left] = right
+        prev[right] = left
+
+    def _link_end(self, i):
+        prev, next = self.prev, self.next
+        newest = prev[0]
+        next[newest] = i
+        prev[i] = newest
+        next[i] = 0
+        prev[0] = i
+
+    def _move_to_end(self, i):
+        if self.prev[0] != i:
+            self._unlink(i)
+            self._link_end(i)
+
+
+class CountMinSketch:
+    """ Compact frequency estimator used by TinyLFUcache. 
+
+        Every key increments one counter in each of the 'depth' rows. The estimate
+        is the minimum of those counters, so it can only overestimate.
+        Counters saturate at 15 and are halved every 'sample_size' increments, 
+        so that old popularity fades away (aging).
+    """
+
+    MAX_COUNT = 15
+
+    def __init__(self, width, depth=4):
+        self.width = max(16, width)
+        self.depth = depth
+        self.table = array('B', bytes(self.width * depth))
+        self.sample_size = 10 * self.width
+        self.additions = 0
+
+    def _indices(self, key):
+        h = hash(key)
+        h2 = (h >> 17) | 1
+        width = self.width
+        return [row * width + (h + row * h2) % width for row in range(self.depth)]
+
+    def increment(self, key):
+        table = self.table
+        for i in self._indices(key):
+            if table[i] < self.MAX_COUNT:
+                table[i] += 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self.reset()
+
+    def estimate(self, key):
+        table = self.table
+        return min(table[i] for i in self._indices(key))
+
+    def reset(self):
+        self.table = array('B', (count >> 1 for count in self.table))
+        self.additions //= 2
+
+
+class TinyLFUcache(collections.abc.MutableMapping):
+    """ Window TinyLFU (W-TinyLFU) cache.
+
+        New entries go into a small LRU window. Entries evicted from the window 
+        are only admitted into the main (segmented LRU) space if they are
+        estimated to be more frequently used than the main space's victim.
+        A one-off scan can therefore only flush the window, not the hot entries.
+    """
+
+    def __init__(self, maxsize=8192, window=0.01, protected=0.8):
+        """ window: the share of maxsize used by the admission window.
+            protected: the share of the main space used by the protected segment.
+        """
+        self.maxsize = maxsize
+        self.window_size = max(1, int(maxsize * window))
+        self.main_size = max(0, maxsize - self.window_size)
+        self.protected_size = int(self.main_size * protected)
+
+        self.hits = 0
+        self.misses = 0
+        self.inserts = 0
+        self.overwrites = 0
+
+        self.sketch = CountMinSketch(maxsize)
+        # All segments are LRU ordered: the oldest item is first.
+        self.window = collections.OrderedDict()
+        self.probation = collections.OrderedDict()
+        self.protected = collections.OrderedDict()
+
+    def __getitem__(self, key):
+        self.sketch.increment(key)
+        if key in self.window:
+            self.window.move_to_end(key)
+            value = self.window[key]
+        elif key in self.protected:
+            self.protected.move_to_end(key)
+            value = self.protected[key]
+        elif key in self.probation:
+            value = self.probation.pop(key)
+            self._promote(key, value)
+        else:
+            self.misses += 1
+            raise KeyError(key)
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        self.sketch.increment(key)
+        for segment in (self.window, self.protected):
+            if key in segment:
+                segment[key] = value
+                segment.move_to_end(key)
+                self.overwrites += 1
+                return
+        if key in self.probation:
+            del self.probation[key]
+            self._promote(key, value)
+            self.overwrites += 1
+            return
+
+        self.inserts += 1
+        self.window[key] = value
+        if len(self.window) > self.window_size:
+            self._admit(*self.window.popitem(last=False))
+
+    def __delitem__(self, key):
+        for segment in (self.window, self.probation, self.protected):
+            if key in segment:
+                del segment[key]
+                return
+        raise KeyError(key)
+
+    def __iter__(self):
+        for segment in (self.window, self.probation, self.protected):
+            yield from segment
+
+    def __len__(self):
+        return len(self.window) + len(self.probation) + len(self.protected)
+
+    def __str__(self):
+        s = "<{"
+        s += ", ".join(("{}: {}".format(k, v) for segment in (self.window, self.probation, self.protected) 
+                                                for k, v in segment.items()))
+        s += "}>"
+        return s
+
+    def _promote(self, key, value):
+        self.protected[key] = value
+        if len(self.protected) > self.protected_size:
+            # Demote the oldest protected entry, giving it another chance.
+            old_key, old_value = self.protected.popitem(last=False)
+            self.probation[old_key] = old_value
+
+    def _admit(self, key, value):
+        if len(self.probation) + len(self.protected) < self.main_size:
+            self.probation[key] = value
+            return
+        victims = self.probation or self.protected
+        if not victims:
+            return
+        victim = next(iter(victims))
+        if self.sketch.estimate(key) > self.sketch.estimate(victim):
+            del victims[victim]
+            self.probation[key] = value
+
+
+class TwoQcache(collections.abc.MutableMapping):
+    """ 2Q cache.
+
+        New entries go into a FIFO queue (A1in). Keys evicted from it are 
+        remembered without their values (A1out). Only a key that is set again
+        while remembered gets into the main LRU (Am), so entries that are 
+        seen only once (a scan) never displace the main entries.
+    """
+
+    def __init__(self, maxsize=8192, kin=0.25, kout=0.5):
+        """ kin: the share of maxsize used by A1in.
+            kout: the number of remembered keys as a share of maxsize.
+        """
+        self.maxsize = maxsize
+        self.in_size = max(1, int(maxsize * kin))
+        self.out_size = max(1, int(maxsize * kout))
+
+        self.hits = 0
+        self.misses = 0
+        self.inserts = 0
+        self.overwrites = 0
+
+        self.a1in = collections.OrderedDict()
+        self.a1out = collections.OrderedDict()  # key -> None
+        self.am = collections.OrderedDict()
+
+    def __getitem__(self, key):
+        if key in self.am:
+            self.am.move_to_end(key)
+            value = self.am[key]
+        elif key in self.a1in:
+            value = self.a1in[key]  # FIFO, so don't reorder.
+        else:
+            self.misses += 1
+            raise KeyError(key)
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self.am:
+            self.am[key] = value
+            self.am.move_to_end(key)
+            self.overwrites += 1
+            return
+        if key in self.a1in:
+            self.a1in[key] = value
+            self.overwrites += 1
+            return
+
+        self.inserts += 1
+        if len(self.a1in) + len(self.am) >= self.maxsize:
+            self._reclaim()
+        if key in self.a1out:
+            del self.a1out[key]
+            self.am[key] = value
+        else:
+            self.a1in[key] = value
+
+    def __delitem__(self, key):
+        if key in self.am:
+            del self.am[key]
+        else:
+            del self.a1in[key]
+
+    def __iter__(self):
+        yield from self.a1in
+        yield from self.am
+
+    def __len__(self):
+        return len(self.a1in) + len(self.am)
+
+    def __str__(self):
+        s = "<{"
+        s += ", ".join(("{}: {}".format(k, v) for segment in (self.a1in, self.am) for k, v in segment.items()))
+        s += "}>"
+        return s
+
+    def _reclaim(self):
+        if len(self.a1in) > self.in_size or not self.am:
+            key, _ = self.a1in.popitem(last=False)
+            self.a1out[key] = None
+            if len(self.a1out) > self.out_size:
+                self.a1out.popitem(last=False)
+        else:
+            self.am.popitem(last=False)
+
+
+POLICIES = {
+    "lru": LRUcache,
+    "compactlru": CompactLRUcache,
+    "tinylfu": TinyLFUcache,
+    "2q": TwoQcache
+}
+
+
+def make_cache(policy="lru", maxsize=8192, **kwargs):
+    """ Create a cache with the given eviction policy (see POLICIES). """
+    try:
+        cls = POLICIES[policy]
+    except KeyError:
+        raise ValueError("unknown cache policy: {}".format(policy))
+    return cls(maxsize=maxsize, **kwargs)
+
+
+def load_trace(path):
+    """ Read a key trace: one key per line. """
+    with open(path) as f:
+        return [line.rstrip("\n") for line in f if line.strip()]
+
+
+def replay_trace(trace, maxsize, policies=None):
+    """ Replay a sequence of keys on a cache of each policy.
+        A missing key is inserted after its lookup.
+
+        Returns a dict of {policy: hit ratio}.
+    """
+    trace = list(trace)
+    ratios = {}
+    for policy in (policies or POLICIES):
+        c = make_cache(policy, maxsize=maxsize)
+        hits = 0
+        for key in trace:
+            try:
+                c[key]
+                hits += 1
+            except KeyError:
+                c[key] = True
+        ratios[policy] = hits / len(trace) if trace else 0
+    return ratios
+
+
+def make_key(*args, **kwargs):
+    """ The default memoize key: a hashable tuple of the arguments. """
+    if not kwargs:
+        return args
+    return args + (make_key,) + tuple(sorted(kwargs.items()))
+
+
+def memoize(maxsize=128, policy="lru", key=make_key, cache_exceptions=None, **kwargs):
+    """ Memoization decorator for functions and coroutine functions.
+
+        Concurrent calls that miss on the same key wait for the single 
+        in-flight call to finish instead of each calling the function (single-flight).
+
+        maxsize, policy, kwargs: passed to make_cache (e.g. ttl=60).
+        key: function(*args, **kwargs) -> hashable cache key.
+        cache_exceptions: if set, exceptions are cached for that many seconds (at most maxsize of them).
+
+        Usage:
+            @memoize(maxsize=1024, ttl=60)
+            def get_page(url):
+                ...
+
+            get_page.cache  # The underlying cache.
+            get_page.cache_clear()
+            get_page.cache_invalidate(url)
+    """
+    def decorator(func):
+        cache = make_cache(policy, maxsize=maxsize, **kwargs)
+        lock = threading.Lock()
+        calls = {}   # key -> future of the in-flight call
+        errors = LRUcache(maxsize=maxsize, ttl=cache_exceptions)  # key -> exception
+
+        def lookup(k):
+            """ Returns (hit, value). Must hold the lock. """
+            try:
+                return True, cache[k]
+            except KeyError:
+                pass
+            try:
+                error = errors[k]
+            except KeyError:
+                return False, None
+            raise error
+
+        def store(k, result=None, exc=None):
+            """ Must hold the lock. """
+            del calls[k]
+            if exc is None:
+                try:
+                    cache[k] = result
+                except ValueError:  # Too heavy.
+                    pass
+            elif cache_exceptions and isinstance(exc, Exception):
+                errors[k] = exc
+
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def wrapper(*args, **kw):
+                k = key(*args, **kw)
+                while True:
+                    with lock:
+                        hit, value = lookup(k)
+                        if hit:
+                            return value
+                        future = calls.get(k)
+                        if future is None:
+                            future = calls[k] = asyncio.get_running_loop().create_future()
+                            break
+                    try:
+                        return await asyncio.shield(future)
+                    except asyncio.CancelledError:
+                        if not future.cancelled():  # This call was cancelled.
+                            raise
+                    # The leader was cancelled, so one of the waiting calls takes over.
+
+                try:
+                    result = await func(*args, **kw)
+                except BaseException as e:
+                    with lock:
+                        store(k, exc=e)
+                    if isinstance(e, asyncio.CancelledError):
+                        future.cancel()
+                    else:
+                        future.set_exception(e)
+                        future.exception()  # Don't warn if nobody was waiting.
+                    raise
+                with lock:
+                    store(k, result)
+                future.set_result(result)
+                return result
+        else:
+            @wraps(func)
+            def wrapper(*args, **kw):
+                k = key(*args, **kw)
+                with lock:
+                    hit, value = lookup(k)
+                    if hit:
+                        return value
+                    future = calls.get(k)
+                    if future is None:
+                        future = calls[k] = concurrent.futures.Future()
+                        leader = True
+                    else:
+                        leader = False
+                if not leader:
+                    return future.result()
+
+                try:
+                    result = func(*args, **kw)
+                except BaseException as e:
+                    with lock:
+                        store(k, exc=e)
+                    future.set_exception(e)
+                    raise
+                with lock:
+                    store(k, result)
+                future.set_result(result)
+                return result
+
+        def cache_clear():
+            with lock:
+                cache.clear()
+                errors.clear()
+
+        def cache_invalidate(*args, **kw):
+            """ Forget the result of the call with these arguments. """
+            k = key(*args, **kw)
+            with lock:
+                cache.pop(k, None)
+                errors.pop(k, None)
+
+        wrapper.cache = cache
+        wrapper.cache_clear = cache_clear
+        wrapper.cache_invalidate = cache_invalidate
+        return wrapper
+    return decorator
+
+
+# Run this module as a script to compare the policies on a recorded trace.
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("trace", type=str, help="File with one key per line.")
+    parser.add_argument("maxsize", type=int, nargs="+")
+    args = parser.parse_args()
+
+    trace = load_trace(args.trace)
+    for maxsize in args.maxsize:
+        for policy, ratio in replay_trace(trace, maxsize).items():
+            print("{:>10} {:>8} {:>7.2f} %".format(maxsize, policy, ratio * 100))
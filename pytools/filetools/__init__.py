@@ -1,4 +1,5 @@
 # __all__ = ["fileutils", "tree"]
 
 from .fileutils import *
-from .tree import tree
\ No newline at end of file
+from .tree import tree
+from .hashing import hash_file, hash_files, hash_dir, ChecksumIndex
\ No newline at end of file
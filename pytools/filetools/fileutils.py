@@ -1,15 +1,17 @@
+import errno
 import math
 import time
 import os
 import shutil
 import sys
+import uuid
 import logging
-import hashlib
 import glob
 from datetime import datetime as dtime
 from time import strftime, gmtime
 from os.path import join, getsize, getmtime
 from contextlib import contextmanager
+from .hashing import hash_file
 try:
     from os import walk
 except ImportError:
@@ -154,21 +156,139 @@ def create_empty_file(path, size=0):
     return path
 
 
+def preallocate_file(path, size):
+    """ Create a file of the given size and reserve its disk space, if the OS supports it.
+        Otherwise the file is sparse (like create_empty_file).
+        An existing file is replaced rather than truncated, so its other hard links keep their data.
+    """
+    remove_file(path)
+    with open(path, 'wb') as f:
+        if size > 0 and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(f.fileno(), 0, size)
+                return path
+            except OSError:  # E.g. the file system doesn't support it.
+                pass
+        f.truncate(size)
+    return path
+
+
+FICLONE = 0x40049409  # Linux ioctl that makes dst a copy-on-write clone of src (btrfs, xfs, ...).
+
+def reflink_file(src, dst):
+    """ Create dst as a copy-on-write clone of src. Raises OSError if the file system can't. """
+    import fcntl  # Not on Windows.
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        try:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+        except OSError:
+            dst_file.close()
+            remove_file(dst)
+            raise
+    return dst
+
+
+def link_file(src, dst, modes=("reflink", "hard", "copy")):
+    """ Make dst have the contents of src without copying them, if possible.
+        The modes are tried in order:
+            reflink: a copy-on-write clone (changes to dst don't affect src).
+            hard: a hard link (dst is the same file as src).
+            copy: a plain copy.
+        An existing dst is replaced. Returns the mode that worked.
+    """
+    tmp = "{}.link-{}".format(dst, uuid.uuid4().hex)  # Unique, so concurrent links to dst don't collide.
+    for mode in modes:
+        try:
+            if mode == "reflink":
+                reflink_file(src, tmp)
+            elif mode == "hard":
+                os.link(src, tmp)
+            elif mode == "copy":
+                shutil.copyfile(src, tmp)
+            else:
+                raise ValueError("Unknown link mode: {}".format(mode))
+        except (OSError, ImportError):
+            remove_file(tmp)
+            if mode == modes[-1]:
+                raise
+            continue
+        try:
+            os.replace(tmp, dst)
+        finally:
+            remove_file(tmp)  # Also if dst already was a hard link to src (then rename does nothing).
+        return mode
+
+
 # @contextmanager
 # def temp_file(name=None, mode='w+b', prefix='tmp', suffix='', dir=None, delete=True):
 #     if name:
 #         with tempfile.NamedTemporaryFile()
 
 
-def join_files(out_path, in_path, *in_paths, out_mode='wb', in_mode='rb'):
-    with open(out_path, mode=out_mode) as out_file:
-        if type(in_path) == str:
-            shutil.copyfileobj(open(in_path, mode=in_mode), out_file)
-        else:
-            for path in in_path:
-                shutil.copyfileobj(open(path, mode=in_mode), out_file)
-        for path in in_paths:
-            shutil.copyfileobj(open(path, mode=in_mode), out_file)
+# Kernel-side copies of count bytes from the current position of src_fd to dst_fd, best first.
+_KERNEL_COPIES = []
+if hasattr(os, 'copy_file_range'):  # Linux: may not copy any data at all (eg: on btrfs, xfs or NFS).
+    _KERNEL_COPIES.append(lambda src_fd, dst_fd, count: os.copy_file_range(src_fd, dst_fd, count))
+if hasattr(os, 'sendfile'):
+    _KERNEL_COPIES.append(lambda src_fd, dst_fd, count: os.sendfile(dst_fd, src_fd, None, count))
+# The method isn't supported for these files, so the next one is tried.
+_UNSUPPORTED = {getattr(errno, name) for name in 
+                ("EXDEV", "ENOSYS", "EINVAL", "EBADF", "EOPNOTSUPP", "ENOTSUP", "ENOTSOCK") if hasattr(errno, name)}
+
+
+def copy_file_data(src, dst):
+    """ Copy the rest of the binary file src to dst (both from their current positions)
+        in the kernel if possible: os.copy_file_range, then os.sendfile, then shutil.copyfileobj.
+        The files should be unbuffered (buffering=0), so that their positions are the ones of the descriptors.
+        Returns the number of bytes copied.
+    """
+    dst.flush()
+    src_fd, dst_fd = src.fileno(), dst.fileno()
+    remaining = os.fstat(src_fd).st_size - os.lseek(src_fd, 0, os.SEEK_CUR)
+    copied = 0
+    for copy in _KERNEL_COPIES:
+        try:
+            while copied < remaining:
+                size = copy(src_fd, dst_fd, min(remaining - copied, 2 ** 30))
+                if not size:
+                    break
+                copied += size
+            if copied >= remaining:
+                return copied
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+    # Whatever is left (eg: the file grew).
+    while True:
+        chunk = src.read(2 ** 20)
+        if not chunk:
+            return copied
+        dst.write(chunk)
+        copied += len(chunk)
+
+
+def join_files(out_path, in_path, *in_paths, out_mode='wb', in_mode='rb', move_first=False):
+    """ Concatenate the files into out_path. In binary mode the data is copied 
+        in the kernel where possible (see copy_file_data).
+
+        in_path: a path or a list of paths (followed by in_paths).
+        move_first: rename the first file to out_path and append the rest to it,
+            so that its data isn't copied at all. The first file is gone afterwards.
+    """
+    paths = ([in_path] if isinstance(in_path, str) else list(in_path)) + list(in_paths)
+    binary = 'b' in out_mode and 'b' in in_mode
+    if move_first and paths and binary and 'a' not in out_mode:
+        os.replace(paths.pop(0), out_path)
+        out_mode = 'r+b'
+    with open(out_path, mode=out_mode, buffering=0 if binary else -1) as out_file:
+        out_file.seek(0, os.SEEK_END)
+        for path in paths:
+            with open(path, mode=in_mode, buffering=0 if binary else -1) as in_file:
+                if binary:
+                    copy_file_data(in_file, out_file)
+                else:
+                    shutil.copyfileobj(in_file, out_file)
+    return out_path
 
 
 def real_case_filename(path):
@@ -196,10 +316,7 @@ def md5sum(path):
         None -> cannot generate md5 checksum
     Note:
         md5 is exploitable!
+        See hashing.hash_files for several algorithms and many files at once.
     """
     if os.path.isfile(path):
-        hash_md5 = hashlib.md5()
-        with open(path, 'rb') as f:
-            for chunk in iter(lambda: f.read(8192), b''):
-                hash_md5.update(chunk)
-        return hash_md5.hexdigest()
+        return hash_file(path, ["md5"])["md5"]
@@ -0,0 +1,314 @@
+""" Parallel file hashing: several algorithms in a single read of each file, many files at once.
+
+    hashlib releases the GIL while it hashes big buffers, so the threads really run in parallel
+    (and the disk gets several requests at a time).
+
+    Usage:
+        hash_file(path, ["md5", "sha256"])  # {"md5": "...", "sha256": "..."}
+
+        for path, digests in hash_files(paths, ["sha256", "blake2b"], threads=8):
+            if isinstance(digests, Exception):
+                print(path, digests)
+
+        for path, digests in hash_dir("artifacts"):
+            ...
+
+        # Only rehash the files that changed since the last time:
+        with ChecksumIndex("checksums.sqlite", ["sha256"]) as index:
+            for path, digests in index.hash_dir("artifacts"):
+                ...
+"""
+
+import concurrent.futures
+import hashlib
+import itertools
+import os
+import sqlite3
+import threading
+import time
+
+BUFFER_SIZE = 2 ** 20  # 1 MiB
+
+_buffers = threading.local()  # One reusable read buffer per thread.
+
+
+def _buffer(size):
+    buf = getattr(_buffers, "buf", None)
+    if buf is None or len(buf) != size:
+        buf = _buffers.buf = bytearray(size)
+    return buf
+
+
+def hash_file(path, algorithms=("md5",), buffer_size=BUFFER_SIZE):
+    """ Returns {algorithm: hex digest} of the file with each of the hashlib algorithms,
+        reading it only once. Raises OSError if it can't be read (eg: it's a directory).
+    """
+    hashes = [(name, hashlib.new(name)) for name in algorithms]
+    buf = _buffer(buffer_size)
+    view = memoryview(buf)
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            size = f.readinto(buf)
+            if not size:
+                break
+            chunk = view[:size]
+            for _, h in hashes:
+                h.update(chunk)
+    return {name: h.hexdigest() for name, h in hashes}
+
+
+def hash_files(paths, algorithms=("md5",), threads=None, buffer_size=BUFFER_SIZE):
+    """ Hash the files on 'threads' threads (see hash_file) and yield (path, digests) as each one finishes.
+        digests is the exception instead, if the file couldn't be hashed.
+        paths can be any iterable (eg: a generator over millions of files), it's consumed as needed.
+    """
+    algorithms = list(algorithms)
+    paths = iter(paths)
+    threads = threads or min(32, (os.cpu_count() or 1) + 4)
+    backlog = 4 * threads  # Only a few files per thread are queued at a time.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = {}  # future -> path
+        while True:
+            for path in itertools.islice(paths, backlog - len(pending)):
+                pending[executor.submit(hash_file, path, algorithms, buffer_size)] = path
+            if not pending:
+                return
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = e
+                yield pending.pop(future), result
+
+
+def iter_files(path):
+    """ Yield the paths of all files under the directory path. """
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            yield os.path.join(dirpath, filename)
+
+
+def hash_dir(path, algorithms=("md5",), threads=None, buffer_size=BUFFER_SIZE):
+    """ hash_files for all files under the directory path. """
+    return hash_files(iter_files(path), algorithms, threads=threads, buffer_size=buffer_size)
+
+
+RACY_WINDOW = 2  # Files modified this many seconds before they were hashed aren't cached.
+BATCH_SIZE = 4096  # Files per transaction of ChecksumIndex.
+
+
+class ChecksumIndex:
+    """ Persistent index of file digests in a sqlite database.
+
+        The digests of a file are stored with its (st_dev, st_ino, st_size, st_mtime_ns)
+        and reused as long as they still match, so checking an unchanged tree only
+        takes a stat per file. Changed files are hashed again (in parallel, see hash_files).
+
+        The database uses WAL, so other processes can read it while it's being updated.
+        It's kept compact: the directories are stored once and the digests as raw bytes.
+
+        Usage:
+            with ChecksumIndex("checksums.sqlite", ["md5", "sha256"]) as index:
+                for path, digests in index.hash_dir("artifacts"):
+                    ...
+                index.digests(path)  # A single file.
+
+        algorithms: fixed for a database. Opening it with others starts over.
+    """
+
+    def __init__(self, path, algorithms=("md5",), threads=None, buffer_size=BUFFER_SIZE):
+        self.algorithms = list(algorithms)
+        self.sizes = [hashlib.new(name).digest_size for name in self.algorithms]
+        self.threads = threads
+        self.buffer_size = buffer_size
+        self.lock = threading.RLock()
+        self.dirs = {}  # path -> id
+
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=60)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS dirs (id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS files ("
+                        "dir INTEGER NOT NULL, name TEXT NOT NULL, dev INTEGER NOT NULL, ino INTEGER NOT NULL, "
+                        "size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, digests BLOB NOT NULL, "
+                        "PRIMARY KEY (dir, name)) WITHOUT ROWID")
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'algorithms'").fetchone()
+        if row is None or row[0] != ",".join(self.algorithms):
+            self.db.execute("BEGIN IMMEDIATE")
+            self.db.execute("DELETE FROM files")
+            self.db.execute("DELETE FROM dirs")
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('algorithms', ?)", (",".join(self.algorithms),))
+            self.db.execute("COMMIT")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def get(self, path, st=None):
+        """ The stored digests of the file path, or None if it changed (or was never hashed). """
+        path = os.path.abspath(path)
+        st = st or os.stat(path)
+        dirpath, name = os.path.split(path)
+        with self.lock:
+            dir_id = self._dir_id(dirpath, create=False)
+            if dir_id is None:
+                return None
+            row = self.db.execute("SELECT dev, ino, size, mtime_ns, digests FROM files WHERE dir = ? AND name = ?",
+                                  (dir_id, name)).fetchone()
+        if row is None or tuple(row[:4]) != (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns):
+            return None
+        return self._unpack(row[4])
+
+    def digests(self, path):
+        """ The digests of the file path, hashed only if it changed. """
+        [(path, result)] = self.hash_files([path], threads=1)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def hash_files(self, paths, threads=None):
+        """ Yield (path, digests) for each of paths, like hashing.hash_files,
+            but only the files that changed are read.
+        """
+        paths = iter(paths)
+        while True:
+            batch = list(itertools.islice(paths, BATCH_SIZE))
+            if not batch:
+                return
+            yield from self._hash_batch(batch, threads)
+
+    def hash_dir(self, path, threads=None, prune=True):
+        """ hash_files for all files under the directory path.
+            prune: forget the files under path that don't exist anymore.
+        """
+        path = os.path.abspath(path)
+        visited = set()
+
+        def files():
+            for dirpath, _, filenames in os.walk(path):
+                visited.add(dirpath)
+                if prune:
+                    self._prune_dir(dirpath, set(filenames))
+                for filename in filenames:
+                    yield os.path.join(dirpath, filename)
+
+        yield from self.hash_files(files(), threads=threads)
+        if prune:
+            with self.lock:
+                rows = self.db.execute("SELECT path FROM dirs WHERE path = ? OR (path >= ? AND path < ?)",
+                    (path, path + os.sep, path + chr(ord(os.sep) + 1))).fetchall()
+            for (dirpath,) in rows:
+                if dirpath not in visited:
+                    self._prune_dir(dirpath, set())
+
+    def prune(self):
+        """ Forget the files that don't exist anymore. Returns how many were removed. """
+        with self.lock:
+            dirs = [path for (path,) in self.db.execute("SELECT path FROM dirs").fetchall()]
+        removed = 0
+        for dirpath in dirs:
+            try:
+                names = set(os.listdir(dirpath))
+            except OSError:
+                names = set()
+            removed += self._prune_dir(dirpath, names)
+        return removed
+
+    def compact(self):
+        """ Give the space of deleted entries back to the file system. """
+        with self.lock:
+            self.db.execute("VACUUM")
+
+    def _hash_batch(self, paths, threads):
+        changed = {}  # path -> stat
+        for path in paths:
+            try:
+                st = os.stat(path)
+                digests = self.get(path, st)
+            except OSError as e:
+                yield path, e
+                continue
+            if digests is None:
+                changed[path] = st
+            else:
+                yield path, digests
+        if not changed:
+            return
+
+        rows = []
+        now = time.time()
+        try:
+            for path, result in hash_files(changed, self.algorithms, threads=threads or self.threads,
+                                           buffer_size=self.buffer_size):
+                st = changed[path]
+                if not isinstance(result, Exception) and now - st.st_mtime_ns / 1e9 > RACY_WINDOW:
+                    # Otherwise it could still change within the same mtime.
+                    rows.append((path, st, result))
+                yield path, result
+        finally:
+            # Even if the caller stopped early.
+            self._store(rows)
+
+    def _store(self, rows):
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self.db.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)", [
+                    (self._dir_id(os.path.dirname(os.path.abspath(path))), os.path.basename(path),
+                     st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, self._pack(digests))
+                    for path, st, digests in rows])
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+    def _prune_dir(self, dirpath, names):
+        """ Forget the files of dirpath that aren't in names. Returns how many were removed. """
+        with self.lock:
+            dir_id = self._dir_id(dirpath, create=False)
+            if dir_id is None:
+                return 0
+            stale = [(dir_id, name) for (name,) in
+                     self.db.execute("SELECT name FROM files WHERE dir = ?", (dir_id,)).fetchall()
+                     if name not in names]
+            if stale:
+                self.db.executemany("DELETE FROM files WHERE dir = ? AND name = ?", stale)
+            if not names:
+                self.db.execute("DELETE FROM dirs WHERE id = ?", (dir_id,))
+                del self.dirs[dirpath]
+            return len(stale)
+
+    def _dir_id(self, dirpath, create=True):
+        """ Must hold the lock. """
+        dir_id = self.dirs.get(dirpath)
+        if dir_id is None:
+            row = self.db.execute("SELECT id FROM dirs WHERE path = ?", (dirpath,)).fetchone()
+            if row is None:
+                if not create:
+                    return None
+                row = (self.db.execute("INSERT INTO dirs (path) VALUES (?)", (dirpath,)).lastrowid,)
+            dir_id = self.dirs[dirpath] = row[0]
+        return dir_id
+
+    def _pack(self, digests):
+        return b"".join(bytes.fromhex(digests[name]) for name in self.algorithms)
+
+    def _unpack(self, blob):
+        digests = {}
+        pos = 0
+        for name, size in zip(self.algorithms, self.sizes):
+            digests[name] = blob[pos:pos + size].hex()
+            pos += size
+        return digests
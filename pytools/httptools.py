@@ -1,18 +1,642 @@
 import requests
-from lxml import html
+from requests.adapters import HTTPAdapter
+from lxml import etree, html
 
 import os
 import logging
+import collections
+import collections.abc
 import concurrent.futures
+import hashlib
+import json
 import math
+import random
+import threading
 import time
 from functools import wraps
 
+from . import cache
 from . import filetools as ft
 from . import progressbar
 
 
 CHUNK_SIZE = 2 ** 20  # 1 MiB
+POOL_SIZE = 16  # Kept-alive connections per host of the default session.
+MIN_SPLIT = 2 ** 17  # Segments are only split if both halves are at least this big.
+SEGMENT_CHUNK_SIZE = 2 ** 16  # Smaller chunks, so that a split is noticed sooner.
+PWRITE_AVAILABLE = hasattr(os, 'pwrite')
+PROBE_CACHE_SIZE = 1024  # URLs whose metadata is cached ...
+PROBE_TTL = 60  # ... for this many seconds.
+
+# Options of download_multiple_connections that download_url passes on. 
+# All other keyword arguments go to requests.
+MULTIPLE_CONNECTIONS_OPTIONS = ("connections", "preallocate", "adaptive", "segment_size", "mirrors")
+# Keyword arguments of download_url that aren't for requests (besides session, limiter and retry).
+DOWNLOAD_OPTIONS = ("with_progress", "resume", "expected_hash", "hash_algorithms", "http_cache", 
+                    "monitor", "store") + MULTIPLE_CONNECTIONS_OPTIONS
+
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+RETRY_EXCEPTIONS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError, 
+                    ConnectionError, TimeoutError)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def create_session(pool_size=POOL_SIZE):
+    """ requests.Session that keeps up to 'pool_size' connections per host alive. 
+        Sessions can be shared between threads.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def get_session():
+    """ The default session shared by all download functions, 
+        so that connections get reused (no new TCP and TLS handshakes). 
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = create_session()
+        return _session
+
+
+class RetryPolicy:
+    """ When and how long to wait before retrying failed requests and broken transfers.
+
+        attempts: tries in a row without receiving any data, before giving up.
+        backoff: the delay doubles after each failed try, starting at 'backoff' seconds, 
+            up to 'max_backoff' seconds (or the server's Retry-After). 
+        jitter: if True, a random delay between 0 and that is used instead ('full jitter'),
+            so that many clients don't retry at the same time.
+        statuses: response status codes that are retried.
+
+        Downloads only request the bytes they are missing when they retry.
+    """
+
+    def __init__(self, attempts=5, backoff=0.5, max_backoff=30, jitter=True, statuses=RETRY_STATUSES,
+                 exceptions=RETRY_EXCEPTIONS):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.statuses = statuses
+        self.exceptions = exceptions
+
+    def retryable(self, exc):
+        if isinstance(exc, requests.HTTPError):
+            return exc.response is not None and exc.response.status_code in self.statuses
+        return isinstance(exc, self.exceptions)
+
+    def delay(self, attempt, response=None):
+        """ Seconds to wait after the attempt-th (from 0) failed try. """
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        retry_after = response.headers.get('retry-after', '') if response is not None else ''
+        if retry_after.isdigit():
+            delay = max(delay, min(self.max_backoff, int(retry_after)))
+        return delay
+
+    def wait(self, attempt, exc=None):
+        time.sleep(self.delay(attempt, getattr(exc, 'response', None)))
+
+    def get(self, session, url, *args, limiter=None, **kwargs):
+        """ session.get that retries connection errors and the retryable statuses. 
+            The last response is returned as it is.
+        """
+        attempt = 0
+        while True:
+            if limiter:
+                limiter.request(url)
+            try:
+                r = session.get(url, *args, **kwargs)
+            except Exception as e:
+                attempt += 1
+                if not self.retryable(e) or attempt >= self.attempts:
+                    raise
+                self.wait(attempt - 1, e)
+                continue
+            attempt += 1
+            if r.status_code not in self.statuses or attempt >= self.attempts:
+                return r
+            r.close()
+            logging.warning('{url}: {status}, retrying'.format(url=url, status=r.status_code))
+            time.sleep(self.delay(attempt - 1, r))
+
+NO_RETRY = RetryPolicy(attempts=1)
+
+
+class RangeJournal:
+    """ Sidecar file (<path>.journal) that records which byte ranges of 
+        a download are complete, so that an interrupted download can be resumed.
+
+        The journal is only trusted if the url, length and validators (ETag, Last-Modified)
+        of the remote file still match.
+    """
+
+    SAVE_INTERVAL = 1  # seconds
+
+    def __init__(self, path, url, length=0, etag=None, last_modified=None):
+        self.path = path + ".journal"
+        self.url = url
+        self.length = length
+        self.etag = etag
+        self.last_modified = last_modified
+        self.done = []  # Sorted disjoint [start, end) ranges.
+        self.lock = threading.Lock()
+        self.last_save = 0
+
+    @classmethod
+    def load(cls, path, url, length=0, etag=None, last_modified=None):
+        """ Returns the journal of path with its completed ranges, 
+            or an empty journal if there is no matching journal. 
+        """
+        journal = cls(path, url, length=length, etag=etag, last_modified=last_modified)
+        state = cls.read(path)
+        if state is None:
+            return journal
+        if journal.validators() == (state.get("url"), state.get("length"), state.get("etag"), state.get("last_modified")) \
+                and os.path.isfile(path) and os.path.getsize(path) == length:
+            journal.done = [list(r) for r in state.get("done", [])]
+        return journal
+
+    @staticmethod
+    def read(path):
+        """ The saved state of path's journal as a dict or None. """
+        try:
+            with open(path + ".journal") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def validators(self):
+        return self.url, self.length, self.etag, self.last_modified
+
+    def add(self, start, end):
+        """ Mark [start, end) as complete. The journal is saved at most every SAVE_INTERVAL seconds. """
+        with self.lock:
+            self.done = merge_ranges(self.done + [[start, end]])
+            if time.time() - self.last_save >= self.SAVE_INTERVAL:
+                self._save()
+
+    def missing(self):
+        """ The [start, end) ranges that aren't complete. """
+        with self.lock:
+            return missing_ranges(self.done, self.length)
+
+    def save(self):
+        with self.lock:
+            self._save()
+
+    def remove(self):
+        ft.remove_file(self.path)
+
+    def _save(self):
+        state = {"url": self.url, "length": self.length, "etag": self.etag, 
+                 "last_modified": self.last_modified, "done": self.done}
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.path)
+        self.last_save = time.time()
+
+class CachedResponse(collections.namedtuple("CachedResponse", ["url", "status_code", "content", "encoding", "from_cache"])):
+    @property
+    def text(self):
+        return str(self.content, self.encoding or 'utf-8', errors='replace')
+
+
+class HTTPCache:
+    """ Local HTTP cache that revalidates responses with conditional requests 
+        (If-None-Match / If-Modified-Since), so unchanged responses (304) are served from disk.
+
+        Page bodies (see get) are stored in a cache.DiskCache of at most 'maxbytes',
+        the least recently used are evicted first. For downloads only the validators are stored,
+        the file itself is the cached copy and it's left untouched if the server replies 304.
+
+        Usage:
+            http_cache = HTTPCache("http_cache.db")
+            get_html_element(url, http_cache=http_cache)
+            download_url(url, "downloads", http_cache=http_cache)
+    """
+
+    def __init__(self, path, maxbytes=2**28):
+        self.store = cache.DiskCache(path, maxbytes=maxbytes)
+
+    def close(self):
+        self.store.close()
+
+    def get(self, url, *args, session=None, limiter=None, **kwargs):
+        """ GET url and return a CachedResponse (the stored body if it's unchanged). """
+        session = session or get_session()
+        headers = dict(kwargs.pop('headers', None) or {})
+        key = ("page", url, tuple(sorted(headers.items())))
+        entry = self.store.get(key)
+        if entry:
+            headers.update(conditional_headers(entry))
+        if limiter:
+            limiter.request(url)
+        r = session.get(url, *args, headers=headers, **kwargs)
+        if r.status_code == 304 and entry:
+            return CachedResponse(r.url, 200, entry["content"], entry["encoding"], True)
+        if r.status_code == 200 and 'no-store' not in r.headers.get('cache-control', ''):
+            entry = {"etag": r.headers.get('etag'), "last_modified": r.headers.get('last-modified'),
+                     "content": r.content, "encoding": r.encoding or r.apparent_encoding}
+            if entry["etag"] or entry["last_modified"]:
+                self.store[key] = entry
+        return CachedResponse(r.url, r.status_code, r.content, r.encoding or r.apparent_encoding, False)
+
+    def file_not_modified(self, url, file_path, *args, session=None, limiter=None, **kwargs):
+        """ True if file_path is a complete earlier download of url (see add_file),
+            that hasn't been modified locally and the server replies 304 for.
+        """
+        entry = self.store.get(("file", url, os.path.abspath(file_path)))
+        if not entry:
+            return False
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            return False
+        if (st.st_size, st.st_mtime_ns) != (entry["size"], entry["mtime_ns"]):
+            return False
+        session = session or get_session()
+        headers = dict(kwargs.pop('headers', None) or {})
+        headers.update(conditional_headers(entry))
+        headers['Range'] = 'bytes=0-0'  # Only a byte if it did change.
+        if limiter:
+            limiter.request(url)
+        with session.get(url, *args, headers=headers, stream=True, **kwargs) as r:
+            if r.status_code == 206:
+                r.content  # So that the connection can be reused.
+            return r.status_code == 304
+
+    def add_file(self, url, file_path, etag=None, last_modified=None):
+        """ Remember the validators of the downloaded file_path. """
+        if not (etag or last_modified):
+            return
+        st = os.stat(file_path)
+        self.store[("file", url, os.path.abspath(file_path))] = {
+            "etag": etag, "last_modified": last_modified, "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+def conditional_headers(entry):
+    headers = {}
+    if entry.get("etag"):
+        headers['If-None-Match'] = entry["etag"]
+    if entry.get("last_modified"):
+        headers['If-Modified-Since'] = entry["last_modified"]
+    return headers
+
+def merge_ranges(ranges):
+    """ Merge overlapping and adjacent [start, end) ranges. """
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+def missing_ranges(ranges, length):
+    """ The gaps in [0, length) not covered by the sorted disjoint ranges. """
+    missing = []
+    pos = 0
+    for start, end in ranges:
+        if start > pos:
+            missing.append([pos, start])
+        pos = max(pos, end)
+    if pos < length:
+        missing.append([pos, length])
+    return missing
+
+def split_ranges(ranges, count):
+    """ Split the [start, end) ranges into about 'count' ranges of similar size. """
+    total = sum(end - start for start, end in ranges)
+    size = max(1, math.ceil(total / count))
+    split = []
+    for start, end in ranges:
+        while start < end:
+            split.append([start, min(end, start + size)])
+            start += size
+    return split
+
+class ChecksumError(IOError):
+    def __init__(self, path, expected, actual):
+        super().__init__("Checksum mismatch for {}: expected {}, got {}".format(path, expected, actual))
+        self.path = path
+        self.expected = expected
+        self.actual = actual
+
+
+class FileChangedError(IOError):
+    """ The file changed on the server since it was probed (see probe_url). """
+    pass
+
+
+class StreamHasher:
+    """ Hashes a file (with several algorithms at once) while its bytes arrive, possibly out of order.
+
+        Bytes at the current position are hashed straight from memory. Bytes that arrive 
+        ahead of it are only recorded, and hashed later by reading them back from 'path' 
+        (usually still in the page cache) once the gap before them is filled, 
+        so nothing is buffered in memory.
+
+        path: the file the bytes are written to, or None if they can only be read 
+            at the end (see finish).
+        done: [start, end) ranges already in the file (eg: of a resumed download).
+    """
+
+    def __init__(self, algorithms, path=None, done=()):
+        self.hashes = {name: hashlib.new(name) for name in algorithms}
+        self.path = path
+        self.pos = 0
+        self.ranges = merge_ranges([list(r) for r in done])  # Received [start, end) ranges after pos.
+        self.lock = threading.Lock()
+        with self.lock:
+            self._advance()
+
+    def update(self, offset, data):
+        """ The bytes at offset were received (and written to path). """
+        with self.lock:
+            end = offset + len(data)
+            if offset <= self.pos < end:
+                self._update(memoryview(data)[self.pos - offset:])
+                self.pos = end
+            elif offset > self.pos:
+                self.ranges = merge_ranges(self.ranges + [[offset, end]])
+            self._advance()
+
+    def finish(self, path=None, length=None):
+        """ Hash the rest of the file (up to length) from path and return the hex digests. """
+        with self.lock:
+            self.path = path or self.path
+            if length is not None and self.pos < length:
+                self.ranges = merge_ranges(self.ranges + [[self.pos, length]])
+            self._advance()
+        return self.hexdigests()
+
+    def hexdigests(self):
+        return {name: h.hexdigest() for name, h in self.hashes.items()}
+
+    def verify(self, expected):
+        """ Raise ChecksumError if any of the expected {algorithm: hex digest} don't match. """
+        digests = self.hexdigests()
+        for name, digest in expected.items():
+            if digests[name] != digest.lower():
+                raise ChecksumError(self.path, digest, digests[name])
+
+    def _update(self, data):
+        for h in self.hashes.values():
+            h.update(data)
+
+    def _advance(self):
+        if self.path is None:
+            return
+        while self.ranges and self.ranges[0][0] <= self.pos:
+            start, end = self.ranges.pop(0)
+            if end <= self.pos:
+                continue
+            with open(self.path, 'rb') as f:
+                f.seek(self.pos)
+                while self.pos < end:
+                    chunk = f.read(min(CHUNK_SIZE, end - self.pos))
+                    if not chunk:
+                        raise IOError("{} is shorter than {} bytes".format(self.path, end))
+                    self._update(chunk)
+                    self.pos += len(chunk)
+
+def create_hasher(expected_hash=None, hash_algorithms=None, path=None, done=()):
+    """ StreamHasher for the algorithms of hash_algorithms and expected_hash, or None if there are none. """
+    algorithms = list(hash_algorithms or ())
+    algorithms += [name for name in (expected_hash or {}) if name not in algorithms]
+    return StreamHasher(algorithms, path=path, done=done) if algorithms else None
+
+def finish_hasher(hasher, path, length=None, expected_hash=None, hash_algorithms=None):
+    """ Verify the downloaded file (it's removed if it doesn't match expected_hash).
+        Returns path, or (path, {algorithm: hex digest}) if hash_algorithms were given.
+    """
+    if hasher is None:
+        return path
+    digests = hasher.finish(path, length)
+    if expected_hash:
+        try:
+            hasher.verify(expected_hash)
+        except ChecksumError:
+            ft.remove_file(path)
+            raise
+    return (path, digests) if hash_algorithms else path
+
+
+class Segment:
+    """ The [start, end) byte range of a download. 'pos' is the next byte to download.
+        'end' shrinks when the segment gets split.
+    """
+    __slots__ = ["start", "end", "pos"]
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.pos = start
+
+    def __repr__(self):
+        return "Segment({}, {}, pos={})".format(self.start, self.end, self.pos)
+
+
+class SegmentScheduler:
+    """ Hands out the byte ranges of a download to the connections as small segments.
+
+        When the queue is empty, an idle connection takes over the second half 
+        of the largest unfinished segment (work stealing), so a slow connection 
+        can't hold up the whole download.
+
+        With adaptive=True, the number of active connections starts at 2 and 
+        every 'interval' seconds moves by one in the direction that improved
+        the measured throughput (up to 'connections').
+
+        Usage (by each connection):
+            while True:
+                segment = scheduler.next()
+                if segment is None: break
+                for chunk in ...:
+                    offset = segment.pos
+                    keep = scheduler.claim(segment, len(chunk))
+                    write chunk[:keep] at offset
+                    if keep < len(chunk): break
+                scheduler.done(segment)  or  scheduler.fail(segment, exception)
+    """
+
+    def __init__(self, ranges, connections=5, segment_size=None, min_split=MIN_SPLIT, adaptive=False, interval=1):
+        """ ranges: [start, end) byte ranges to download. """
+        total = sum(end - start for start, end in ranges)
+        if segment_size is None:
+            segment_size = min(64 * CHUNK_SIZE, max(CHUNK_SIZE, total // (connections * 4)))
+        self.pending = collections.deque(Segment(start, end) for start, end in split_ranges(
+            ranges, max(1, math.ceil(total / segment_size))))
+        self.active = []
+        self.connections = connections
+        self.min_split = min_split
+        self.cond = threading.Condition()
+        self.splits = 0
+        self.errors = []
+
+        self.adaptive = adaptive
+        self.interval = interval
+        self.limit = min(2, connections) if adaptive else connections
+        self.direction = 1
+        self.received = 0
+        self.last_rate = 0
+        self.interval_start = time.time()
+
+    def next(self):
+        """ The next segment to download, or None if there's nothing left for this connection.
+            Blocks while the number of active connections is at the limit.
+        """
+        with self.cond:
+            while True:
+                if len(self.active) < self.limit:
+                    segment = self.pending.popleft() if self.pending else self._split()
+                    if segment is not None:
+                        self.active.append(segment)
+                    return segment
+                if not self.pending and self._largest() is None:
+                    return None
+                self.cond.wait(self.interval)
+
+    def claim(self, segment, size):
+        """ Claim the next 'size' bytes of the segment. Returns how many of them 
+            the caller should keep (less if the segment was split in the meantime).
+        """
+        with self.cond:
+            keep = max(0, min(size, segment.end - segment.pos))
+            segment.pos += keep
+            self.received += keep
+            if self.adaptive:
+                self._adapt()
+            return keep
+
+    def done(self, segment):
+        """ The connection stopped working on the segment. 
+            An unfinished remainder is put back into the queue.
+        """
+        with self.cond:
+            self.active.remove(segment)
+            if segment.pos < segment.end:
+                self.pending.appendleft(Segment(segment.pos, segment.end))
+            self.cond.notify_all()
+
+    def fail(self, segment, exc):
+        with self.cond:
+            self.errors.append(exc)
+        self.done(segment)
+
+    def remaining(self):
+        """ Bytes that are still pending or being downloaded. """
+        with self.cond:
+            return sum(s.end - s.pos for s in self.pending) + sum(s.end - s.pos for s in self.active)
+
+    def _largest(self):
+        """ The active segment with the most remaining bytes, if it's worth splitting. """
+        largest = max(self.active, key=lambda s: s.end - s.pos, default=None)
+        if largest is None or largest.end - largest.pos < 2 * self.min_split:
+            return None
+        return largest
+
+    def _split(self):
+        largest = self._largest()
+        if largest is None:
+            return None
+        mid = largest.pos + (largest.end - largest.pos) // 2
+        segment = Segment(mid, largest.end)
+        largest.end = mid
+        self.splits += 1
+        return segment
+
+    def _adapt(self):
+        now = time.time()
+        elapsed = now - self.interval_start
+        if elapsed < self.interval:
+            return
+        rate = self.received / elapsed
+        if rate < self.last_rate:
+            self.direction = -self.direction
+        self.limit = max(1, min(self.connections, self.limit + self.direction))
+        self.last_rate = rate
+        self.received = 0
+        self.interval_start = now
+        self.cond.notify_all()
+
+
+class MirrorError(IOError):
+    pass
+
+
+class Mirrors:
+    """ Equivalent urls of the same file. Each segment goes to a mirror chosen at random, 
+        weighted by the throughput measured for it (an exponential moving average), 
+        so the download isn't limited by the slowest mirror.
+
+        A mirror is dropped if its responses don't match (length or its own ETag changed) 
+        or after 'attempts' failures in a row, as long as there is another one left.
+    """
+
+    def __init__(self, length, attempts=1, alpha=0.3):
+        self.length = length
+        self.attempts = attempts
+        self.alpha = alpha
+        self.urls = []
+        self.etags = {}
+        self.rates = {}  # url -> bytes/s (None until measured)
+        self.failures = {}
+        self.lock = threading.Lock()
+
+    def add(self, url, etag=None):
+        with self.lock:
+            if url not in self.etags:
+                self.urls.append(url)
+                self.etags[url] = etag
+                self.rates[url] = None
+                self.failures[url] = 0
+
+    def choose(self):
+        with self.lock:
+            measured = [rate for rate in self.rates.values() if rate]
+            # Mirrors without a measurement yet get the best rate, so that they get tried.
+            best = max(measured) if measured else 1
+            return random.choices(self.urls, [self.rates[url] or best for url in self.urls])[0]
+
+    def check(self, url, response):
+        """ Raise MirrorError if the response isn't of the same file. """
+        total = response.headers.get('content-range', '').rsplit('/', 1)[-1]
+        if total.isdigit() and int(total) != self.length:
+            raise MirrorError("{} has a different length ({} != {})".format(url, total, self.length))
+        etag = response.headers.get('etag')
+        if self.etags.get(url) and etag and etag != self.etags[url]:
+            raise MirrorError("{} changed (ETag {} != {})".format(url, etag, self.etags[url]))
+
+    def record(self, url, size, seconds):
+        with self.lock:
+            if url not in self.rates:
+                return
+            self.failures[url] = 0
+            if size and seconds > 0:
+                rate = size / seconds
+                old = self.rates[url]
+                self.rates[url] = rate if old is None else self.alpha * rate + (1 - self.alpha) * old
+
+    def failed(self, url, exc, retry=NO_RETRY):
+        """ Returns True if the mirror was dropped (the other mirrors take over). """
+        with self.lock:
+            if url not in self.rates or len(self.urls) < 2:
+                return False
+            self.failures[url] += 1
+            if isinstance(exc, MirrorError) or not retry.retryable(exc) or self.failures[url] >= self.attempts:
+                logging.warning('Dropping mirror {url}: {e}'.format(url=url, e=exc))
+                self.urls.remove(url)
+                del self.rates[url]
+                return True
+            return False
 
 
 def format_speed(start_time, _bytes):
@@ -32,20 +656,190 @@ def downloading_log(func):
         return result
     return inner_log
 
-def get_html_element(url, *args, **kwargs):
-    r = requests.get(url, *args, **kwargs)
+def get_html_element(url, *args, session=None, http_cache=None, **kwargs):
+    """ http_cache: optional HTTPCache, so that unchanged pages are served from disk. """
+    session = session or get_session()
+    if http_cache:
+        r = http_cache.get(url, *args, session=session, **kwargs)
+    else:
+        r = session.get(url, *args, **kwargs)
     return html.fromstring(r.text)
 
-def download_url(url, path, *args, **kwargs):
-    if range_download_available(url, *args, **kwargs):
-        return download_multiple_connections(url, path, *args, **kwargs)
+def iterparse_html(url, *args, session=None, chunk_size=SEGMENT_CHUNK_SIZE, **kwargs):
+    """ Parse the page while it downloads (without keeping the body in memory). 
+        Yields the root element of the tree parsed so far after each chunk and 
+        finally the complete tree. Stop iterating to stop the download.
+    """
+    session = session or get_session()
+    with session.get(url, *args, stream=True, **kwargs) as r:
+        r.raise_for_status()
+        # Without a charset requests assumes ISO-8859-1, but lxml can do better (eg: <meta charset>).
+        encoding = r.encoding if 'charset' in r.headers.get('content-type', '') else None
+        parser = etree.HTMLPullParser(events=("start",), tag="html", encoding=encoding)
+        parser.set_element_class_lookup(html.HtmlElementClassLookup())  # Same elements as get_html_element.
+        root = None
+        for chunk in r.iter_content(chunk_size):
+            parser.feed(chunk)
+            for _, element in parser.read_events():
+                root = element
+            if root is not None:
+                yield root
+        yield parser.close()
+
+def parse_html(url, *args, until=None, session=None, **kwargs):
+    """ Like get_html_element, but parses the page while it downloads.
+
+        until: XPath query or 'css:<selector>' (or a list of them). The download stops as soon as 
+            each of them has a complete match, so the returned tree may be partial.
+    """
+    if isinstance(until, str):
+        until = [until]
+    queries = compile_queries(until or [])
+    for root in iterparse_html(url, *args, session=session, **kwargs):
+        if queries and all(first_complete(query(root)) is not None for query in queries):
+            break
+    return root
+
+def scrape(url, queries, *args, first=False, session=None, **kwargs):
+    """ Parse url while it downloads and return {name: values} for queries {name: XPath or 'css:<selector>'}.
+
+        Elements are returned as their text content, other XPath results (attributes, text()) as strings.
+        first: if True, only the first match of each query (or None) is returned and 
+            the download stops as soon as all of them are complete (queries that don't 
+            return a list, eg: count(), always need the whole page).
+    """
+    compiled = dict(zip(queries, compile_queries(queries.values())))
+    for root in iterparse_html(url, *args, session=session, **kwargs):
+        if first and all(first_complete(query(root)) is not None for query in compiled.values()):
+            break
+    results = {}
+    for name, query in compiled.items():
+        matches = query(root)
+        if not isinstance(matches, list):
+            results[name] = matches  # eg: count()
+        elif first:
+            results[name] = scraped_value(matches[0]) if matches else None
+        else:
+            results[name] = [scraped_value(match) for match in matches]
+    return results
+
+def scrape_urls(urls, queries, *args, threads=8, session=None, **kwargs):
+    """ scrape all urls concurrently. Returns the list of results (or exceptions) in the order of urls. """
+    session = session or (get_session() if threads <= POOL_SIZE else create_session(pool_size=threads))
+    def scrape_url(url):
+        try:
+            return scrape(url, queries, *args, session=session, **kwargs)
+        except Exception as e:
+            logging.warning('Scraping {url} failed: {e}'.format(url=url, e=e))
+            return e
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        return list(executor.map(scrape_url, urls))
+
+def compile_queries(queries):
+    compiled = []
+    for query in queries:
+        if query.startswith("css:"):
+            from lxml.cssselect import CSSSelector  # Needs the cssselect package.
+            compiled.append(CSSSelector(query[len("css:"):]))
+        else:
+            compiled.append(etree.XPath(query))
+    return compiled
+
+def is_complete(element):
+    """ Whether the end of element has been parsed: it or one of its ancestors already has a next sibling. """
+    while element is not None:
+        if element.getnext() is not None:
+            return True
+        element = element.getparent()
+    return False
+
+def first_complete(matches):
+    """ The first of the XPath matches if it's complete, otherwise None. """
+    if not isinstance(matches, list) or not matches:
+        return None
+    match = matches[0]
+    # Attribute values and text() results know their element.
+    element = match if isinstance(match, etree._Element) else getattr(match, 'getparent', lambda: None)()
+    return match if element is not None and is_complete(element) else None
+
+def scraped_value(match):
+    if isinstance(match, etree._Element):
+        return match.text_content()
+    return str(match) if isinstance(match, str) else match
+
+def download_url(url, path, *args, file_name="", with_progress=True, resume=True, session=None, limiter=None, 
+                 expected_hash=None, hash_algorithms=None, http_cache=None, retry=None, monitor=None, store=None, 
+                 **kwargs):
+    """ Download url into the directory path, using multiple connections if the server supports ranges. 
+        See MULTIPLE_CONNECTIONS_OPTIONS for the extra options.
+
+        limiter: optional ratelimit.RateLimiter (share one between downloads to cap their total rate).
+        expected_hash: optional {algorithm: hex digest} (eg: {"sha256": "..."}). The file is hashed 
+            while it downloads. If it doesn't match, it's removed and ChecksumError is raised.
+        hash_algorithms: optional hashlib algorithm names. If given, (path, {algorithm: hex digest})
+            is returned instead of path.
+        http_cache: optional HTTPCache. If the file was downloaded before and the server
+            replies 304 Not Modified, it's left as it is.
+        retry: optional RetryPolicy (by default nothing is retried).
+        monitor: optional telemetry.DownloadMonitor (events, throughput and stall detection).
+        store: optional store.DownloadStore. The file is linked from the store (downloaded into it
+            first, unless it's there already) and concurrent downloads of url join a single transfer.
+    """
+    session = session or get_session()
+    if store:
+        return store.download(url, path, *args, file_name=file_name, with_progress=with_progress, resume=resume, 
+                              session=session, limiter=limiter, expected_hash=expected_hash, 
+                              hash_algorithms=hash_algorithms, retry=retry, monitor=monitor, **kwargs)
+    options = {key: kwargs.pop(key) for key in MULTIPLE_CONNECTIONS_OPTIONS if key in kwargs}
+    options.update(expected_hash=expected_hash, hash_algorithms=hash_algorithms, retry=retry, monitor=monitor)
+    if http_cache:
+        file_path = os.path.join(path, file_name) if file_name else path_from_url(path, url)
+        if http_cache.file_not_modified(url, file_path, *args, session=session, limiter=limiter, **kwargs):
+            logging.info('{path} is up to date'.format(path=file_path))
+            return finish_hasher(create_hasher(expected_hash, hash_algorithms, path=file_path), file_path, 
+                                 os.path.getsize(file_path), expected_hash, hash_algorithms)
+        # The cached probe may be of the old file.
+        probe_url.cache_invalidate(url, *args, **kwargs)
+
+    info = probe_url(url, *args, session=session, limiter=limiter, retry=retry, **kwargs)
+    if info.ranges and info.length > 0:
+        try:
+            result = download_multiple_connections(url, path, *args, file_name=file_name,
+                with_progress=with_progress, resume=resume, session=session, limiter=limiter, **options, **kwargs)
+        except FileChangedError as e:
+            # The probe was stale (it's been dropped), so start over once.
+            logging.warning('{e}, starting over'.format(e=e))
+            info = probe_url(url, *args, session=session, limiter=limiter, retry=retry, **kwargs)
+            result = download_multiple_connections(url, path, *args, file_name=file_name,
+                with_progress=with_progress, resume=resume, session=session, limiter=limiter, **options, **kwargs)
     else:
-        return download_basic(url, path, *args, **kwargs)
+        result = download_basic(url, *args, dir_path=path, file_name=file_name, 
+            with_progress=with_progress, resume=resume, session=session, limiter=limiter, 
+            expected_hash=expected_hash, hash_algorithms=hash_algorithms, retry=retry, monitor=monitor, **kwargs)
+    if http_cache:
+        http_cache.add_file(url, file_path, info.etag, info.last_modified)
+    return result
+
+def download_basic(url, *args, dir_path=".", file_name="", file_path="", with_progress=True, resume=True, 
+                   session=None, limiter=None, expected_hash=None, hash_algorithms=None, retry=None, monitor=None, 
+                   **kwargs):
+    """ Download url using a single connection.
 
-def download_basic(url, *args, dir_path=".", file_name="", file_path="", with_progress=True, **kwargs):
+        resume: if an earlier download of url to the same path was interrupted,
+            continue from the current size of the file (if the server supports ranges 
+            and the file hasn't changed).
+        limiter: optional ratelimit.RateLimiter.
+        expected_hash, hash_algorithms: see download_url.
+        retry: optional RetryPolicy. A broken transfer continues from the last received byte
+            (if the server supports ranges and the file hasn't changed, otherwise it starts over).
+        monitor: optional telemetry.DownloadMonitor.
+    """
     time_started = time.time()
+    session = session or get_session()
+    retry = retry or NO_RETRY
 
-    total = get_content_length(url, *args, **kwargs)
+    total = probe_url(url, *args, session=session, limiter=limiter, retry=retry, **kwargs).length
     total_str = ft.convert_file_size(total)
 
     if not file_path:
@@ -53,88 +847,524 @@ def download_basic(url, *args, dir_path=".", file_name="", file_path="", with_pr
 
     logging.info('Downloading {url} to {path}'.format(url=url, path=file_path))
 
-    if with_progress: 
-        pbar = progressbar.blockbar(total=total, 
-            desc="{file} ({total})\n\t".format(file=os.path.basename(file_path), total=total_str))
-    r = requests.get(url, *args, stream=True, **kwargs)
-    with open(file_path, 'wb') as f:
-        for chunk in r.iter_content(CHUNK_SIZE):
-            if chunk:
-                f.write(chunk)
-                if with_progress: 
-                    pbar.update(len(chunk))
-    if with_progress:
-        pbar.close()
-    logging.info('Completed downloading {path} ({size}) (took {time} to finish)'.format(
-                path=file_path, size=total_str if total > 0 else ft.get_file_size(file_path), time=ft.format_seconds(time.time() - time_started)))
+    transfer = monitor.start(url, file_path, total) if monitor else None
+    try:
+        headers = dict(kwargs.pop('headers', None) or {})
+        offset = 0
+        state = RangeJournal.read(file_path) if resume and os.path.isfile(file_path) else None
+        if state and state.get("url") == url and (state.get("etag") or state.get("last_modified")):
+            # If-Range: the server only sends the rest if the file hasn't changed.
+            offset = os.path.getsize(file_path)
+            headers['Range'] = "bytes={}-".format(offset)
+            headers['If-Range'] = state.get("etag") or state.get("last_modified")
 
-    return file_path
+        r = retry.get(session, url, *args, stream=True, headers=headers, limiter=limiter, **kwargs)
+        if r.status_code == 416 or (offset and r.status_code != 206):
+            # The file changed or the range is invalid, so start over.
+            r.close()
+            offset = 0
+            headers.pop('Range', None)
+            headers.pop('If-Range', None)
+            r = retry.get(session, url, *args, stream=True, headers=headers, limiter=limiter, **kwargs)
+        r.raise_for_status()
+        connection = transfer.connect(offset) if transfer else None
+        if connection:
+            connection.attach(r)
 
-def range_download_available(url, *args, **kwargs):
-    r = requests.head(url, *args, **kwargs)
+        journal = RangeJournal(file_path, url, etag=r.headers.get('etag'), last_modified=r.headers.get('last-modified'))
+        validator = journal.etag or journal.last_modified
+        hasher = create_hasher(expected_hash, hash_algorithms, path=file_path, done=[[0, offset]] if offset else [])
+        if resume:
+            journal.save()
+        if with_progress: 
+            pbar = progressbar.blockbar(total=total, 
+                desc="{file} ({total})\n\t".format(file=os.path.basename(file_path), total=total_str))
+            pbar.update(offset)
+        # Smaller chunks when throttled, so that the rate is smooth, 
+        # and when retrying, since a broken chunk is lost.
+        chunk_size = SEGMENT_CHUNK_SIZE if limiter or retry.attempts > 1 else CHUNK_SIZE
+        pos = offset
+        failures = 0
+        stalls = 0
+        if not offset:
+            # A new file, so that other hard links to the old one (eg: from a DownloadStore) keep their data.
+            ft.remove_file(file_path)
+        with open(file_path, 'ab' if offset else 'wb') as f:
+            while True:
+                try:
+                    for chunk in r.iter_content(chunk_size):
+                        if chunk:
+                            f.write(chunk)
+                            if hasher:
+                                hasher.update(pos, chunk)
+                            pos += len(chunk)
+                            failures = 0
+                            if limiter:
+                                throttle(limiter, url, len(chunk), connection)
+                            if with_progress: 
+                                pbar.update(len(chunk))
+                            if connection:
+                                connection.received(len(chunk))
+                    break
+                except Exception as e:
+                    r.close()
+                    if connection:
+                        connection.close(e)
+                    if connection and connection.stalled and stalls < monitor.stall_retries:
+                        stalls += 1
+                    else:
+                        failures += 1
+                        if not retry.retryable(e) or failures >= retry.attempts:
+                            raise
+                        retry.wait(failures - 1, e)
+                    logging.warning('{url}: {e}, retrying from byte {pos}'.format(url=url, e=e, pos=pos))
+                    if connection:
+                        connection.retried(e)
+                    if validator:
+                        # Only the missing bytes, if the file hasn't changed.
+                        headers['Range'] = "bytes={}-".format(pos)
+                        headers['If-Range'] = validator
+                    r = retry.get(session, url, *args, stream=True, headers=headers, limiter=limiter, **kwargs)
+                    r.raise_for_status()
+                    if r.status_code != 206:
+                        # The whole file, so start over.
+                        f.seek(0)
+                        f.truncate()
+                        pos = 0
+                        hasher = create_hasher(expected_hash, hash_algorithms, path=file_path)
+                    if transfer:
+                        connection = transfer.connect(pos)
+                        connection.attach(r)
+        if connection:
+            connection.close()
+        journal.remove()
+        if with_progress:
+            pbar.close()
+        logging.info('Completed downloading {path} ({size}) (took {time} to finish)'.format(
+                    path=file_path, size=total_str if total > 0 else ft.get_file_size(file_path), time=ft.format_seconds(time.time() - time_started)))
+        result = finish_hasher(hasher, file_path, pos, expected_hash, hash_algorithms)
+    except BaseException as e:
+        if transfer:
+            transfer.finish(e)
+        raise
+    if transfer:
+        transfer.finish()
+    return result
+
+# final url: after redirects. length: 0 if unknown. ranges: True if byte ranges are supported.
+UrlInfo = collections.namedtuple("UrlInfo", ["url", "length", "ranges", "etag", "last_modified"])
+
+def _freeze(value):
+    """ A hashable version of value for the probe cache key (eg: params, cookies or proxies dicts). """
+    if isinstance(value, collections.abc.Mapping):
+        return tuple(sorted(((_freeze(k), _freeze(v)) for k, v in value.items()), key=repr))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    if isinstance(value, (set, frozenset)):
+        return frozenset(_freeze(item) for item in value)
     try:
-        return r.headers['accept-ranges'] == 'bytes'
-    except KeyError:
-        headers = kwargs.pop('headers', {})
-        headers['Range'] = 'bytes=0-0'
-        r = requests.get(url, *args, headers=headers, **kwargs)
-        return r.status_code == 206
+        hash(value)
+    except TypeError:
+        return (type(value), id(value))  # The same object gets the same key.
+    return value
+
+def _probe_key(url, *args, session=None, limiter=None, retry=None, **kwargs):
+    return (url, _freeze(args)) + cache.make_key(**{key: _freeze(value) for key, value in kwargs.items()})
+
+@cache.memoize(maxsize=PROBE_CACHE_SIZE, key=_probe_key, ttl=PROBE_TTL)
+def probe_url(url, *args, session=None, limiter=None, retry=None, **kwargs):
+    """ Returns the UrlInfo of url with a single 'Range: bytes=0-0' request.
+        The result is cached for PROBE_TTL seconds (probe_url.cache_clear() to forget it).
+    """
+    session = session or get_session()
+    headers = dict(kwargs.pop('headers', None) or {})
+    headers['Range'] = 'bytes=0-0'
+    with (retry or NO_RETRY).get(session, url, *args, headers=headers, stream=True, limiter=limiter, **kwargs) as r:
+        length = 0
+        if r.status_code in (206, 416):
+            # eg: 'content-range': 'bytes 0-0/10494470' or 'bytes */0' (empty file)
+            total = r.headers.get('content-range', '').rsplit('/', 1)[-1]
+            length = int(total) if total.isdigit() else 0
+            if r.status_code == 206:
+                r.content  # Read the byte, so that the connection can be reused.
+        else:
+            # The whole body would follow, so the connection is dropped instead.
+            r.raise_for_status()
+            length = int(r.headers.get('content-length', 0))
+        return UrlInfo(r.url, length, r.status_code in (206, 416), 
+                       r.headers.get('etag'), r.headers.get('last-modified'))
+
+def if_range(info):
+    """ The If-Range validator of the UrlInfo (If-Range needs a strong ETag), or None. """
+    if info.etag and not info.etag.startswith('W/'):
+        return info.etag
+    return info.last_modified
+
+def check_range_response(url, response, info):
+    """ Raise FileChangedError if the 206 response isn't a range of the file that info describes. """
+    total = response.headers.get('content-range', '').rsplit('/', 1)[-1]
+    if total.isdigit() and int(total) != info.length:
+        raise FileChangedError("{} changed (length {} != {})".format(url, total, info.length))
+    etag = response.headers.get('etag')
+    if info.etag and etag and etag != info.etag:
+        raise FileChangedError("{} changed (ETag {} != {})".format(url, etag, info.etag))
+
+def range_download_available(url, *args, **kwargs):
+    return probe_url(url, *args, **kwargs).ranges
 
 def get_content_length(url, *args, **kwargs):
-    r = requests.head(url, *args, **kwargs)
-    content_length = int(r.headers.get('content-length', 0))
-    if not content_length:
-        headers = kwargs.pop('headers', {})
-        headers['Range'] = 'bytes=0-0'
-        r = requests.get(url, *args, headers=headers, **kwargs)
-        if r.status_code == 206:
-            # eg: 'content-range': 'bytes 0-0/10494470'
-            content_length = int(r.headers['content-range'].rsplit('/')[1])
-    return content_length
-
-def download_multiple_connections(url, dir_path, *args, file_name="", connections=5, **kwargs):
+    return probe_url(url, *args, **kwargs).length
+
+def download_multiple_connections(url, dir_path, *args, file_name="", connections=5, with_progress=False, 
+                                  preallocate=None, resume=True, adaptive=False, segment_size=None, 
+                                  session=None, limiter=None, expected_hash=None, hash_algorithms=None, retry=None, 
+                                  mirrors=None, monitor=None, **kwargs):
+    """ Download url using multiple connections.
+
+        The file is split into segments that are handed out to the connections
+        by a SegmentScheduler. Idle connections take over half of the largest
+        unfinished segment, so slow connections don't hold up the download.
+
+        preallocate: if True, the file is preallocated and each connection writes 
+            its range directly into it (os.pwrite). Otherwise each segment is downloaded
+            into a .part file and the parts are joined at the end.
+            Defaults to True where os.pwrite is available (not on Windows).
+
+        resume: if True, the completed ranges are recorded in a journal (see RangeJournal), 
+            so that an interrupted download only fetches the missing ranges the next time.
+            Only used with preallocate.
+
+        adaptive: if True, the number of active connections (at most 'connections')
+            adapts to the measured throughput.
+
+        segment_size: size of the segments in the queue (by default about 1/4 of 
+            the size per connection, between 1 MiB and 64 MiB).
+
+        limiter: optional ratelimit.RateLimiter shared by all connections.
+
+        expected_hash, hash_algorithms: see download_url. The segments are hashed in order 
+            as they complete (see StreamHasher).
+
+        retry: optional RetryPolicy. When a connection fails, the rest of its segment 
+            goes back to the queue, so only the missing bytes are requested again.
+
+        mirrors: optional list of other urls of the same file. The segments are spread over
+            all of them by their measured throughput (see Mirrors). Mirrors with a different 
+            length or without range support are skipped.
+
+        monitor: optional telemetry.DownloadMonitor. Each segment request is a connection 
+            of the transfer. With a stall_timeout, a stalled segment is aborted and 
+            the rest of it goes back to the queue.
+
+        Raises FileChangedError if the file changed since it was probed (the cached probe 
+        and the journal are dropped, so the next try starts over).
+    """
+    if preallocate is None:
+        preallocate = PWRITE_AVAILABLE
     file_path = os.path.join(dir_path, file_name) if file_name else path_from_url(dir_path, url)
+    if session is None:
+        # Every connection should get a kept-alive connection from the pool.
+        session = get_session() if connections <= POOL_SIZE else create_session(pool_size=connections)
     
     logging.info('Downloading {url} to {path} with {connections} connections.'.format(url=url, path=file_path, connections=connections))
 
-    total = get_content_length(url, *args, **kwargs)
-    futures = []
-    with concurrent.futures.ThreadPoolExecutor(max_workers=connections) as executor:
-        b_range = math.ceil(total / connections)
-        for i in range(connections):
-            part_path = '{path}.part{part}'.format(path=file_path, part=i + 1)
-            futures.append(executor.submit(download_byte_range, url, part_path, (i * b_range) + i, ((i + 1) * b_range) + i, *args, **kwargs))
-
-    parts = [future.result() for future in futures]
-    parts.sort()
-    logging.info('Concatenating downloaded parts to {}'.format(file_path))
-    ft.join_files(file_path, parts)
-    logging.info('Removing .part files for {}'.format(file_path))
-    [ft.remove_file(part) for part in parts]
-    return file_path
-
-def download_byte_range(url, path, start_range, end_range, *args, **kwargs):
-    with open(path, 'wb') as f:
-        headers = kwargs.pop('headers', {})
-        headers['Range'] = "bytes={}-{}".format(start_range, end_range)
+    info = probe_url(url, *args, session=session, limiter=limiter, retry=retry, **kwargs)
+    total = info.length
+    if total <= 0 or not info.ranges:
+        return download_basic(url, *args, file_path=file_path, with_progress=with_progress, 
+                              resume=resume, session=session, limiter=limiter, 
+                              expected_hash=expected_hash, hash_algorithms=hash_algorithms, retry=retry, 
+                              monitor=monitor, **kwargs)
 
-        r = requests.get(url, *args, stream=True, headers=headers, **kwargs)
+    mirror_set = None
+    if mirrors:
+        mirror_set = Mirrors(total, attempts=(retry or NO_RETRY).attempts)
+        mirror_set.add(info.url, info.etag)
+        for mirror in mirrors:
+            try:
+                mirror_info = probe_url(mirror, *args, session=session, limiter=limiter, retry=retry, **kwargs)
+            except Exception as e:
+                logging.warning('Skipping mirror {url}: {e}'.format(url=mirror, e=e))
+                continue
+            if mirror_info.length != total or not mirror_info.ranges:
+                logging.warning('Skipping mirror {url}: length {length} != {total} or no ranges'.format(
+                    url=mirror, length=mirror_info.length, total=total))
+                continue
+            mirror_set.add(mirror_info.url, mirror_info.etag)
 
-        # chunk_time = time.time()
-        for chunk in r.iter_content(CHUNK_SIZE):
-            if chunk:
-                f.write(chunk)
-                # print(format_speed(chunk_time, len(chunk)), end='\r')
-                # chunk_time = time.time()
+    progress = None
+    if with_progress:
+        pbar = progressbar.blockbar(total=total, 
+            desc="{file} ({total})\n\t".format(file=os.path.basename(file_path), total=ft.convert_file_size(total)))
+        progress = pbar.update
 
+    ranges = [[0, total]]
+    journal = None
+    fd = None
+    parts = {}  # start -> .part file
+    if preallocate:
+        journal = RangeJournal.load(file_path, url, length=total, etag=info.etag, last_modified=info.last_modified)
+        if resume and journal.done:
+            ranges = journal.missing()
+            logging.info('Resuming {path} ({size} missing)'.format(path=file_path, 
+                size=ft.convert_file_size(sum(end - start for start, end in ranges))))
+            if with_progress:
+                pbar.update(total - sum(end - start for start, end in ranges))
+        else:
+            journal.done = []
+            ft.preallocate_file(file_path, total)
+        hasher = create_hasher(expected_hash, hash_algorithms, path=file_path, done=journal.done)
+        if not resume:
+            journal = None
+        fd = os.open(file_path, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+
+        def open_segment(segment):
+            return (lambda offset, data: pwrite(fd, data, offset)), None
+    else:
+        hasher = create_hasher(expected_hash, hash_algorithms)  # Hashes the rest after joining the parts.
+        parts_lock = threading.Lock()
+
+        def open_segment(segment):
+            part_path = '{path}.part{start}'.format(path=file_path, start=segment.start)
+            f = open(part_path, 'wb')
+            with parts_lock:
+                # A retried segment that got nothing before it failed starts at the same byte,
+                # so it reuses (and truncates) its part file.
+                parts[segment.start] = part_path
+            return (lambda offset, data: f.write(data)), f.close
+
+    scheduler = SegmentScheduler(ranges, connections=connections, segment_size=segment_size, adaptive=adaptive)
+    transfer = monitor.start(url, file_path, total) if monitor else None
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=connections) as executor:
+            futures = [executor.submit(download_segments, info.url, scheduler, open_segment, *args, 
+                                       session=session, progress=progress, journal=journal, limiter=limiter, 
+                                       hasher=hasher, retry=retry, mirrors=mirror_set, transfer=transfer, 
+                                       info=info, **kwargs)
+                       for _ in range(connections)]
+        [future.result() for future in futures]
+        if scheduler.remaining():
+            changed = [e for e in scheduler.errors if isinstance(e, FileChangedError)]
+            raise changed[0] if changed else scheduler.errors[-1]
+    except BaseException as e:
+        if isinstance(e, FileChangedError):
+            probe_url.cache_invalidate(url, *args, **kwargs)
+            if journal:
+                journal.remove()
+                journal = None
+        if journal:
+            journal.save()
+        if transfer:
+            transfer.finish(e)
+        raise
+    finally:
+        if fd is not None:
+            os.close(fd)
+    if journal:
+        journal.remove()
+    if with_progress:
+        pbar.close()
+    logging.info('{path}: {splits} segment splits'.format(path=file_path, splits=scheduler.splits))
+
+    if parts:
+        parts = [parts[start] for start in sorted(parts)]
+        logging.info('Concatenating downloaded parts to {}'.format(file_path))
+        # The first part becomes the file, so its data isn't copied.
+        ft.join_files(file_path, parts, move_first=True)
+        logging.info('Removing .part files for {}'.format(file_path))
+        [ft.remove_file(part) for part in parts[1:]]
+    try:
+        result = finish_hasher(hasher, file_path, total, expected_hash, hash_algorithms)
+    except ChecksumError as e:
+        if transfer:
+            transfer.finish(e)
+        raise
+    if transfer:
+        transfer.finish()
+    return result
+
+def download_segments(url, scheduler, open_segment, *args, session=None, progress=None, journal=None, 
+                      limiter=None, hasher=None, retry=None, mirrors=None, transfer=None, info=None, **kwargs):
+    """ Download segments from the scheduler until there are none left (a single connection). 
+
+        open_segment: function(segment) -> (write(offset, data), close or None).
+        progress: optional callback(bytes received).
+        journal: optional RangeJournal that records the written ranges.
+        limiter: optional ratelimit.RateLimiter.
+        hasher: optional StreamHasher that gets the written bytes.
+        retry: optional RetryPolicy.
+        mirrors: optional Mirrors to get the segments from (instead of url).
+        transfer: optional telemetry.Transfer. Each segment request is a new connection of it.
+        info: optional UrlInfo of url (see probe_url). The segments of url are requested with If-Range
+            and FileChangedError is raised if the file isn't the same anymore.
+    """
+    session = session or get_session()
+    retry = retry or NO_RETRY
+    headers = dict(kwargs.pop('headers', None) or {})
+    validator = if_range(info) if info else None
+    failures = 0
+    stalls = 0
+    while True:
+        segment = scheduler.next()
+        if segment is None:
+            return
+        source = mirrors.choose() if mirrors else url
+        connection = transfer.connect(segment.pos) if transfer else None
+        try:
+            write, close = open_segment(segment)
+            try:
+                headers['Range'] = "bytes={}-{}".format(segment.pos, segment.end - 1)
+                if validator and source == url:
+                    headers['If-Range'] = validator
+                else:
+                    headers.pop('If-Range', None)
+                if limiter:
+                    limiter.request(source)
+                started = time.time()
+                received = 0
+                with session.get(source, *args, stream=True, headers=headers, **kwargs) as r:
+                    if connection:
+                        connection.attach(r)
+                    if r.status_code == 200 and 'If-Range' in headers:
+                        raise FileChangedError("{} changed (If-Range didn't match)".format(source))
+                    if r.status_code != 206:
+                        raise requests.HTTPError("Range request for {} failed ({})".format(source, r.status_code), response=r)
+                    if info and source == url:
+                        check_range_response(source, r, info)
+                    if mirrors:
+                        mirrors.check(source, r)
+                    for chunk in r.iter_content(SEGMENT_CHUNK_SIZE):
+                        received += len(chunk)
+                        if limiter:
+                            throttle(limiter, source, len(chunk), connection)
+                        offset = segment.pos
+                        keep = scheduler.claim(segment, len(chunk))
+                        if keep:
+                            failures = 0
+                            write(offset, memoryview(chunk)[:keep])
+                            if hasher:
+                                hasher.update(offset, memoryview(chunk)[:keep])
+                            if journal:
+                                journal.add(offset, offset + keep)
+                            if progress:
+                                progress(keep)
+                            if connection:
+                                connection.received(keep)
+                        if keep < len(chunk) or segment.pos >= segment.end:
+                            break  # The segment was split.
+                if mirrors:
+                    mirrors.record(source, received, time.time() - started)
+            finally:
+                if close:
+                    close()
+        except Exception as e:
+            if connection:
+                connection.close(e)
+            if connection and connection.stalled and stalls < transfer.monitor.stall_retries:
+                logging.warning('{url}: segment {segment} stalled, retrying'.format(url=url, segment=segment))
+                stalls += 1
+                connection.retried(e)
+                scheduler.done(segment)  # The rest goes back to the queue.
+                continue
+            if mirrors and mirrors.failed(source, e, retry):
+                if connection:
+                    connection.retried(e)
+                scheduler.done(segment)  # The other mirrors take over.
+                continue
+            failures += 1
+            if retry.retryable(e) and failures < retry.attempts:
+                logging.warning('{url}: segment {segment} failed: {e}, retrying'.format(url=url, segment=segment, e=e))
+                if connection:
+                    connection.retried(e)
+                scheduler.done(segment)  # The rest goes back to the queue.
+                retry.wait(failures - 1, e)
+                continue
+            logging.warning('{url}: segment {segment} failed: {e}'.format(url=url, segment=segment, e=e))
+            scheduler.fail(segment, e)
+            return
+        if connection:
+            connection.close()
+        scheduler.done(segment)
+
+def download_byte_range(url, path, start_range, end_range, *args, session=None, progress=None, limiter=None, 
+                        retry=None, **kwargs):
+    """ Download the byte range (inclusive) into the file path.
+        progress: optional callback(bytes received). 
+        limiter: optional ratelimit.RateLimiter.
+        retry: optional RetryPolicy (only the missing bytes are requested again).
+    """
+    with open(path, 'wb') as f:
+        def write(offset, chunk):
+            f.write(chunk)
+            if progress:
+                progress(len(chunk))
+        stream_range(url, start_range, end_range, write, *args, session=session, limiter=limiter, retry=retry, **kwargs)
     return path
 
-def download_urls(urls, path, *args, threads=3, **kwargs):
+def stream_range(url, start_range, end_range, write, *args, session=None, limiter=None, retry=None, **kwargs):
+    """ Call write(offset, chunk) for the bytes [start_range, end_range] of url, 
+        retrying from the first missing byte according to retry. 
+        Returns the offset after the last received byte.
+    """
+    session = session or get_session()
+    retry = retry or NO_RETRY
+    headers = dict(kwargs.pop('headers', None) or {})
+    offset = start_range
+    failures = 0
+    while True:
+        headers['Range'] = "bytes={}-{}".format(offset, end_range)
+        try:
+            with retry.get(session, url, *args, stream=True, headers=headers, limiter=limiter, **kwargs) as r:
+                if r.status_code != 206:
+                    raise requests.HTTPError("Range request for {} failed ({})".format(url, r.status_code), response=r)
+                for chunk in r.iter_content(SEGMENT_CHUNK_SIZE if limiter or retry.attempts > 1 else CHUNK_SIZE):
+                    if chunk:
+                        if limiter:
+                            limiter.received(url, len(chunk))
+                        write(offset, chunk)
+                        offset += len(chunk)
+                        failures = 0
+            return offset
+        except Exception as e:
+            failures += 1
+            if not retry.retryable(e) or failures >= retry.attempts:
+                raise
+            logging.warning('{url}: {e}, retrying from byte {offset}'.format(url=url, e=e, offset=offset))
+            retry.wait(failures - 1, e)
+
+def throttle(limiter, url, size, connection=None):
+    """ limiter.received(url, size), but the wait doesn't count as a stall of the telemetry connection. """
+    delay = limiter.reserve(url, size=size)
+    if connection:
+        connection.sleep(delay)
+    elif delay > 0:
+        time.sleep(delay)
+
+def pwrite(fd, data, offset):
+    """ Write all of data at offset (os.pwrite may write less). """
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+def download_urls(urls, path, *args, threads=3, session=None, **kwargs):
+    """ Download urls into the directory path (or a list of directories, one for each url).
+        Returns the list of file paths. If a download fails, its exception is raised 
+        once all of them are done.
+
+        See batch.BatchDownloader for priorities, per-host limits and results as they finish.
+    """
+    if session is None:
+        pool_size = threads * kwargs.get("connections", 5)
+        session = get_session() if pool_size <= POOL_SIZE else create_session(pool_size=pool_size)
+    def download(url, path):
+        return download_url(url, path, *args, session=session, **kwargs)
+
+    paths = [path] * len(urls) if isinstance(path, str) else path
     with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
-        if type(path) == str:
-            executor.map(download_url, urls, [p for p in urls], *args, **kwargs)
-        else:
-            executor.map(download_url, urls, path, *args, **kwargs)
+        futures = [executor.submit(download, url, dir_path) for url, dir_path in zip(urls, paths)]
+    return [future.result() for future in futures]
 
 def path_from_url(dir_path, url, overwrite=True):
     dir_path = os.path.abspath(dir_path)
@@ -0,0 +1,116 @@
+""" Token bucket rate limiting of bytes/s and requests/s, shared by all download threads.
+
+    Usage:
+        limiter = RateLimiter(bytes_per_second=2 * 2**20, host_requests_per_second=5)
+        httptools.download_urls(urls, "downloads", threads=8, limiter=limiter)
+"""
+
+import functools
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+class TokenBucket:
+    """ Holds up to 'burst' tokens and refills at 'rate' tokens per second.
+
+        A reservation always succeeds, but may put the bucket into debt.
+        The returned delay is how long the caller has to wait to pay it off,
+        so throttling stays smooth even if the amounts are bigger than the burst.
+    """
+
+    def __init__(self, rate, burst=None, timer=time.monotonic):
+        self.rate = rate
+        self.burst = rate if burst is None else burst
+        self.tokens = self.burst
+        self.timer = timer
+        self.last = timer()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount=1):
+        """ Take 'amount' tokens and return the number of seconds to wait before using them. """
+        with self.lock:
+            now = self.timer()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= amount
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+    def consume(self, amount=1):
+        """ Take 'amount' tokens, sleeping if the bucket is in debt. """
+        delay = self.reserve(amount)
+        if delay > 0:
+            time.sleep(delay)
+
+
+@functools.lru_cache(maxsize=1024)
+def get_host(url):
+    return urlsplit(url).netloc.lower()
+
+
+class RateLimiter:
+    """ Global and per-host limits of bytes/s and requests/s (None means unlimited).
+
+        burst: how many seconds worth of tokens can be used at once after being idle.
+
+        Download functions call request(url) before each request and received(url, size)
+        after each chunk. Both sleep as needed. Asyncio code should use reserve()
+        and await asyncio.sleep() instead.
+    """
+
+    def __init__(self, bytes_per_second=None, requests_per_second=None,
+                 host_bytes_per_second=None, host_requests_per_second=None, burst=0.25, timer=time.monotonic):
+        self.host_bytes_per_second = host_bytes_per_second
+        self.host_requests_per_second = host_requests_per_second
+        self.burst = burst
+        self.timer = timer
+        self.bytes = self._bucket(bytes_per_second)
+        self.requests = self._bucket(requests_per_second)
+        self.hosts = {}  # host -> (bytes bucket, requests bucket)
+        self.lock = threading.Lock()
+        self.limited = any(rate is not None for rate in
+            (bytes_per_second, requests_per_second, host_bytes_per_second, host_requests_per_second))
+
+    def reserve(self, url, size=0, requests=0):
+        """ Reserve 'size' bytes and 'requests' requests to url's host.
+            Returns the number of seconds to wait.
+        """
+        if not self.limited:
+            return 0
+        host_bytes, host_requests = self._host_buckets(get_host(url))
+        delay = 0
+        if size:
+            delay = max(self._reserve(self.bytes, size), self._reserve(host_bytes, size))
+        if requests:
+            delay = max(delay, self._reserve(self.requests, requests), self._reserve(host_requests, requests))
+        return delay
+
+    def request(self, url):
+        """ Call before sending a request to url. """
+        self._sleep(self.reserve(url, requests=1))
+
+    def received(self, url, size):
+        """ Call after receiving 'size' bytes from url. """
+        self._sleep(self.reserve(url, size=size))
+
+    def _bucket(self, rate):
+        if rate is None:
+            return None
+        return TokenBucket(rate, burst=max(1, rate * self.burst), timer=self.timer)
+
+    def _host_buckets(self, host):
+        buckets = self.hosts.get(host)
+        if buckets is None:
+            with self.lock:
+                buckets = self.hosts.setdefault(host,
+                    (self._bucket(self.host_bytes_per_second), self._bucket(self.host_requests_per_second)))
+        return buckets
+
+    @staticmethod
+    def _reserve(bucket, amount):
+        return bucket.reserve(amount) if bucket is not None else 0
+
+    @staticmethod
+    def _sleep(delay):
+        if delay > 0:
+            time.sleep(delay)
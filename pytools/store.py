@@ -0,0 +1,146 @@
+""" Content-addressed store of downloaded files.
+
+    Each distinct content is kept once, as root/objects/<digest[:2]>/<digest>
+    (named by its hash), and an index maps url + validator (ETag or Last-Modified)
+    to the digest. Files are linked into the requested paths (see filetools.link_file),
+    so the same url, or different urls with the same bytes, take up the space of one copy.
+    Concurrent downloads of the same url join a single transfer.
+
+    Usage:
+        store = DownloadStore("~/.cache/pytools/downloads")
+        httptools.download_url(url, "downloads", store=store)
+        # Or:
+        store.download(url, "downloads")
+
+    The objects are read-only, since a hard linked file is the same file as the object.
+    Objects are only reused while they still match their digest (checked with 
+    a filetools.ChecksumIndex, so unchanged objects aren't read again).
+"""
+
+import concurrent.futures
+import logging
+import os
+import shutil
+import stat
+import threading
+import uuid
+
+from . import cache
+from . import filetools as ft
+from . import httptools
+
+
+class DownloadStore:
+    """ root: the directory of the store (created if it doesn't exist).
+        algorithm: the hashlib algorithm that names the objects.
+        link_modes: how files are put into the requested paths (see filetools.link_file).
+    """
+
+    def __init__(self, root, algorithm="sha256", link_modes=("reflink", "hard", "copy"), maxbytes=2**26):
+        self.root = os.path.expanduser(root)
+        self.algorithm = algorithm
+        self.link_modes = link_modes
+        ft.create_dir(os.path.join(self.root, "objects"))
+        ft.create_dir(os.path.join(self.root, "tmp"))
+        self.index = cache.DiskCache(os.path.join(self.root, "index.sqlite"), maxbytes=maxbytes)
+        self.checksums = ft.ChecksumIndex(os.path.join(self.root, "checksums.sqlite"), [algorithm])
+        self.lock = threading.Lock()
+        self.inflight = {}  # (url, validator) -> future of the digest
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.index.close()
+        self.checksums.close()
+
+    def object_path(self, digest):
+        return os.path.join(self.root, "objects", digest[:2], digest)
+
+    def valid(self, digest):
+        """ True if the object exists and still matches digest (eg: it wasn't written through a hard link). """
+        try:
+            return self.checksums.digests(self.object_path(digest))[self.algorithm] == digest
+        except OSError:
+            return False
+
+    def download(self, url, path=".", *args, file_name="", expected_hash=None, hash_algorithms=None, **kwargs):
+        """ Put the contents of url into the directory path, downloading them unless the store has them.
+            Takes the arguments of httptools.download_url and returns what it would.
+        """
+        file_path = os.path.join(path, file_name) if file_name else httptools.path_from_url(path, url)
+        digest = self.fetch(url, *args, **kwargs)
+        mode = ft.link_file(self.object_path(digest), file_path, self.link_modes)
+        # A journal of an earlier download would make the next one resume into the object.
+        httptools.RangeJournal(file_path, url).remove()
+        logging.info('{path}: {mode} of {digest}'.format(path=file_path, mode=mode, digest=digest))
+        if not (expected_hash or hash_algorithms):
+            return file_path
+        algorithms = set(hash_algorithms or ()) | set(expected_hash or ())
+        if algorithms == {self.algorithm}:
+            digests = {self.algorithm: digest}
+        else:
+            digests = httptools.StreamHasher(algorithms).finish(file_path, os.path.getsize(file_path))
+        for name, value in (expected_hash or {}).items():
+            if digests[name] != value.lower():
+                ft.remove_file(file_path)
+                raise httptools.ChecksumError(file_path, value, digests[name])
+        return (file_path, digests) if hash_algorithms else file_path
+
+    def fetch(self, url, *args, session=None, limiter=None, retry=None, **kwargs):
+        """ Returns the digest of the contents of url, downloading them unless the store has them.
+            Without a validator (ETag or Last-Modified), the url is always downloaded
+            (but still only stored once).
+        """
+        request_kwargs = {k: v for k, v in kwargs.items() if k not in httptools.DOWNLOAD_OPTIONS}
+        info = httptools.probe_url(url, *args, session=session, limiter=limiter, retry=retry, **request_kwargs)
+        key = (url, info.etag or info.last_modified)
+        if key[1]:
+            digest = self.index.get(key)
+            if digest is not None and self.valid(digest):
+                return digest
+
+        with self.lock:
+            future = self.inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self.inflight[key] = concurrent.futures.Future()
+        if not leader:
+            logging.info('Waiting for the download of {url} in progress'.format(url=url))
+            return future.result()
+
+        try:
+            digest = self._download(url, key, *args, session=session, limiter=limiter, retry=retry, **kwargs)
+        except BaseException as e:
+            with self.lock:
+                del self.inflight[key]
+            future.set_exception(e)
+            raise
+        with self.lock:
+            del self.inflight[key]
+        future.set_result(digest)
+        return digest
+
+    def _download(self, url, key, *args, **kwargs):
+        tmp_dir = os.path.join(self.root, "tmp", uuid.uuid4().hex)
+        ft.create_dir(tmp_dir)
+        try:
+            kwargs.setdefault("with_progress", False)
+            tmp_path, digests = httptools.download_url(url, tmp_dir, *args, file_name="download",
+                                                       hash_algorithms=[self.algorithm], **kwargs)
+            digest = digests[self.algorithm]
+            object_path = self.object_path(digest)
+            if not self.valid(digest):
+                ft.create_dir(os.path.dirname(object_path))
+                os.chmod(tmp_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+                os.replace(tmp_path, object_path)
+            else:
+                logging.info('{url}: same contents as {digest}'.format(url=url, digest=digest))
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        if key[1]:
+            self.index[key] = digest
+        return digest
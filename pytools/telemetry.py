@@ -0,0 +1,289 @@
+""" Download telemetry: events, throughput (per connection and per download),
+    time to first byte and a stall watchdog.
+
+    Usage:
+        monitor = DownloadMonitor(stall_timeout=30)
+        monitor.add_hook(log_hook)
+        monitor.add_hook(BlockbarHook())
+        monitor.add_hook(lambda event, transfer, connection=None, **data: ...)  # eg: a metrics exporter
+        httptools.download_url(url, "downloads", monitor=monitor)
+        monitor.snapshot()
+
+    Hooks are called as hook(event, transfer, connection=None, **data) with the events:
+        started: a download (connection is None) or a connection of it started.
+        received: 'size' bytes were received by the connection.
+        stalled: the connection didn't receive anything for stall_timeout seconds and was aborted.
+        retried: the connection failed with 'error' and will be retried.
+        finished: a download (connection is None) or a connection of it finished ('error' if it failed).
+"""
+
+import itertools
+import logging
+import os
+import socket
+import threading
+import time
+
+from . import filetools as ft
+from . import progressbar
+
+
+class Throughput:
+    """ Bytes/s smoothed with an exponential moving average.
+        The average is only updated every 'interval' seconds, so add() is cheap.
+    """
+
+    def __init__(self, alpha=0.3, interval=0.25, now=None):
+        self.alpha = alpha
+        self.interval = interval
+        self.rate = 0.0
+        self.pending = 0
+        self.last = time.monotonic() if now is None else now
+
+    def add(self, size, now):
+        self.pending += size
+        elapsed = now - self.last
+        if elapsed >= self.interval:
+            rate = self.pending / elapsed
+            self.rate = rate if not self.rate else self.alpha * rate + (1 - self.alpha) * self.rate
+            self.pending = 0
+            self.last = now
+
+
+class Connection:
+    """ A single request of a transfer (eg: a segment). """
+
+    def __init__(self, transfer, id, start=0):
+        self.transfer = transfer
+        self.id = id
+        self.start = start  # Byte offset.
+        self.started = time.monotonic()
+        self.ttfb = None  # Seconds until the first byte arrived.
+        self.bytes = 0
+        self.throughput = Throughput(now=self.started)
+        self.last_progress = self.started
+        self.response = None
+        self.stalled = False
+        self.paused = False
+
+    def attach(self, response):
+        """ The requests response of this connection (so that the watchdog can abort it).
+            The watchdog only watches connections with a response (the request timeout covers the rest).
+        """
+        self.last_progress = time.monotonic()
+        self.response = response
+
+    def sleep(self, seconds):
+        """ Wait without it counting as a stall (eg: for a rate limiter). """
+        if seconds <= 0:
+            return
+        self.paused = True
+        try:
+            time.sleep(seconds)
+        finally:
+            self.last_progress = time.monotonic()
+            self.paused = False
+
+    def received(self, size):
+        now = time.monotonic()
+        if self.ttfb is None:
+            self.ttfb = now - self.started
+        self.bytes += size
+        self.last_progress = now
+        self.throughput.add(size, now)
+        self.transfer._received(self, size, now)
+
+    def retried(self, error):
+        self.transfer.monitor._emit("retried", self.transfer, self, error=error)
+
+    def close(self, error=None):
+        self.response = None
+        self.transfer._close(self, error)
+
+    def abort(self):
+        """ Shut down the socket, so that the blocked read fails (and the request gets retried). """
+        try:
+            self.response.raw.connection.sock.shutdown(socket.SHUT_RDWR)
+        except (AttributeError, OSError):
+            pass
+
+    def snapshot(self):
+        return {"id": self.id, "start": self.start, "bytes": self.bytes, "rate": self.throughput.rate,
+                "ttfb": self.ttfb, "stalled": self.stalled}
+
+
+class Transfer:
+    """ A download of url to path. """
+
+    def __init__(self, monitor, url, path, total=0):
+        self.monitor = monitor
+        self.url = url
+        self.path = path
+        self.total = total
+        self.started = time.monotonic()
+        self.finished = None
+        self.ttfb = None
+        self.bytes = 0
+        self.throughput = Throughput(now=self.started)
+        self.connections = {}  # id -> active Connection
+        self.error = None
+        self.ids = itertools.count()
+        self.lock = threading.Lock()
+
+    def connect(self, start=0):
+        """ Returns a new Connection, starting at byte offset 'start'. """
+        connection = Connection(self, next(self.ids), start)
+        with self.lock:
+            self.connections[connection.id] = connection
+        self.monitor._emit("started", self, connection)
+        return connection
+
+    def finish(self, error=None):
+        self.finished = time.monotonic()
+        self.error = error
+        self.monitor._finish(self)
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.monotonic()) - self.started
+
+    def snapshot(self):
+        with self.lock:
+            connections = [c.snapshot() for c in self.connections.values()]
+        return {"url": self.url, "path": self.path, "total": self.total, "bytes": self.bytes,
+                "rate": self.throughput.rate, "average_rate": self.bytes / self.elapsed if self.elapsed else 0,
+                "ttfb": self.ttfb, "elapsed": self.elapsed, "connections": connections}
+
+    def _received(self, connection, size, now):
+        with self.lock:
+            if self.ttfb is None:
+                self.ttfb = now - self.started
+            self.bytes += size
+            self.throughput.add(size, now)
+        self.monitor._emit("received", self, connection, size=size)
+
+    def _close(self, connection, error=None):
+        with self.lock:
+            self.connections.pop(connection.id, None)
+        self.monitor._emit("finished", self, connection, error=error)
+
+
+class DownloadMonitor:
+    """ Tracks the transfers of the download functions that it's passed to (monitor=...)
+        and calls the hooks for each event (see the module docstring).
+
+        stall_timeout: if set, a watchdog thread aborts connections that haven't received
+            anything for this many seconds. Only once the response headers have arrived
+            (the request timeout covers the rest), and waiting for a rate limiter doesn't count.
+        stall_retries: how many times each download connection re-issues the rest of 
+            a stalled request (on top of its RetryPolicy).
+    """
+
+    def __init__(self, hooks=(), stall_timeout=None, stall_retries=3):
+        self.hooks = list(hooks)
+        self.stall_timeout = stall_timeout
+        self.stall_retries = stall_retries
+        self.transfers = {}  # id -> active Transfer
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        self.watchdog = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def start(self, url, path, total=0):
+        """ Returns a new Transfer. """
+        transfer = Transfer(self, url, path, total)
+        with self.lock:
+            self.transfers[id(transfer)] = transfer
+            if self.stall_timeout and self.watchdog is None:
+                self.watchdog = threading.Thread(target=self._watch, daemon=True)
+                self.watchdog.start()
+        self._emit("started", transfer)
+        return transfer
+
+    def check_stalls(self, now=None):
+        """ Abort the connections that haven't made progress for stall_timeout seconds. """
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            transfers = list(self.transfers.values())
+        for transfer in transfers:
+            with transfer.lock:
+                connections = list(transfer.connections.values())
+            for connection in connections:
+                if connection.response is None or connection.paused or connection.stalled:
+                    continue
+                if now - connection.last_progress > self.stall_timeout:
+                    connection.stalled = True
+                    self._emit("stalled", transfer, connection)
+                    connection.abort()
+
+    def snapshot(self):
+        with self.lock:
+            transfers = list(self.transfers.values())
+        return [transfer.snapshot() for transfer in transfers]
+
+    def close(self):
+        self.stop.set()
+        if self.watchdog is not None:
+            self.watchdog.join()
+
+    def _finish(self, transfer):
+        with self.lock:
+            self.transfers.pop(id(transfer), None)
+        self._emit("finished", transfer, error=transfer.error)
+
+    def _emit(self, event, transfer, connection=None, **data):
+        for hook in self.hooks:
+            try:
+                hook(event, transfer, connection, **data)
+            except Exception:
+                logging.exception('Download monitor hook failed')
+
+    def _watch(self):
+        while not self.stop.wait(min(1, self.stall_timeout / 4)):
+            self.check_stalls()
+
+
+def log_hook(event, transfer, connection=None, error=None, **data):
+    """ Logs every event except 'received'. """
+    if event == "received":
+        return
+    name = transfer.url if connection is None else "{} (connection {} from byte {})".format(
+        transfer.url, connection.id, connection.start)
+    if event == "finished" and connection is None:
+        logging.info('{name}: finished ({size} at {rate}/s, ttfb {ttfb:.3f} s){error}'.format(
+            name=name, size=ft.convert_file_size(transfer.bytes),
+            rate=ft.convert_file_size(transfer.bytes / transfer.elapsed if transfer.elapsed else 0),
+            ttfb=transfer.ttfb or 0, error=" with error: {}".format(error) if error else ""))
+    elif event in ("stalled", "retried") or error:
+        logging.warning('{name}: {event}{error}'.format(name=name, event=event,
+            error=" ({})".format(error) if error else ""))
+    else:
+        logging.debug('{name}: {event}'.format(name=name, event=event))
+
+
+class BlockbarHook:
+    """ Shows a progressbar.blockbar for each transfer. """
+
+    def __init__(self):
+        self.bars = {}
+
+    def __call__(self, event, transfer, connection=None, size=0, **data):
+        if connection is None and event == "started":
+            self.bars[transfer] = progressbar.blockbar(total=transfer.total, desc="{file} ({total})\n\t".format(
+                file=os.path.basename(transfer.path), total=ft.convert_file_size(transfer.total)))
+        elif event == "received":
+            bar = self.bars.get(transfer)
+            if bar is not None:
+                bar.update(size)
+        elif connection is None and event == "finished":
+            bar = self.bars.pop(transfer, None)
+            if bar is not None:
+                bar.close()
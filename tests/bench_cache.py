@@ -0,0 +1,82 @@
+""" Memory and speed of the LRU implementations.
+
+    Usage: python tests/bench_cache.py [N]  (default N = 1000000 keys)
+"""
+
+import functools
+import gc
+import sys
+import time
+import tracemalloc
+
+from pytools import cache
+
+
+def measure_memory(fill, n):
+    gc.collect()
+    tracemalloc.start()
+    obj = fill(n)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del obj
+    return memory
+
+
+def bench(fill, lookup, insert, n):
+    """ Returns memory, set/s, get/s, evict/s. """
+    memory = measure_memory(fill, n)
+
+    gc.collect()
+    t = time.perf_counter()
+    obj = fill(n)
+    set_time = time.perf_counter() - t
+
+    t = time.perf_counter()
+    for i in range(n):
+        lookup(obj, i)
+    get_time = time.perf_counter() - t
+
+    # Keys that aren't in the cache evict the oldest entries.
+    t = time.perf_counter()
+    for i in range(n, 2 * n):
+        insert(obj, i)
+    evict_time = time.perf_counter() - t
+    return memory, n / set_time, n / get_time, n / evict_time
+
+
+def bench_cache(cls, n):
+    def fill(n):
+        c = cls(maxsize=n)
+        for i in range(n):
+            c[i] = i
+        return c
+
+    def insert(c, i):
+        c[i] = i
+
+    return bench(fill, lambda c, i: c[i], insert, n)
+
+
+def bench_lru_cache(n):
+    def fill(n):
+        @functools.lru_cache(maxsize=n)
+        def f(i):
+            return i
+        for i in range(n):
+            f(i)
+        return f
+
+    return bench(fill, lambda f, i: f(i), lambda f, i: f(i), n)
+
+
+def report(name, n, result):
+    memory, sets, gets, evicts = result
+    print("{:>16} {:>8.1f} B/key {:>12,.0f} set/s {:>12,.0f} get/s {:>12,.0f} evict/s".format(
+        name, memory / n, sets, gets, evicts))
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10 ** 6
+    report("LRUcache", n, bench_cache(cache.LRUcache, n))
+    report("CompactLRUcache", n, bench_cache(cache.CompactLRUcache, n))
+    report("lru_cache", n, bench_lru_cache(n))
@@ -0,0 +1,29 @@
+""" Wall time of large downloads from a local server.
+
+    Usage: python tests/bench_httptools.py [size in MiB]  (default 512)
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+from pytools import httptools
+from local_server import LocalServer
+
+
+def bench(url, dir_path, **kwargs):
+    t = time.perf_counter()
+    path = httptools.download_multiple_connections(url, dir_path, file_name="bench.dat", **kwargs)
+    elapsed = time.perf_counter() - t
+    os.remove(path)
+    return elapsed
+
+
+if __name__ == "__main__":
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 512
+    data = os.urandom(size * 2 ** 20)
+    with LocalServer({"/bench.dat": data}) as server, tempfile.TemporaryDirectory(dir=".") as tmp:
+        url = server.url("/bench.dat")
+        for name, kwargs in (("part files", {"preallocate": False}), ("preallocated", {"preallocate": True})):
+            print("{:>14}: {:.2f} s".format(name, bench(url, tmp, connections=4, **kwargs)))
@@ -0,0 +1,152 @@
+""" Local HTTP server for the download tests.
+
+    Usage:
+    with LocalServer({"/file.dat": data}) as server:
+        httptools.download_url(server.url("/file.dat"), ".")
+
+    The server supports HEAD, If-None-Match and single byte range requests (unless ranges=False).
+    Set 'delay' to a function (handler, start) -> seconds to throttle each chunk of a response
+    and 'drop' to a function (handler, start) -> number of bytes after which the connection is dropped.
+    Set 'fail' to a function (handler) -> error status code (or None) to reply with instead.
+"""
+
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CHUNK_SIZE = 2 ** 16
+
+
+def random_data(size, seed=0):
+    return random.Random(seed).randbytes(size)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive.
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.owner.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.respond(body=False)
+
+    def do_GET(self):
+        self.respond(body=True)
+
+    def respond(self, body):
+        server = self.server.owner
+        with server.lock:
+            server.requests.append((self.command, self.path, dict(self.headers)))
+        status = server.fail(self) if server.fail else None
+        if status:
+            self.send_response(status)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if self.path in server.redirects:
+            self.send_response(302)
+            self.send_header("Location", server.redirects[self.path])
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        data = server.files.get(self.path)
+        if data is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        etag = server.etags.get(self.path, '"{}"'.format(hash(data) & 0xffffffff))
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        start, end = 0, len(data) - 1
+        status = 200
+        range_header = self.headers.get("Range")
+        if_range = self.headers.get("If-Range")
+        if if_range and if_range != etag:
+            range_header = None  # Changed, so send everything.
+        if server.ranges and range_header and range_header.startswith("bytes="):
+            first, last = range_header[len("bytes="):].split("-")
+            start = int(first)
+            end = min(end, int(last)) if last else end
+            status = 206
+
+        self.send_response(status)
+        if server.ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        if status == 206:
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end, len(data)))
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", "Mon, 01 Jan 2024 00:00:00 GMT")
+        self.end_headers()
+        if not body:
+            return
+
+        delay = server.delay(self, start) if server.delay else 0
+        drop = server.drop(self, start) if server.drop else None
+        pos = start
+        while pos <= end:
+            chunk = data[pos:min(end + 1, pos + CHUNK_SIZE)]
+            if drop is not None and pos - start + len(chunk) > drop:
+                self.wfile.write(chunk[:max(0, drop - (pos - start))])
+                self.wfile.flush()
+                self.close_connection = True
+                self.connection.shutdown(2)
+                return
+            self.wfile.write(chunk)
+            pos += len(chunk)
+            if delay:
+                time.sleep(delay)
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients close connections on purpose (e.g. when a segment is split).
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class LocalServer:
+    def __init__(self, files=None, ranges=True):
+        self.files = files or {}  # path -> bytes
+        self.etags = {}  # path -> etag (default: hash of the data)
+        self.redirects = {}  # path -> location
+        self.ranges = ranges
+        self.delay = None
+        self.drop = None
+        self.fail = None
+        self.connections = 0
+        self.requests = []  # (method, path, headers)
+        self.lock = threading.Lock()
+
+        self.httpd = Server(("127.0.0.1", 0), Handler)
+        self.httpd.owner = self
+        self.httpd.lock = self.lock
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def url(self, path):
+        return "http://127.0.0.1:{}{}".format(self.httpd.server_address[1], path)
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,96 @@
+""" asynchttp tests against a local HTTP server (see local_server.py). """
+
+import asyncio
+import os
+
+from pytools import asynchttp
+from local_server import LocalServer, random_data
+
+DATA = random_data(3 * 2 ** 20 + 12345)
+
+
+def check(path, data):
+    with open(path, 'rb') as f:
+        assert f.read() == data
+
+
+def test_download_urls(tmp_path):
+    files = {"/{}.dat".format(i): random_data(1000 + i, seed=i) for i in range(200)}
+    files["/big.dat"] = DATA
+    with LocalServer(files) as server:
+        urls = [server.url(path) for path in files] + [server.url("/missing")]
+        results = asynchttp.download_urls(urls, str(tmp_path), concurrency=16, connections=4)
+        assert server.connections <= 16 + 4  # Kept alive (+ closed after a 404).
+    assert isinstance(results[-1], asynchttp.HTTPError)
+    for path, result in zip(files, results):
+        assert result == os.path.join(str(tmp_path), path[1:])
+        check(result, files[path])
+
+
+def test_chunked_body():
+    async def read():
+        reader = asyncio.StreamReader()
+        reader.feed_data(b"5\r\nhello\r\n6;ext=1\r\n world\r\n0\r\nTrailer: x\r\n\r\n")
+        reader.feed_eof()
+        headers = {"transfer-encoding": "chunked"}
+        return b"".join([chunk async for chunk in asynchttp.iter_body(reader, "GET", 200, headers, 4)])
+
+    assert asyncio.run(read()) == b"hello world"
+
+
+def test_failed_segment_stops_writes(tmp_path, monkeypatch):
+    path = str(tmp_path / "big.dat")
+    stray_writes = []
+    pwrite = asynchttp.pwrite
+
+    def checked_pwrite(fd, data, offset):
+        # After the file is closed, fd is invalid or belongs to another file.
+        try:
+            same = os.fstat(fd).st_ino == os.stat(path).st_ino
+        except OSError:
+            same = False
+        if not same:
+            stray_writes.append(offset)
+            return
+        return pwrite(fd, data, offset)
+    monkeypatch.setattr(asynchttp, "pwrite", checked_pwrite)
+
+    async def download(url):
+        async with asynchttp.Client() as client:
+            try:
+                await asynchttp.download_multiple_connections(client, url, path, len(DATA), connections=4)
+            except asynchttp.HTTPError:
+                with open(str(tmp_path / "other.dat"), 'wb'):
+                    await asyncio.sleep(0.5)  # The other segments would still be arriving.
+                return
+            assert False, "should have failed"
+
+    with LocalServer({"/big.dat": DATA}) as server:
+        server.delay = lambda handler, start: 0.01
+        server.fail = lambda handler: 503 if handler.headers.get("Range", "").startswith("bytes=2097152-") else None
+        asyncio.run(download(server.url("/big.dat")))
+    assert stray_writes == []
+    assert os.path.getsize(str(tmp_path / "other.dat")) == 0
+
+
+def test_probe_without_ranges(monkeypatch):
+    reads = []
+    iter_content = asynchttp.Response.iter_content
+
+    def recorded_iter_content(self, *args, **kwargs):
+        reads.append(self.status_code)
+        return iter_content(self, *args, **kwargs)
+    monkeypatch.setattr(asynchttp.Response, "iter_content", recorded_iter_content)
+
+    async def probe(url):
+        async with asynchttp.Client() as client:
+            return await asynchttp.probe(client, url)
+
+    with LocalServer({"/big.dat": DATA}) as server:
+        assert asyncio.run(probe(server.url("/big.dat"))) == (len(DATA), True)
+        assert reads == [206]
+    del reads[:]
+    with LocalServer({"/big.dat": DATA}, ranges=False) as server:
+        # The body isn't read (it's the whole file).
+        assert asyncio.run(probe(server.url("/big.dat"))) == (len(DATA), False)
+        assert reads == []
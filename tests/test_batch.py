@@ -0,0 +1,71 @@
+""" Batch download tests (see local_server.py for the HTTP server). """
+
+import collections
+import os
+import threading
+import time
+
+import requests
+
+from pytools import batch
+from local_server import LocalServer, random_data
+
+
+def test_priorities():
+    order = []
+    started = threading.Event()
+    added = threading.Event()
+    def download(url, path):
+        order.append(url)
+        if url.endswith("block"):
+            started.set()
+            added.wait()
+        return path
+
+    with batch.BatchDownloader(threads=1, download=download) as downloader:
+        downloader.add("http://a/block")  # Keeps the thread busy while the rest are added.
+        started.wait()
+        for i, priority in enumerate([0, 5, 1, 5, -1]):
+            assert downloader.add("http://a/{}".format(i), priority=priority)
+        assert not downloader.add("http://a/1", priority=100)
+        added.set()
+        results = list(downloader.results())
+    assert len(results) == 6 and all(r.error is None for r in results)
+    assert order == ["http://a/block", "http://a/1", "http://a/3", "http://a/2", "http://a/0", "http://a/4"]
+
+
+def test_per_host_limit():
+    lock = threading.Lock()
+    active = collections.Counter()
+    peak = collections.Counter()
+    def download(url, path):
+        host = url.split("/")[2]
+        with lock:
+            active[host] += 1
+            peak[host] = max(peak[host], active[host])
+        time.sleep(0.02)
+        with lock:
+            active[host] -= 1
+
+    urls = ["http://{}/{}".format(host, i) for i in range(10) for host in ("a", "b", "c")]
+    t = time.perf_counter()
+    results = list(batch.download_batch(urls, threads=9, per_host=2, download=download))
+    elapsed = time.perf_counter() - t
+    assert sorted(r.url for r in results) == sorted(urls)
+    assert peak == {"a": 2, "b": 2, "c": 2}
+    assert elapsed < 10 * 0.02 * 0.9 * 3  # The hosts are downloaded in parallel.
+
+
+def test_download_batch(tmp_path):
+    files = {"/{}.dat".format(i): random_data(5000, seed=i) for i in range(20)}
+    with LocalServer(files) as server:
+        urls = [server.url(path) for path in files] + [server.url("/missing")]
+        results = {r.url: r for r in batch.download_batch(urls + urls[:5], str(tmp_path), threads=4)}
+    assert len(results) == len(urls)
+    assert isinstance(results[urls[-1]].error, requests.HTTPError)
+    for path, data in files.items():
+        result = results[server.url(path)]
+        assert result.error is None and result.result == os.path.join(str(tmp_path), path[1:])
+        with open(result.result, 'rb') as f:
+            assert f.read() == data
+
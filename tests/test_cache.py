@@ -1,4 +1,8 @@
 from pytools import cache
+import asyncio
+import concurrent.futures
+import random
+import time
 
 
 def test_lru():
@@ -24,7 +28,290 @@ def test_lru():
     c[3] = 9  # 7, 8, 9
     print(c)
 
-    print(c.hits, c.misses)  # 2, 6
+    print(c.hits, c.misses)  # 1, 1
+
+def test_lru_stats():
+    evicted = []
+    c = cache.LRUcache(maxsize=3, getweight=len, window=4, sample_every=2,
+                       on_evict=lambda k, v: evicted.append(k))
+    for i in range(5):
+        c[i] = "x" * i
+    c[4] = "xxxx"
+    c.get(4)
+    c.get(0)
+    c.get(3)
+    c.get(1)
+    c.get(2)
+    stats = c.snapshot()
+    assert evicted == [0, 1]
+    assert (stats["inserts"], stats["overwrites"], stats["evictions"]) == (5, 1, 2)
+    assert (stats["lookups"], stats["hits"], stats["misses"]) == (5, 3, 2)
+    assert stats["window_hit_ratio"] == 0.5  # Last 4 lookups: miss, hit, miss, hit.
+    assert stats["histogram"] == {4: 2, 8: 1}
+    assert stats["weight"] == 9 and stats["entries"] == 3
+    assert stats["latency"]["get"]["samples"] + stats["latency"]["set"]["samples"] == 5
+
+    s = cache.ShardedLRUcache(maxsize=8, shards=2, window=10)
+    for i in range(10):
+        s[i] = i
+        s.get(i)
+    stats = s.snapshot()
+    assert (stats["entries"], stats["hits"], stats["evictions"]) == (8, 10, 2)
+    assert stats["window_hit_ratio"] == 1
+
+def test_lru_weight():
+    c = cache.LRUcache(maxweight=10, getweight=len)
+    c["a"] = "xxxx"
+    c["b"] = "xxxx"
+    c["c"] = "xx"
+    assert c.weight == 10
+    c["d"] = "x"  # evicts a
+    assert list(c) == ["b", "c", "d"] and c.weight == 7
+    c["c"] = "xxxxxx"  # heavier overwrite evicts b
+    assert sorted(c) == ["c", "d"] and c.weight == 7
+    try:
+        c["e"] = "x" * 11
+        assert False
+    except ValueError:
+        pass
+    del c["c"]
+    assert c.weight == 1
+
+def test_lru_ttl():
+    now = [0]
+    c = cache.LRUcache(ttl=10, timer=lambda: now[0])
+    c[1] = 1
+    c.set(2, 2, ttl=100)
+    c[3] = 3
+    now[0] = 5
+    assert c[1] == 1  # 2, 3, 1
+    now[0] = 10
+    assert 1 not in c and 3 not in c
+    assert list(c) == [2]
+    c[4] = 4
+    now[0] = 20
+    assert c.expire() == 0  # 2 is at the head and hasn't expired.
+    now[0] = 100
+    assert c.expire() == 2 and len(c) == 0
+
+def test_compact_lru():
+    rand = random.Random(0)
+    a = cache.LRUcache(maxsize=50)
+    b = cache.CompactLRUcache(maxsize=50)
+    for _ in range(20000):
+        key = rand.randrange(100)
+        op = rand.random()
+        if op < 0.4:
+            assert a.get(key) == b.get(key)
+        elif op < 0.9:
+            a[key] = b[key] = rand.random()
+        else:
+            assert a.pop(key, None) == b.pop(key, None)
+        assert len(a) == len(b)
+    assert dict(a) == dict(b)
+    assert (a.hits, a.misses) == (b.hits, b.misses)
+
+def test_policies():
+    for policy in cache.POLICIES:
+        c = cache.make_cache(policy, maxsize=100)
+        for i in range(1000):
+            c[i] = i
+            assert c[i] == i or i not in c
+        assert len(c) <= 100
+        assert all(c[k] == k for k in list(c))
+        key = next(iter(c))
+        del c[key]
+        assert key not in c
+
+def test_scan_resistance():
+    rand = random.Random(0)
+    hot = list(range(50))
+    trace = []
+    for i in range(20000):
+        trace.append(rand.choice(hot))
+        if i % 2:
+            trace.append("scan{}".format(i))  # Seen only once.
+    ratios = cache.replay_trace(trace, maxsize=100)
+    print(ratios)
+    assert ratios["tinylfu"] > ratios["lru"]
+    assert ratios["2q"] > ratios["lru"]
+
+def test_memoize_single_flight():
+    calls = []
+
+    @cache.memoize(maxsize=10)
+    def slow(x):
+        calls.append(x)
+        time.sleep(0.2)
+        return x * 2
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as ex:
+        results = list(ex.map(slow, [1] * 8 + [2] * 8))
+    assert results == [2] * 8 + [4] * 8
+    assert sorted(calls) == [1, 2]
+    assert slow(1) == 2 and len(calls) == 2
+    slow.cache_clear()
+    slow(1)
+    assert len(calls) == 3
+
+def test_memoize_exceptions():
+    calls = []
+
+    @cache.memoize(cache_exceptions=0.2, key=lambda x, **kw: x)
+    def fail(x, y=None):
+        calls.append(x)
+        raise ValueError(x)
+
+    for _ in range(3):
+        try:
+            fail(1, y=2)
+            assert False
+        except ValueError:
+            pass
+    assert len(calls) == 1
+    time.sleep(0.25)
+    try:
+        fail(1)
+    except ValueError:
+        pass
+    assert len(calls) == 2
+    fail.cache_invalidate(1)
+    try:
+        fail(1)
+    except ValueError:
+        pass
+    assert len(calls) == 3
+
+def test_memoize_async():
+    calls = []
+
+    @cache.memoize(policy="2q")
+    async def slow(x):
+        calls.append(x)
+        await asyncio.sleep(0.1)
+        return x
+
+    async def main():
+        return await asyncio.gather(*[slow(i % 2) for i in range(10)])
+
+    assert asyncio.run(main()) == [0, 1] * 5
+    assert sorted(calls) == [0, 1]
+
+def test_memoize_async_cancel():
+    calls = []
+
+    @cache.memoize()
+    async def slow(x):
+        calls.append(x)
+        await asyncio.sleep(0.1)
+        return x
+
+    async def main():
+        leader = asyncio.ensure_future(slow(1))
+        await asyncio.sleep(0)
+        followers = [asyncio.ensure_future(slow(1)) for _ in range(3)]
+        await asyncio.sleep(0.05)
+        leader.cancel()
+        return await asyncio.gather(*followers)
+
+    # One of the waiting calls takes over from the cancelled one.
+    assert asyncio.run(main()) == [1] * 3
+    assert calls == [1, 1]
+
+def test_tiered(tmp_path):
+    path = str(tmp_path / "cache.db")
+    c = cache.TieredCache(path, maxsize=2)
+    for i in range(5):
+        c[i] = str(i)
+    assert len(c.data) == 2 and len(c.disk) == 3
+    assert c[0] == "0" and c.disk_hits == 1  # Promoted, 2 is spilled.
+    assert 0 not in c.disk and 2 in c.disk
+    assert sorted(c) == list(range(5))
+    del c[1]
+    assert 1 not in c
+    c.close()
+
+    evicted = []
+    c = cache.TieredCache(path, maxsize=2, on_evict=lambda k, v: evicted.append(k))  # Warm restart.
+    assert dict(c) == {0: "0", 2: "2", 3: "3", 4: "4"}
+    evictions = c.evictions
+    c.close()  # Not evictions.
+    assert c.evictions == evictions and len(evicted) == evictions
+
+def test_disk_cache(tmp_path):
+    c = cache.DiskCache(str(tmp_path / "cache.db"), maxbytes=1000)
+    c["a"] = b"x" * 400
+    c["b"] = b"x" * 400
+    c["a"]  # b is now the least recently used.
+    c["c"] = b"x" * 400
+    assert sorted(c) == ["a", "c"] and c.size <= 1000
+    c.close()
+
+def check_linked_list(c):
+    """ Walk the linked list in both directions and compare it with the dict. """
+    keys = []
+    entry = c.head
+    while entry.next is not c.tail:
+        assert entry.next.prev is entry
+        entry = entry.next
+        keys.append(entry.key)
+        assert c.data[entry.key] is entry
+    assert c.tail.prev is entry
+    assert len(keys) == len(set(keys)) == len(c.data)
+    assert len(c) <= c.maxsize
+
+def test_sharded_lru():
+    c = cache.ShardedLRUcache(maxsize=10, shards=1)
+    for i in range(20):
+        c[i] = i
+    assert sorted(c) == list(range(10, 20))
+    c.get(10)
+    c[20] = 20
+    assert 10 in c and 11 not in c
+    assert c.setdefault(11, 0) == 0
+    assert c.pop(11) == 0
+    assert len(c) == 9
+
+def test_sharded_lru_stress():
+    c = cache.ShardedLRUcache(maxsize=64, shards=4)
+
+    def worker(seed):
+        rand = random.Random(seed)
+        for _ in range(20000):
+            key = rand.randrange(256)
+            op = rand.random()
+            if op < 0.5:
+                c.get(key)
+            elif op < 0.9:
+                c[key] = key
+            else:
+                c.pop(key, None)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as ex:
+        [f.result() for f in [ex.submit(worker, i) for i in range(8)]]
+
+    assert sum(shard.maxsize for shard in c.shards) == 64
+    for shard in c.shards:
+        check_linked_list(shard)
+    assert all(c[k] == k for k in list(c))
 
 if __name__ == "__main__":
-    test_lru()
\ No newline at end of file
+    test_lru()
+    test_lru_stats()
+    test_lru_weight()
+    test_lru_ttl()
+    test_compact_lru()
+    test_policies()
+    test_scan_resistance()
+    test_memoize_single_flight()
+    test_memoize_exceptions()
+    test_memoize_async()
+    test_memoize_async_cancel()
+    test_sharded_lru()
+    test_sharded_lru_stress()
+
+    import pathlib
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        test_tiered(pathlib.Path(tmp))
+        test_disk_cache(pathlib.Path(tmp))
\ No newline at end of file
@@ -0,0 +1,311 @@
+""" Download tests against a local HTTP server (see local_server.py). """
+
+import hashlib
+import os
+import time
+
+import requests
+
+from pytools import httptools
+from local_server import LocalServer, random_data
+
+DATA = random_data(3 * 2 ** 20 + 12345)
+SMALL = random_data(1000, seed=1)
+
+
+def check(path, data=DATA):
+    with open(path, 'rb') as f:
+        assert hashlib.md5(f.read()).digest() == hashlib.md5(data).digest()
+
+
+def test_download(tmp_path):
+    with LocalServer({"/file.dat": DATA}) as server:
+        url = server.url("/file.dat")
+        assert httptools.range_download_available(url)
+        assert httptools.get_content_length(url) == len(DATA)
+        check(httptools.download_basic(url, dir_path=str(tmp_path), file_name="basic", with_progress=False))
+        check(httptools.download_multiple_connections(url, str(tmp_path), file_name="multi", connections=4))
+        check(httptools.download_multiple_connections(url, str(tmp_path), file_name="parts", connections=4,
+                                                      preallocate=False))
+        assert not [name for name in os.listdir(str(tmp_path)) if ".part" in name]
+        check(httptools.download_url(url, str(tmp_path)))
+
+
+def test_download_tiny(tmp_path):
+    with LocalServer({"/tiny": b"abc"}) as server:
+        check(httptools.download_multiple_connections(server.url("/tiny"), str(tmp_path), connections=5), b"abc")
+
+
+def test_segment_scheduler():
+    scheduler = httptools.SegmentScheduler([[0, 100], [200, 300]], connections=2, segment_size=50, min_split=10)
+    assert [(s.start, s.end) for s in scheduler.pending] == [(0, 50), (50, 100), (200, 250), (250, 300)]
+    segments = [scheduler.next() for _ in range(2)]
+    scheduler.done(segments[1])  # Didn't download anything, so it's requeued.
+    assert len(scheduler.pending) == 3
+    scheduler.pending.clear()  # Pretend the rest was downloaded.
+    assert scheduler.claim(segments[0], 10) == 10
+    stolen = scheduler.next()  # Steals half of what remains of segments[0].
+    assert (stolen.start, stolen.end) == (30, 50) and segments[0].end == 30
+    assert scheduler.claim(segments[0], 30) == 20  # Only up to the split.
+    assert scheduler.splits == 1
+
+
+def test_work_stealing(tmp_path):
+    with LocalServer({"/file.dat": DATA}) as server:
+        url = server.url("/file.dat")
+        # The connection that downloads the start of the file is slow (~4 s without splits).
+        server.delay = lambda handler, start: 0.3 if start == 0 else 0
+        for preallocate in (True, False):
+            t = time.time()
+            check(httptools.download_multiple_connections(url, str(tmp_path), connections=4, 
+                                                          preallocate=preallocate))
+            assert time.time() - t < 3
+            assert not [name for name in os.listdir(str(tmp_path)) if ".part" in name]
+        check(httptools.download_multiple_connections(url, str(tmp_path), connections=4, adaptive=True))
+
+
+def test_resume_multiple_connections(tmp_path):
+    with LocalServer({"/file.dat": DATA}) as server:
+        url = server.url("/file.dat")
+        server.drop = lambda handler, start: 2 ** 18 if start > 0 else None
+        try:
+            httptools.download_multiple_connections(url, str(tmp_path), connections=4)
+            assert False
+        except requests.RequestException:
+            pass
+        path = os.path.join(str(tmp_path), "file.dat")
+        state = httptools.RangeJournal.read(path)
+        assert state and state["done"]
+
+        server.drop = None
+        del server.requests[:]
+        # The completed ranges are hashed from the file.
+        path, digests = httptools.download_multiple_connections(url, str(tmp_path), connections=4, 
+                                                                hash_algorithms=["sha256"])
+        check(path)
+        assert digests == {"sha256": hashlib.sha256(DATA).hexdigest()}
+        assert not os.path.exists(path + ".journal")
+        # Only the missing ranges were requested.
+        for method, _, headers in server.requests:
+            if method == "GET":
+                first, last = headers["Range"][len("bytes="):].split("-")
+                assert not any(start <= int(first) < end for start, end in state["done"])
+
+
+def test_resume_basic(tmp_path):
+    with LocalServer({"/file.dat": DATA}) as server:
+        url = server.url("/file.dat")
+        server.drop = lambda handler, start: 2 ** 20
+        try:
+            httptools.download_basic(url, dir_path=str(tmp_path), with_progress=False)
+            assert False
+        except requests.RequestException:
+            pass
+        path = os.path.join(str(tmp_path), "file.dat")
+        size = os.path.getsize(path)
+        assert 0 < size < len(DATA)
+
+        server.drop = None
+        check(httptools.download_basic(url, dir_path=str(tmp_path), with_progress=False, 
+                                       expected_hash={"md5": hashlib.md5(DATA).hexdigest()}))
+        assert server.requests[-1][2]["Range"] == "bytes={}-".format(size)
+        assert not os.path.exists(path + ".journal")
+
+        # The file changed on the server, so start over.
+        with open(path, 'r+b') as f:
+            f.write(bytes(size))
+            f.truncate(size)
+        httptools.RangeJournal(path, url, etag='"old"')._save()
+        check(httptools.download_basic(url, dir_path=str(tmp_path), with_progress=False))
+
+
+def test_stream_hasher(tmp_path):
+    path = str(tmp_path / "data")
+    with open(path, 'wb') as f:
+        f.write(DATA)
+    hasher = httptools.StreamHasher(["md5", "sha1"], path=path, done=[[0, 100]])
+    hasher.update(2 ** 20, DATA[2 ** 20:])  # Ahead, read from the file later.
+    hasher.update(50, DATA[50:2 ** 20])  # Overlaps the done range.
+    assert hasher.pos == len(DATA)
+    assert hasher.hexdigests() == {"md5": hashlib.md5(DATA).hexdigest(), "sha1": hashlib.sha1(DATA).hexdigest()}
+
+
+def test_checksum(tmp_path):
+    expected = {"sha256": hashlib.sha256(DATA).hexdigest()}
+    with LocalServer({"/file.dat": DATA}) as server:
+        url = server.url("/file.dat")
+        for kwargs in ({"connections": 4, "preallocate": True}, {"connections": 4, "preallocate": False},
+                       {"connections": 1}):
+            path, digests = httptools.download_url(url, str(tmp_path), with_progress=False, expected_hash=expected,
+                                                   hash_algorithms=["md5", "sha256"], **kwargs)
+            check(path)
+            assert digests == {"md5": hashlib.md5(DATA).hexdigest(), "sha256": expected["sha256"]}
+
+        try:
+            httptools.download_url(url, str(tmp_path), with_progress=False, expected_hash={"md5": "0" * 32})
+            assert False
+        except httptools.ChecksumError as e:
+            assert e.actual == hashlib.md5(DATA).hexdigest()
+        assert not os.path.exists(path)
+
+
+def test_probe(tmp_path):
+    with LocalServer({"/file.dat": DATA}) as server:
+        server.redirects["/link"] = "/file.dat"
+        headers = {"X-Test": "1"}
+        info = httptools.probe_url(server.url("/link"), headers=headers)
+        assert headers == {"X-Test": "1"}
+        assert info.url == server.url("/file.dat")
+        assert info.length == len(DATA) and info.ranges and info.etag and info.last_modified
+        assert len(server.requests) == 2  # The redirect and the range request.
+
+        assert httptools.probe_url(server.url("/link"), headers={"X-Test": "1"}) is info  # Cached.
+        assert httptools.probe_url(server.url("/link"), headers={"X-Test": "2"}) is not info
+        # Other requests arguments (even unhashable ones) are part of the key.
+        cookies = httptools.probe_url(server.url("/link"), cookies={"c": "1"}, proxies={})
+        assert cookies is not info and cookies.length == len(DATA)
+        assert httptools.probe_url(server.url("/link"), proxies={}, cookies={"c": "1"}) is cookies
+        assert httptools.get_content_length(server.url("/link"), cookies={"c": "2"}) == len(DATA)
+        assert hash(httptools._probe_key(server.url("/link"), params={"a": [1, 2]}))
+        del server.requests[:]
+
+        httptools.download_url(server.url("/link"), str(tmp_path), file_name="file.dat", with_progress=False,
+                               headers=headers)
+        check(os.path.join(str(tmp_path), "file.dat"))
+        # No probing and the segments go straight to the final url.
+        assert all(method == "GET" and path == "/file.dat" for method, path, _ in server.requests)
+
+
+def test_file_changed(tmp_path):
+    httptools.probe_url.cache_clear()
+    changed = random_data(4 * 2 ** 20, seed=2)
+    with LocalServer({"/file.dat": DATA}) as server:
+        url = server.url("/file.dat")
+        check(httptools.download_url(url, str(tmp_path), with_progress=False))
+        # Within PROBE_TTL, so the cached probe is of the old file.
+        server.files["/file.dat"] = changed
+        check(httptools.download_url(url, str(tmp_path), with_progress=False), changed)
+
+        # The journal of an interrupted download matches the stale probe too.
+        server.files["/file.dat"] = DATA
+        httptools.probe_url.cache_clear()
+        server.drop = lambda handler, start: 2 ** 18 if start > 0 else None
+        try:
+            httptools.download_multiple_connections(url, str(tmp_path), connections=4)
+            assert False
+        except requests.RequestException:
+            pass
+        server.drop = None
+        server.files["/file.dat"] = changed
+        try:
+            httptools.download_multiple_connections(url, str(tmp_path), connections=4)
+            assert False
+        except httptools.FileChangedError:
+            pass
+        check(httptools.download_multiple_connections(url, str(tmp_path), connections=4), changed)
+
+
+def test_http_cache(tmp_path):
+    page = b"<html><body><p id='a'>\xc5\xa1</p></body></html>"
+    http_cache = httptools.HTTPCache(str(tmp_path / "http.db"))
+    with LocalServer({"/page.html": page, "/file.dat": DATA}) as server:
+        for from_cache in (False, True):
+            r = http_cache.get(server.url("/page.html"))
+            assert r.from_cache == from_cache and r.content == page
+        assert "If-None-Match" in server.requests[-1][2]
+        element = httptools.get_html_element(server.url("/page.html"), http_cache=http_cache)
+        assert element.get_element_by_id("a").text == "\u0161"
+
+        url = server.url("/file.dat")
+        path = httptools.download_url(url, str(tmp_path), with_progress=False, http_cache=http_cache)
+        mtime = os.stat(path).st_mtime_ns
+        del server.requests[:]
+        assert httptools.download_url(url, str(tmp_path), with_progress=False, http_cache=http_cache) == path
+        assert len(server.requests) == 1  # 304
+        assert os.stat(path).st_mtime_ns == mtime
+
+        server.files["/file.dat"] = SMALL
+        check(httptools.download_url(url, str(tmp_path), with_progress=False, http_cache=http_cache), SMALL)
+    http_cache.close()
+
+
+def make_page(items, filler=0):
+    rows = "".join("<li class='item' data-id='{0}'>item {0}</li>".format(i) for i in range(items))
+    return "<html><head><title>Test</title></head><body><ul>{}</ul><div>{}</div></body></html>".format(
+        rows, "<p>filler</p>" * filler).encode()
+
+
+def test_parse_html():
+    page = make_page(10, filler=200000)  # About 3 MiB.
+    with LocalServer({"/page.html": page}) as server:
+        url = server.url("/page.html")
+        server.delay = lambda handler, start: 0.02  # 1 s for the whole page.
+        t = time.perf_counter()
+        root = httptools.parse_html(url, until="//li[last()]")
+        assert time.perf_counter() - t < 0.5  # Stopped early.
+        assert [li.text_content() for li in root.xpath("//li")][-1] == "item 9"
+
+        t = time.perf_counter()
+        results = httptools.scrape(url, {"title": "//title", "id": "//li[3]/@data-id"}, first=True)
+        assert time.perf_counter() - t < 0.5
+        assert results["title"] == "Test" and results["id"] == "2"
+
+        server.delay = None
+        results = httptools.scrape(url, {"items": "//li[@class='item']/text()", "p": "count(//p)"})
+        assert results == {"items": ["item {}".format(i) for i in range(10)], "p": 200000}
+
+
+def test_scrape_urls():
+    files = {"/{}.html".format(i): make_page(i + 1) for i in range(20)}
+    with LocalServer(files) as server:
+        urls = [server.url(path) for path in files] + [server.url("/missing")]
+        results = httptools.scrape_urls(urls, {"last": "//li[last()]"}, first=True, threads=4)
+    assert [r["last"] for r in results[:-1]] == ["item {}".format(i) for i in range(20)]
+    assert isinstance(results[-1], requests.HTTPError)
+
+
+def requested_bytes(server):
+    total = 0
+    for method, _, headers in server.requests:
+        first, last = headers["Range"][len("bytes="):].split("-")
+        total += int(last) - int(first) + 1 if method == "GET" and last != "0" else 0
+    return total
+
+
+def test_mirrors(tmp_path):
+    with LocalServer({"/file.dat": DATA}) as fast, LocalServer({"/file.dat": DATA}) as slow, \
+            LocalServer({"/file.dat": DATA}) as broken, LocalServer({"/file.dat": SMALL}) as other:
+        slow.delay = lambda handler, start: 0.05  # About 1.3 MB/s.
+        broken.drop = lambda handler, start: 0 if handler.headers["Range"] != "bytes=0-0" else None
+        mirrors = [slow.url("/file.dat"), broken.url("/file.dat"), other.url("/file.dat")]
+        t = time.perf_counter()
+        check(httptools.download_url(fast.url("/file.dat"), str(tmp_path), connections=4, segment_size=2 ** 18,
+                                     with_progress=False, mirrors=mirrors))
+        assert time.perf_counter() - t < 2  # The slow mirror alone would take 2.5 s.
+        assert len(other.requests) == 1  # Only probed (different length).
+        assert len(broken.requests) <= 1 + 4  # Dropped after failing.
+        assert requested_bytes(fast) > requested_bytes(slow) > 0
+
+
+def test_download_no_ranges(tmp_path):
+    with LocalServer({"/file.dat": DATA}, ranges=False) as server:
+        url = server.url("/file.dat")
+        assert not httptools.range_download_available(url)
+        check(httptools.download_url(url, str(tmp_path), with_progress=False))
+
+
+def test_session_reuse(tmp_path):
+    files = {"/{}.dat".format(i): SMALL for i in range(30)}
+    with LocalServer(files) as server:
+        session = httptools.create_session(pool_size=4)
+        urls = [server.url(path) for path in files]
+        for url in urls[:10]:
+            httptools.download_basic(url, dir_path=str(tmp_path), with_progress=False, session=session)
+        assert server.connections == 1  # Kept alive.
+
+        connections = server.connections
+        httptools.download_urls(urls, [str(tmp_path)] * len(urls), threads=4, connections=2,
+                                with_progress=False)
+        assert server.connections - connections <= 4 * 2
+    for path in files:
+        check(os.path.join(str(tmp_path), path[1:]), SMALL)
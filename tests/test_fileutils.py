@@ -0,0 +1,85 @@
+""" Tests of filetools.fileutils. """
+
+import concurrent.futures
+import os
+
+from pytools import filetools as ft
+from pytools.filetools import fileutils
+
+
+def make_parts(tmp_path, count=4):
+    parts = []
+    for i in range(count):
+        path = tmp_path / "file.part{}".format(i)
+        path.write_bytes(os.urandom(i * 300007 + 5))
+        parts.append(str(path))
+    return parts
+
+
+def read_all(paths):
+    data = b""
+    for path in paths:
+        with open(path, 'rb') as f:
+            data += f.read()
+    return data
+
+
+def test_join_files(tmp_path):
+    parts = make_parts(tmp_path)
+    expected = read_all(parts)
+    out = str(tmp_path / "file")
+    assert ft.join_files(out, parts) == out
+    assert read_all([out]) == expected
+    ft.join_files(out, parts[0], *parts[1:])
+    assert read_all([out]) == expected
+    ft.join_files(out, parts[:1], out_mode='ab')
+    assert read_all([out]) == expected + read_all(parts[:1])
+
+
+def test_join_files_move_first(tmp_path):
+    parts = make_parts(tmp_path)
+    expected = read_all(parts)
+    inode = os.stat(parts[0]).st_ino
+    out = str(tmp_path / "file")
+    ft.join_files(out, parts, move_first=True)
+    assert read_all([out]) == expected
+    assert os.stat(out).st_ino == inode
+    assert not os.path.exists(parts[0])
+
+
+def test_join_files_fallback(tmp_path, monkeypatch):
+    def unsupported(src_fd, dst_fd, count):
+        raise OSError(fileutils.errno.EXDEV, "Cross-device link")
+
+    def partial(src_fd, dst_fd, count):
+        return os.write(dst_fd, os.read(src_fd, min(count, 1000)))
+
+    parts = make_parts(tmp_path)
+    expected = read_all(parts)
+    out = str(tmp_path / "file")
+    for copies in ([], [unsupported], [partial], [unsupported, partial]):
+        monkeypatch.setattr(fileutils, "_KERNEL_COPIES", copies)
+        ft.join_files(out, parts)
+        assert read_all([out]) == expected
+
+
+def test_join_text_files(tmp_path):
+    paths = []
+    for i in range(3):
+        path = tmp_path / "{}.txt".format(i)
+        path.write_text("line {}\n".format(i))
+        paths.append(str(path))
+    out = str(tmp_path / "out.txt")
+    ft.join_files(out, paths, out_mode='w', in_mode='r')
+    assert (tmp_path / "out.txt").read_text() == "line 0\nline 1\nline 2\n"
+
+
+def test_link_file_concurrent(tmp_path):
+    src = tmp_path / "src.dat"
+    src.write_bytes(os.urandom(2 ** 20))
+    dst = str(tmp_path / "dst.dat")
+    for modes in (("hard",), ("copy",)):
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            assert set(executor.map(lambda _: ft.link_file(str(src), dst, modes), range(32))) == set(modes)
+        assert open(dst, 'rb').read() == src.read_bytes()
+    assert sorted(os.listdir(str(tmp_path))) == ["dst.dat", "src.dat"]
@@ -0,0 +1,109 @@
+""" Tests of filetools.hashing. """
+
+import hashlib
+import os
+
+from pytools import filetools as ft
+from pytools.filetools import hashing
+
+
+def make_files(tmp_path, count=20):
+    files = {}
+    for i in range(count):
+        path = tmp_path / "dir{}".format(i % 3) / "file{}.dat".format(i)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        data = os.urandom(i * 100003)
+        path.write_bytes(data)
+        files[str(path)] = data
+    return files
+
+
+def test_hash_file(tmp_path):
+    data = os.urandom(3 * hashing.BUFFER_SIZE + 17)
+    path = tmp_path / "file.dat"
+    path.write_bytes(data)
+    algorithms = ["md5", "sha1", "sha256", "blake2b"]
+    assert ft.hash_file(str(path), algorithms) == {name: hashlib.new(name, data).hexdigest() for name in algorithms}
+    assert ft.hash_file(str(path), ["sha256"], buffer_size=4096) == {"sha256": hashlib.sha256(data).hexdigest()}
+    assert ft.md5sum(str(path)) == hashlib.md5(data).hexdigest()
+    assert ft.md5sum(str(tmp_path)) is None
+
+
+def test_hash_files(tmp_path):
+    files = make_files(tmp_path)
+    results = dict(ft.hash_files(files, ["md5", "sha256"], threads=4))
+    assert results == {path: {"md5": hashlib.md5(data).hexdigest(), "sha256": hashlib.sha256(data).hexdigest()}
+                       for path, data in files.items()}
+    assert dict(ft.hash_dir(str(tmp_path), ["md5"], threads=2)).keys() == files.keys()
+
+
+def test_hash_files_errors(tmp_path):
+    files = make_files(tmp_path, count=3)
+    missing = str(tmp_path / "missing")
+    results = dict(ft.hash_files(iter(list(files) + [missing, str(tmp_path)])))
+    assert isinstance(results.pop(missing), FileNotFoundError)
+    assert isinstance(results.pop(str(tmp_path)), OSError)
+    assert results.keys() == files.keys()
+
+
+def age(files, seconds=60):
+    """ Make the files old enough to be cached (see hashing.RACY_WINDOW). """
+    for path in files:
+        st = os.stat(path)
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns - seconds * 10 ** 9))
+
+
+def test_checksum_index(tmp_path, monkeypatch):
+    files = make_files(tmp_path / "tree")
+    age(files)
+    db = str(tmp_path / "index.sqlite")
+    expected = {path: {"md5": hashlib.md5(data).hexdigest(), "sha256": hashlib.sha256(data).hexdigest()}
+                for path, data in files.items()}
+    with ft.ChecksumIndex(db, ["md5", "sha256"]) as index:
+        assert dict(index.hash_dir(str(tmp_path / "tree"))) == expected
+        assert len(index) == len(files)
+
+    hashed = []
+    original = hashing.hash_file
+    monkeypatch.setattr(hashing, "hash_file", lambda path, *args: hashed.append(path) or original(path, *args))
+    with ft.ChecksumIndex(db, ["md5", "sha256"]) as index:
+        # Unchanged files aren't read again.
+        assert dict(index.hash_dir(str(tmp_path / "tree"))) == expected
+        assert hashed == []
+
+        changed, removed = sorted(files)[1:3]
+        with open(changed, 'ab') as f:
+            f.write(b"more")
+        age([changed])
+        os.remove(removed)
+        results = dict(index.hash_dir(str(tmp_path / "tree")))
+        assert hashed == [changed]
+        assert results[changed]["md5"] == hashlib.md5(files[changed] + b"more").hexdigest()
+        assert removed not in results
+        assert len(index) == len(files) - 1
+        assert index.digests(changed) == results[changed]
+        assert hashed == [changed]
+
+        # A file that was just modified isn't cached, since it could still change within the same mtime.
+        new = str(tmp_path / "tree" / "new.dat")
+        with open(new, 'wb') as f:
+            f.write(b"new")
+        index.digests(new)
+        assert index.get(new) is None
+
+    # Other algorithms start over.
+    with ft.ChecksumIndex(db, ["sha1"]) as index:
+        assert len(index) == 0
+
+
+def test_checksum_index_prune(tmp_path):
+    files = make_files(tmp_path / "tree")
+    age(files)
+    with ft.ChecksumIndex(str(tmp_path / "index.sqlite")) as index:
+        assert len(dict(index.hash_files(files))) == len(files)
+        ft.remove_dir(str(tmp_path / "tree" / "dir0"))
+        remaining = [path for path in files if os.path.exists(path)]
+        assert index.prune() == len(files) - len(remaining)
+        assert len(index) == len(remaining)
+        index.compact()
+        assert all(index.get(path) for path in remaining)
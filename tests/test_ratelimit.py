@@ -0,0 +1,68 @@
+""" Rate limiter tests (the download tests use a local HTTP server, see local_server.py). """
+
+import os
+import time
+
+from pytools import httptools, ratelimit
+from local_server import LocalServer, random_data
+
+DATA = random_data(3 * 2 ** 20)
+
+
+class FakeTimer:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_token_bucket():
+    timer = FakeTimer()
+    bucket = ratelimit.TokenBucket(100, burst=10, timer=timer)
+    assert bucket.reserve(10) == 0
+    assert bucket.reserve(50) == 0.5  # In debt.
+    assert bucket.reserve(50) == 1.0  # Queued behind the previous reservation.
+    timer.now = 10
+    assert bucket.reserve(5) == 0  # Refilled up to the burst.
+    assert bucket.tokens == 5
+
+
+def test_limiter_hosts():
+    timer = FakeTimer()
+    limiter = ratelimit.RateLimiter(requests_per_second=10, host_requests_per_second=1, burst=1, timer=timer)
+    assert limiter.reserve("http://a.com/1", requests=1) == 0
+    assert limiter.reserve("http://A.com/2", requests=1) == 1  # Same host.
+    assert limiter.reserve("http://b.com/1", requests=1) == 0
+    assert ratelimit.RateLimiter().reserve("http://a.com", size=10 ** 9, requests=100) == 0
+
+
+def test_download_rate(tmp_path):
+    rate = 4 * 2 ** 20
+    with LocalServer({"/data.dat": DATA}) as server:
+        for kwargs in ({"connections": 4}, {"connections": 1, "preallocate": False}):
+            limiter = ratelimit.RateLimiter(bytes_per_second=rate)
+            t = time.perf_counter()
+            path = httptools.download_multiple_connections(server.url("/data.dat"), str(tmp_path),
+                                                           limiter=limiter, **kwargs)
+            elapsed = time.perf_counter() - t
+            # The burst (1/4 s) is free, the rest is throttled.
+            assert elapsed >= (len(DATA) - rate * 0.25) / rate * 0.9
+            with open(path, 'rb') as f:
+                assert f.read() == DATA
+            os.remove(path)
+
+
+def test_request_rate(tmp_path):
+    files = {"/{}.dat".format(i): b"x" * 100 for i in range(10)}
+    with LocalServer(files, ranges=False) as server:
+        limiter = ratelimit.RateLimiter(host_requests_per_second=40)
+        t = time.perf_counter()
+        httptools.download_urls([server.url(path) for path in files], [str(tmp_path)] * len(files), threads=4,
+                                with_progress=False, limiter=limiter)
+        elapsed = time.perf_counter() - t
+        requests = len(server.requests)
+    assert requests >= 20  # At least a probe and a GET per file.
+    assert elapsed >= (requests - 10) / 40 * 0.9
+    for path in files:
+        assert os.path.isfile(os.path.join(str(tmp_path), path[1:]))
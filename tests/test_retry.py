@@ -0,0 +1,117 @@
+""" Retry tests against a local HTTP server that drops connections (see local_server.py). """
+
+import requests
+
+from pytools import httptools
+from local_server import LocalServer, random_data
+
+DATA = random_data(3 * 2 ** 20 + 12345)
+RETRY = httptools.RetryPolicy(attempts=3, backoff=0.01)
+
+
+def check(path):
+    with open(path, 'rb') as f:
+        assert f.read() == DATA
+
+
+def get_ranges(server):
+    return [headers.get("Range") for method, _, headers in server.requests if method == "GET"]
+
+
+def test_retry_policy():
+    retry = httptools.RetryPolicy(backoff=1, max_backoff=4, jitter=False)
+    assert [retry.delay(attempt) for attempt in range(5)] == [1, 2, 4, 4, 4]
+    retry = httptools.RetryPolicy(backoff=1, max_backoff=4)
+    assert all(0 <= retry.delay(3) <= 4 for _ in range(100))
+    assert retry.retryable(requests.ConnectionError())
+    assert not retry.retryable(ValueError())
+    response = requests.Response()
+    response.status_code = 503
+    assert retry.retryable(requests.HTTPError(response=response))
+    response.status_code = 404
+    assert not retry.retryable(requests.HTTPError(response=response))
+
+
+def test_retry_basic(tmp_path):
+    with LocalServer({"/file.dat": DATA}) as server:
+        # Every response is cut off after 1 MiB.
+        server.drop = lambda handler, start: 2 ** 20
+        path = httptools.download_basic(server.url("/file.dat"), dir_path=str(tmp_path), with_progress=False,
+                                        resume=False, retry=RETRY)
+        check(path)
+        # Continued from where the previous response broke off.
+        assert get_ranges(server) == ["bytes=0-0", None, "bytes=1048576-", "bytes=2097152-", "bytes=3145728-"]
+
+
+def test_retry_basic_gives_up(tmp_path):
+    with LocalServer({"/file.dat": DATA}) as server:
+        server.drop = lambda handler, start: 0 if start > 0 else 2 ** 20
+        try:
+            httptools.download_basic(server.url("/file.dat"), dir_path=str(tmp_path), with_progress=False,
+                                     resume=False, retry=RETRY)
+            assert False
+        except requests.RequestException:
+            pass
+        assert get_ranges(server).count("bytes=1048576-") == RETRY.attempts - 1
+
+
+def test_retry_multiple_connections(tmp_path):
+    with LocalServer({"/file.dat": DATA}) as server:
+        server.drop = lambda handler, start: 2 ** 18
+        check(httptools.download_multiple_connections(server.url("/file.dat"), str(tmp_path), connections=4,
+                                                      retry=RETRY))
+        # Every range starts at a byte that hadn't been received yet.
+        starts = [int(r[len("bytes="):].split("-")[0]) for r in get_ranges(server)[1:]]
+        assert len(starts) == len(set(starts))
+
+
+def test_retry_part_files(tmp_path):
+    for first in (True, False):
+        failed = set()
+
+        def fail(handler):
+            # Each range fails once before any byte is sent (only the first one or all but the first).
+            range_header = handler.headers.get("Range")
+            if range_header in failed or range_header == "bytes=0-0" or \
+                    range_header.startswith("bytes=0-") != first:
+                return None
+            failed.add(range_header)
+            return 503
+        with LocalServer({"/file.dat": DATA}) as server:
+            server.fail = fail
+            path = httptools.download_multiple_connections(server.url("/file.dat"), str(tmp_path), connections=4,
+                                                           preallocate=False, retry=RETRY)
+            check(path)
+            assert failed
+            assert not [p for p in tmp_path.iterdir() if ".part" in p.name]
+
+
+def test_retry_byte_range(tmp_path):
+    with LocalServer({"/file.dat": DATA}) as server:
+        server.drop = lambda handler, start: 2 ** 18
+        path = str(tmp_path / "range")
+        httptools.download_byte_range(server.url("/file.dat"), path, 1000, 2 ** 20, retry=RETRY)
+        with open(path, 'rb') as f:
+            assert f.read() == DATA[1000:2 ** 20 + 1]
+        assert get_ranges(server) == ["bytes=1000-1048576", "bytes=263144-1048576",
+                                      "bytes=525288-1048576", "bytes=787432-1048576"]
+
+
+def test_retry_statuses(tmp_path):
+    failures = []
+    def fail(handler):
+        if len(failures) < 2:
+            failures.append(handler.path)
+            return 503
+    with LocalServer({"/file.dat": DATA}) as server:
+        server.fail = fail
+        path = httptools.download_url(server.url("/file.dat"), str(tmp_path), with_progress=False, retry=RETRY)
+        check(path)
+        assert len(failures) == 2
+
+        server.fail = lambda handler: 503
+        try:
+            httptools.download_url(server.url("/other.dat"), str(tmp_path), with_progress=False, retry=RETRY)
+            assert False
+        except requests.HTTPError as e:
+            assert e.response.status_code == 503
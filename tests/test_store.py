@@ -0,0 +1,125 @@
+""" DownloadStore tests against a local HTTP server (see local_server.py). """
+
+import concurrent.futures
+import hashlib
+import os
+
+from pytools import httptools
+from pytools.store import DownloadStore
+from local_server import LocalServer, random_data
+
+DATA = random_data(3 * 2 ** 20 + 12345)
+SHA256 = hashlib.sha256(DATA).hexdigest()
+
+
+def check(path, data=DATA):
+    with open(path, 'rb') as f:
+        assert f.read() == data
+
+
+def transfers(server):
+    """ GET requests other than probes. """
+    return [headers.get("Range") for method, path, headers in server.requests
+            if method == "GET" and headers.get("Range") != "bytes=0-0"]
+
+
+def requested_bytes(server):
+    ranges = [r[len("bytes="):].split("-") for r in transfers(server)]
+    return sum(int(end) - int(start) + 1 for start, end in ranges)
+
+
+def objects(store):
+    return [name for _, _, files in os.walk(os.path.join(store.root, "objects")) for name in files]
+
+
+def test_store(tmp_path):
+    httptools.probe_url.cache_clear()
+    files = {"/file.dat": DATA, "/copy.dat": DATA}
+    with LocalServer(files) as server, DownloadStore(str(tmp_path / "store")) as store:
+        first = httptools.download_url(server.url("/file.dat"), str(tmp_path), store=store)
+        check(first)
+        assert objects(store) == [SHA256]
+        assert transfers(server)
+
+        del server.requests[:]
+        (tmp_path / "other").mkdir()
+        path, digests = httptools.download_url(server.url("/file.dat"), str(tmp_path / "other"), store=store,
+                                               hash_algorithms=["sha256", "md5"])
+        check(path)
+        assert digests == {"sha256": SHA256, "md5": hashlib.md5(DATA).hexdigest()}
+        assert transfers(server) == []
+        assert os.path.samefile(first, path) or os.stat(first).st_nlink == 1  # Hard link or reflink.
+
+        # The same bytes from another url are only stored once.
+        path = httptools.download_url(server.url("/copy.dat"), str(tmp_path), store=store)
+        check(path)
+        assert objects(store) == [SHA256]
+
+        # A changed file (new ETag) is downloaded again.
+        del server.requests[:]
+        httptools.probe_url.cache_clear()
+        server.files["/file.dat"] = DATA[::-1]
+        path = httptools.download_url(server.url("/file.dat"), str(tmp_path), store=store)
+        check(path, DATA[::-1])
+        assert transfers(server)
+        assert len(objects(store)) == 2
+
+
+def test_store_inflight(tmp_path):
+    httptools.probe_url.cache_clear()
+    with LocalServer({"/file.dat": DATA}) as server, DownloadStore(str(tmp_path / "store")) as store:
+        server.delay = lambda handler, start: 0.01
+        dirs = [tmp_path / str(i) for i in range(4)]
+        [d.mkdir() for d in dirs]
+        with concurrent.futures.ThreadPoolExecutor(4) as executor:
+            paths = list(executor.map(lambda d: store.download(server.url("/file.dat"), str(d), connections=1),
+                                      dirs))
+        [check(path) for path in paths]
+        assert requested_bytes(server) == len(DATA)
+
+
+def test_store_checksum(tmp_path):
+    httptools.probe_url.cache_clear()
+    with LocalServer({"/file.dat": DATA}) as server, DownloadStore(str(tmp_path / "store")) as store:
+        try:
+            store.download(server.url("/file.dat"), str(tmp_path), expected_hash={"sha256": "0" * 64})
+            assert False, "should have failed"
+        except httptools.ChecksumError:
+            pass
+        assert not os.path.exists(httptools.path_from_url(str(tmp_path), server.url("/file.dat")))
+        assert objects(store) == [SHA256]
+
+
+def test_store_then_plain_download(tmp_path):
+    httptools.probe_url.cache_clear()
+    changed = random_data(len(DATA), seed=3)
+    with LocalServer({"/file.dat": DATA}) as server, DownloadStore(str(tmp_path / "store")) as store:
+        url = server.url("/file.dat")
+        first = httptools.download_url(url, str(tmp_path), store=store)
+        # Downloads without the store replace the linked file instead of writing into the object.
+        server.files["/file.dat"] = changed
+        check(httptools.download_url(url, str(tmp_path), with_progress=False), changed)
+        check(store.object_path(SHA256))
+        check(httptools.download_basic(url, file_path=first, with_progress=False), changed)
+        check(store.object_path(SHA256))
+
+        # An object that changed anyway isn't reused.
+        server.files["/file.dat"] = DATA
+        httptools.probe_url.cache_clear()
+        httptools.download_url(url, str(tmp_path), store=store)
+        os.chmod(store.object_path(SHA256), 0o644)
+        with open(store.object_path(SHA256), 'r+b') as f:
+            f.write(b"x")
+        del server.requests[:]
+        check(httptools.download_url(url, str(tmp_path), store=store))
+        check(store.object_path(SHA256))
+        assert transfers(server)
+
+
+def test_store_request_arguments(tmp_path):
+    httptools.probe_url.cache_clear()
+    with LocalServer({"/file.dat": DATA}) as server, DownloadStore(str(tmp_path / "store")) as store:
+        server.fail = lambda handler: None if handler.headers.get("Cookie") == "k=v" else 401
+        path = httptools.download_url(server.url("/file.dat"), str(tmp_path), store=store, cookies={"k": "v"},
+                                      connections=2)
+        check(path)
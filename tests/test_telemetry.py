@@ -0,0 +1,158 @@
+""" Download telemetry tests against a local HTTP server (see local_server.py). """
+
+import collections
+import threading
+import time
+
+from pytools import httptools, ratelimit, telemetry
+from local_server import LocalServer, random_data
+
+DATA = random_data(3 * 2 ** 20 + 12345)
+RETRY = httptools.RetryPolicy(attempts=3, backoff=0.01)
+
+
+class Recorder:
+    def __init__(self):
+        self.events = []
+        self.lock = threading.Lock()
+
+    def __call__(self, event, transfer, connection=None, **data):
+        with self.lock:
+            self.events.append((event, connection is None, data))
+
+    def count(self, event, transfer_level=False):
+        return sum(1 for e, level, _ in self.events if e == event and level == transfer_level)
+
+    def received(self):
+        return sum(data["size"] for e, _, data in self.events if e == "received")
+
+
+def check(path):
+    with open(path, 'rb') as f:
+        assert f.read() == DATA
+
+
+def stall_first_request(server, seconds=5):
+    """ The first GET (that isn't a probe) sends one chunk and then stalls. """
+    stalled = set()
+
+    def delay(handler, start):
+        if handler.headers.get("Range") != "bytes=0-0" and not stalled:
+            stalled.add(start)
+            return seconds
+        return 0
+    server.delay = delay
+
+
+def test_throughput():
+    throughput = telemetry.Throughput(alpha=0.5, interval=1, now=0)
+    throughput.add(100, 0.5)
+    assert throughput.rate == 0  # Not updated before the interval.
+    throughput.add(100, 1)
+    assert throughput.rate == 200
+    throughput.add(400, 2)
+    assert throughput.rate == 300
+
+
+def test_monitor_events(tmp_path):
+    recorder = Recorder()
+    with telemetry.DownloadMonitor(hooks=[recorder]) as monitor, LocalServer({"/file.dat": DATA}) as server:
+        snapshots = []
+        monitor.add_hook(lambda event, *args, **data: event == "finished" and snapshots.append(monitor.snapshot()))
+        path = httptools.download_url(server.url("/file.dat"), str(tmp_path), with_progress=False,
+                                      connections=4, segment_size=2 ** 20, monitor=monitor)
+        check(path)
+        assert recorder.count("started", True) == recorder.count("finished", True) == 1
+        assert recorder.count("started") == recorder.count("finished") >= 4  # One per segment (and split).
+        assert recorder.received() == len(DATA)
+        assert monitor.snapshot() == []
+        assert snapshots[-2][0]["bytes"] == len(DATA)
+        assert snapshots[-2][0]["ttfb"] is not None
+
+        recorder.events.clear()
+        path = httptools.download_basic(server.url("/file.dat"), dir_path=str(tmp_path), file_name="basic.dat",
+                                        with_progress=False, monitor=monitor)
+        check(path)
+        assert recorder.count("started") == recorder.count("finished") == 1
+        assert recorder.received() == len(DATA)
+
+
+def test_monitor_error(tmp_path):
+    recorder = Recorder()
+    monitor = telemetry.DownloadMonitor(hooks=[recorder])
+    with LocalServer({"/file.dat": DATA}) as server:
+        server.drop = lambda handler, start: 2 ** 20 if handler.headers.get("Range") != "bytes=0-0" else None
+        try:
+            httptools.download_basic(server.url("/file.dat"), dir_path=str(tmp_path), with_progress=False,
+                                     monitor=monitor)
+            assert False, "should have failed"
+        except Exception:
+            pass
+    errors = [data["error"] for event, level, data in recorder.events if event == "finished" and level]
+    assert len(errors) == 1 and errors[0] is not None
+
+
+def test_stall_basic(tmp_path):
+    recorder = Recorder()
+    with telemetry.DownloadMonitor(hooks=[recorder], stall_timeout=0.5) as monitor, \
+            LocalServer({"/file.dat": DATA}) as server:
+        stall_first_request(server)
+        started = time.monotonic()
+        path = httptools.download_basic(server.url("/file.dat"), dir_path=str(tmp_path), with_progress=False,
+                                        retry=RETRY, monitor=monitor)
+        assert time.monotonic() - started < 4
+        check(path)
+        assert recorder.count("stalled") == 1
+        assert recorder.count("retried") == 1
+        assert recorder.received() == len(DATA)
+
+
+def test_stall_multiple_connections(tmp_path):
+    recorder = Recorder()
+    with telemetry.DownloadMonitor(hooks=[recorder], stall_timeout=0.5) as monitor, \
+            LocalServer({"/file.dat": DATA}) as server:
+        stall_first_request(server)
+        started = time.monotonic()
+        # Stalled segments are re-issued even without a RetryPolicy.
+        path = httptools.download_multiple_connections(server.url("/file.dat"), str(tmp_path), connections=2,
+            segment_size=2 ** 20, with_progress=False, monitor=monitor)
+        assert time.monotonic() - started < 4
+        check(path)
+        assert recorder.count("stalled") == 1
+        finished = collections.Counter(data.get("error") is None for event, level, data in recorder.events
+                                       if event == "finished" and not level)
+        assert finished[False] == 1
+
+
+def test_no_stall_while_throttled(tmp_path):
+    recorder = Recorder()
+    data = DATA[:2 ** 18]
+    # Each chunk (of SEGMENT_CHUNK_SIZE) waits 0.5 s for the limiter, longer than the stall timeout.
+    limiter = ratelimit.RateLimiter(host_bytes_per_second=2 * httptools.SEGMENT_CHUNK_SIZE)
+    with telemetry.DownloadMonitor(hooks=[recorder], stall_timeout=0.3) as monitor, \
+            LocalServer({"/file.dat": data}) as server:
+        httptools.download_basic(server.url("/file.dat"), dir_path=str(tmp_path), file_name="basic.dat",
+                                 with_progress=False, limiter=limiter, monitor=monitor)
+        httptools.download_multiple_connections(server.url("/file.dat"), str(tmp_path), connections=2,
+            segment_size=2 ** 17, with_progress=False, limiter=limiter, monitor=monitor)
+    assert recorder.count("stalled") == 0
+    assert recorder.received() == 2 * len(data)
+
+
+def test_no_stall_before_response(tmp_path):
+    recorder = Recorder()
+    slow = set()
+
+    def fail(handler):
+        # The first GET (that isn't a probe) takes a while to answer.
+        if handler.command == "GET" and handler.headers.get("Range") != "bytes=0-0" and not slow:
+            slow.add(handler)
+            time.sleep(1)
+    with telemetry.DownloadMonitor(hooks=[recorder], stall_timeout=0.3) as monitor, \
+            LocalServer({"/file.dat": DATA}) as server:
+        server.fail = fail
+        path = httptools.download_multiple_connections(server.url("/file.dat"), str(tmp_path), connections=2,
+            segment_size=2 ** 20, with_progress=False, monitor=monitor)
+        check(path)
+    assert slow
+    assert recorder.count("stalled") == 0